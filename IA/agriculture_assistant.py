@@ -1,37 +1,80 @@
+import os
 import requests
+from knowledge_index import KnowledgeIndex, DEFAULT_TOP_K
 
-LLAMA_API_URL = "http://localhost:8º    º   º   º   º   º   º000/v1/chat/completions"
+LLAMA_API_URL = os.environ.get("LLAMA_API_URL", "http://localhost:8000/v1/chat/completions")
+LLAMA_TIMEOUT = (5, float(os.environ.get("LLAMA_TIMEOUT", "120"))) # (conexión, lectura) en segundos
+
+GENERATION_PARAMS = {"temperature": 0.2, "max_tokens": 512}
+
+MODEL_ERROR_PREFIX = "Error al contactar con el modelo"
+
+# Sesión compartida: reutiliza la conexión HTTP con el servidor del modelo entre preguntas
+llama_session = requests.Session()
 
 def load_knowledge_base(file_path):
     with open(file_path, 'r', encoding='utf-8') as f:
         return f.read()
 
-def ask_question(knowledge_base, question):
-    system_prompt = f"""Eres un experto asesor agrícola. Responde de forma clara, concisa y profesional usando la siguiente base de conocimientos:
+def build_knowledge_index(file_path):
+    """Construye una vez el índice de recuperación sobre la base de conocimientos."""
+    return KnowledgeIndex.from_file(file_path)
+
+def retrieve_knowledge(knowledge_index, query, top_k=DEFAULT_TOP_K):
+    """Devuelve como texto (una viñeta por hecho) los hechos más relevantes para la consulta."""
+    return "\n".join(f"- {fact}" for fact in knowledge_index.search(query, k=top_k))
+
+# Instrucciones fijas, idénticas en todas las preguntas: van al principio del prompt
+# para que el servidor reutilice su caché KV ("cache_prompt"). Los hechos recuperados,
+# distintos en cada pregunta, van detrás.
+SYSTEM_PROMPT = """Eres un experto asesor agrícola. Responde de forma clara, concisa y profesional.
+Basa tu respuesta en la BASE DE CONOCIMIENTOS que sigue a estas instrucciones y ten en cuenta el contexto de región de la pregunta."""
+
+def build_prompt(knowledge_base, question):
+    return f"""{SYSTEM_PROMPT}
 
 BASE DE CONOCIMIENTOS:
-\"\"\"{knowledge_base}\"\"\""""
+\"\"\"{knowledge_base}\"\"\"
+Usuario: {question}
+Asistente:"""
 
+def build_payload(knowledge_base, question, stream=False):
+    """Cuerpo de la petición al servidor del modelo (compartido por el servidor síncrono y el asíncrono)."""
     payload = {
-        "prompt": f"{system_prompt}\nUsuario: {question}\nAsistente:",
-        "temperature": 0.2,
-        "max_tokens": 512
+        "prompt": build_prompt(knowledge_base, question),
+        **GENERATION_PARAMS,
+        "cache_prompt": True, # llama.cpp: reutiliza la caché KV del prefijo SYSTEM_PROMPT
     }
+    if stream:
+        payload["stream"] = True
+    return payload
+
+def extract_completion_text(result):
+    """Texto de una respuesta completa del modelo (formato chat, completions o llama.cpp nativo)."""
+    choice = (result.get("choices") or [{}])[0]
+    text = choice.get("message", {}).get("content") or choice.get("text") or result.get("content") or ""
+    return text.strip()
 
+def extract_stream_delta(chunk):
+    """Fragmento de texto de un evento de streaming del modelo ('' si no trae texto)."""
+    choice = (chunk.get("choices") or [{}])[0]
+    return choice.get("delta", {}).get("content") or choice.get("text") or chunk.get("content") or ""
+
+def ask_question(knowledge_base, question):
+    """knowledge_base: texto de conocimientos para el prompt (la base completa o solo los hechos recuperados)."""
     try:
-        response = requests.post(LLAMA_API_URL, json=payload)
+        response = llama_session.post(LLAMA_API_URL, json=build_payload(knowledge_base, question), timeout=LLAMA_TIMEOUT)
         response.raise_for_status()
-        result = response.json()
-        return result.get("choices", [{}])[0].get("message", {}).get("content", "").strip()
+        return extract_completion_text(response.json())
     except requests.RequestException as e:
-        return f"Error al contactar con el modelo: {e}"
+        return f"{MODEL_ERROR_PREFIX}: {e}"
 
 if __name__ == "__main__":
-    knowledge_base = load_knowledge_base("base_conocimiento.txt")
+    knowledge_index = build_knowledge_index("base_conocimiento.txt")
 
     while True:
         user_question = input("\nIntroduce tu pregunta sobre agricultura (o 'salir' para terminar): ")
         if user_question.lower() == "salir":
             break
-        answer = ask_question(knowledge_base, user_question)
+        answer = ask_question(retrieve_knowledge(knowledge_index, user_question), user_question)
         print(f"\n🤖 Respuesta:\n{answer}")
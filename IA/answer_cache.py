@@ -0,0 +1,155 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from knowledge_index import normalize_text, tokenize
+
+# Caché de respuestas del asistente. La clave es (pregunta normalizada, región):
+# dos agricultores de la misma región que preguntan "¿Cuándo regar?" y
+# "cuando regar" reciben la misma respuesta sin volver a llamar al modelo.
+# Opcionalmente, una pregunta parecida (similitud de Jaccard entre sus términos
+# >= similarity_threshold) también cuenta como acierto.
+
+DEFAULT_MAX_ENTRIES = 1000
+DEFAULT_TTL_SECONDS = 6 * 3600
+
+def normalize_question(question):
+    """'¿Cuándo  REGAR?' -> 'cuando regar' (sin tildes, signos ni espacios repetidos)."""
+    words = ''.join(c if c.isalnum() else ' ' for c in normalize_text(question)).split()
+    return ' '.join(words)
+
+def jaccard_similarity(terms_a, terms_b):
+    if not terms_a or not terms_b:
+        return 0.0
+    return len(terms_a & terms_b) / len(terms_a | terms_b)
+
+def file_signature(file_path):
+    """Identifica la versión de un fichero (fecha de modificación y tamaño); None si no existe."""
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+class AnswerCache:
+    """
+    Caché LRU con caducidad (TTL) y tamaño máximo, segura entre hilos.
+    Si se indica knowledge_path, check_knowledge() la vacía en cuanto cambia ese
+    fichero y avanza la generación: el servidor reconstruye su índice cuando la
+    generación cambia, y put() descarta las respuestas calculadas con una anterior.
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, ttl_seconds=DEFAULT_TTL_SECONDS,
+                 similarity_threshold=None, knowledge_path=None):
+        self.max_entries = max(1, max_entries)
+        self.ttl_seconds = ttl_seconds
+        self.similarity_threshold = similarity_threshold # None o 0 = solo coincidencia exacta
+        self.knowledge_path = knowledge_path
+        self._knowledge_signature = file_signature(knowledge_path) if knowledge_path else None
+        self.generation = 0 # Versión de la base de conocimientos vista por la caché
+        self._entries = OrderedDict() # (pregunta normalizada, región) -> (expira, términos, respuesta)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self.stale_puts = 0
+
+    @classmethod
+    def from_env(cls, knowledge_path=None):
+        """Caché configurada con ANSWER_CACHE_SIZE, ANSWER_CACHE_TTL y ANSWER_CACHE_SIMILARITY (0-1)."""
+        similarity = float(os.environ.get('ANSWER_CACHE_SIMILARITY', '0'))
+        return cls(max_entries=int(os.environ.get('ANSWER_CACHE_SIZE', DEFAULT_MAX_ENTRIES)),
+                   ttl_seconds=float(os.environ.get('ANSWER_CACHE_TTL', DEFAULT_TTL_SECONDS)),
+                   similarity_threshold=similarity or None,
+                   knowledge_path=knowledge_path)
+
+    def _key(self, question, region):
+        return (normalize_question(question), normalize_text(region or '').strip())
+
+    def check_knowledge(self):
+        """
+        Único punto que detecta cambios en la base de conocimientos: si el fichero
+        cambió, vacía la caché y avanza la generación. Devuelve la generación actual.
+        """
+        with self._lock:
+            if self.knowledge_path:
+                signature = file_signature(self.knowledge_path)
+                if signature != self._knowledge_signature:
+                    self._knowledge_signature = signature
+                    self.generation += 1
+                    if self._entries:
+                        self._entries.clear()
+                        self.invalidations += 1
+            return self.generation
+
+    def get(self, question, region):
+        """Devuelve la respuesta guardada para la pregunta en esa región, o None."""
+        key = self._key(question, region)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[2]
+                del self._entries[key]
+                self.expirations += 1
+
+            if self.similarity_threshold:
+                terms = frozenset(tokenize(key[0]))
+                best_key, best_score = None, 0.0
+                for other_key, (expires_at, other_terms, _) in self._entries.items():
+                    if other_key[1] != key[1] or expires_at <= now:
+                        continue
+                    score = jaccard_similarity(terms, other_terms)
+                    if score > best_score:
+                        best_key, best_score = other_key, score
+                if best_key is not None and best_score >= self.similarity_threshold:
+                    self._entries.move_to_end(best_key)
+                    self.similar_hits += 1
+                    return self._entries[best_key][2]
+
+            self.misses += 1
+            return None
+
+    def put(self, question, region, answer, generation=None):
+        """Guarda la respuesta; la descarta (False) si se calculó con una generación anterior de la base de conocimientos."""
+        key = self._key(question, region)
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                self.stale_puts += 1
+                return False
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, frozenset(tokenize(key[0])), answer)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+            return True
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.similar_hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'maxEntries': self.max_entries,
+                'ttlSeconds': self.ttl_seconds,
+                'similarityThreshold': self.similarity_threshold,
+                'hits': self.hits,
+                'similarHits': self.similar_hits,
+                'misses': self.misses,
+                'hitRate': round((self.hits + self.similar_hits) / lookups, 4) if lookups else None,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+                'knowledgeGeneration': self.generation,
+                'stalePuts': self.stale_puts,
+            }
@@ -1,14 +1,44 @@
 from flask import Flask, request, jsonify
 from flask_cors import CORS
-from agriculture_assistant import load_knowledge_base, ask_question
+from agriculture_assistant import build_knowledge_index, retrieve_knowledge, ask_question, MODEL_ERROR_PREFIX
+from answer_cache import AnswerCache
 import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # telemetry.py, compartido con los scripts de ingesta
+import telemetry
+from water_balance import WaterBalanceModel, CROP_COEFFICIENTS
+from datetime import datetime
 
 app = Flask(__name__)
 CORS(app)  # Habilita CORS para todas las rutas
 
 current_dir = os.path.dirname(os.path.abspath(__file__))
 knowledge_base_path = os.path.join(current_dir, 'base_conocimiento.txt')
-knowledge_base = load_knowledge_base(knowledge_base_path)
+# El índice de recuperación se construye una sola vez al arrancar; cada pregunta
+# envía al modelo solo los hechos relevantes, no el fichero completo.
+knowledge_index = build_knowledge_index(knowledge_base_path)
+TOP_K_FACTS = int(os.environ.get('ASSISTANT_TOP_K', '8'))
+
+# Respuestas ya generadas por (pregunta normalizada, región). ANSWER_CACHE_SIMILARITY
+# (0-1) permite reutilizar también la respuesta de una pregunta parecida.
+answer_cache = AnswerCache.from_env(knowledge_base_path)
+knowledge_generation = answer_cache.generation # Generación de la base de conocimientos con la que se construyó el índice
+
+# Balance hídrico (water_balance.py) sobre los CSV de aemetDATA; se carga en la primera consulta
+aemet_data_path = os.path.join(os.path.dirname(current_dir), 'aemetDATA')
+water_balance_model = None
+
+def get_water_balance_model():
+    """El modelo se carga una sola vez; si falla se recuerda (False) y se devuelve None sin reintentar."""
+    global water_balance_model
+    if water_balance_model is None:
+        try:
+            model = WaterBalanceModel.load(aemet_data_path)
+        except Exception as e:
+            print(f"Balance hídrico no disponible: {e}")
+            model = False
+        water_balance_model = model if model and model.keys else False
+    return water_balance_model or None
 
 @app.route('/ask', methods=['POST'])
 def ask():
@@ -22,10 +52,64 @@ def ask():
     # Agregar contexto de la región a la pregunta
     contextualized_question = f"Contexto de región: {region}. Pregunta: {question}"
 
-    answer = ask_question(knowledge_base, contextualized_question)
+    global knowledge_index, knowledge_generation
+    generation = answer_cache.check_knowledge()
+    if generation != knowledge_generation:
+        # La base de conocimientos ha cambiado: la caché ya se ha vaciado, se reconstruye el índice
+        knowledge_index = build_knowledge_index(knowledge_base_path)
+        knowledge_generation = generation
+
+    cached_answer = answer_cache.get(question, region)
+    telemetry.inc("cache_requests_total", cache="answers", result="miss" if cached_answer is None else "hit")
+    if cached_answer is not None:
+        return jsonify({'answer': cached_answer, 'cached': True})
+
+    with telemetry.timed("retrieval"):
+        relevant_knowledge = retrieve_knowledge(knowledge_index, f"{question} {region}", top_k=TOP_K_FACTS)
+    with telemetry.timed("llm", mode="complete"):
+        answer = ask_question(relevant_knowledge, contextualized_question)
+    if answer and not answer.startswith(MODEL_ERROR_PREFIX):
+        answer_cache.put(question, region, answer, generation)
+    else:
+        telemetry.inc("errors_total", stage="llm", mode="complete")
     return jsonify({'answer': answer})
 
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    return jsonify(answer_cache.stats())
+
+@app.route('/water-balance', methods=['GET'])
+def water_balance():
+    """Riego necesario hasta diciembre para una región: ?region=MADRID&month=1-12&humidity=%&crop=maiz&daily=1"""
+    region = request.args.get('region', '')
+    crop = request.args.get('crop')
+    try:
+        month = int(request.args.get('month', datetime.now().month))
+        humidity = request.args.get('humidity')
+        humidity = float(humidity) if humidity not in (None, '') else None
+    except ValueError:
+        return jsonify({'error': 'Parámetros month/humidity no válidos.'}), 400
+    if not region or not 1 <= month <= 12 or (crop and crop not in CROP_COEFFICIENTS):
+        return jsonify({'error': 'Región, mes (1-12) o cultivo no válidos.', 'crops': list(CROP_COEFFICIENTS)}), 400
+
+    model = get_water_balance_model()
+    if model is None:
+        return jsonify({'error': 'Balance hídrico no disponible: no se pudieron cargar los datos históricos.'}), 503
+    crops = {crop: CROP_COEFFICIENTS[crop]} if crop else CROP_COEFFICIENTS
+    with telemetry.timed("water_balance"):
+        projection = model.project(region, month - 1, humidity, crops=crops,
+                                   daily=request.args.get('daily') == '1')
+    if projection is None:
+        return jsonify({'error': f'Sin datos históricos para la región {region}.'}), 404
+    return jsonify({'region': region, 'startMonth': month, 'initialHumidity': humidity, 'crops': projection})
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Tiempos por etapa y contadores en formato Prometheus (ver telemetry.py)."""
+    return telemetry.render_prometheus(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+
 if __name__ == '__main__':
+    telemetry.configure_from_env("api_assistant")
     app.run(host='0.0.0.0', port=5000)
 
 
@@ -0,0 +1,304 @@
+import asyncio
+import contextlib
+import json
+import os
+import sys
+import time
+import aiohttp
+from aiohttp import web
+from agriculture_assistant import (build_knowledge_index, retrieve_knowledge, build_prompt, build_payload,
+                                   extract_completion_text, extract_stream_delta, LLAMA_API_URL, MODEL_ERROR_PREFIX)
+from answer_cache import AnswerCache
+from llm_batcher import MicroBatcher, DEFAULT_MAX_BATCH_SIZE
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # telemetry.py, compartido con los scripts de ingesta
+import telemetry
+from water_balance import WaterBalanceModel, CROP_COEFFICIENTS
+from datetime import datetime
+
+# Servidor asíncrono del asistente (alternativa a api_assistant.py con la misma API).
+# Una generación lenta ya no bloquea un worker: todas las peticiones comparten un
+# bucle de eventos y un pool de conexiones con el servidor del modelo. /ask
+# devuelve la respuesta token a token (Server-Sent Events) si el cliente lo pide
+# con "Accept: text/event-stream", o el JSON {"answer": ...} de siempre si no.
+#
+#   python async_api_assistant.py   (mismo puerto 5000 que la versión Flask)
+
+LLM_CONCURRENCY = int(os.environ.get('ASSISTANT_LLM_CONCURRENCY', '2')) # Generaciones simultáneas enviadas al modelo
+LLM_QUEUE_TIMEOUT = float(os.environ.get('ASSISTANT_QUEUE_TIMEOUT', '30')) # Espera máxima por un hueco libre (s)
+LLM_TIMEOUT = aiohttp.ClientTimeout(
+    total=float(os.environ.get('LLAMA_TIMEOUT', '120')), # Generación completa
+    sock_connect=5,
+    sock_read=30, # Máximo entre dos fragmentos de la respuesta
+)
+TOP_K_FACTS = int(os.environ.get('ASSISTANT_TOP_K', '8'))
+# Micro-lotes (llm_batcher.py): con una ventana > 0 las preguntas simultáneas se envían
+# juntas al modelo. Prioriza el rendimiento total sobre la latencia del primer token:
+# en ese modo los clientes SSE reciben la respuesta completa en un único evento.
+BATCH_WINDOW_MS = float(os.environ.get('ASSISTANT_BATCH_WINDOW_MS', '0'))
+BATCH_MAX_SIZE = int(os.environ.get('ASSISTANT_BATCH_MAX_SIZE', str(DEFAULT_MAX_BATCH_SIZE)))
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+knowledge_base_path = os.path.join(current_dir, 'base_conocimiento.txt')
+aemet_data_path = os.path.join(os.path.dirname(current_dir), 'aemetDATA') # Balance hídrico (water_balance.py)
+
+CORS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Headers': 'Content-Type, Accept',
+    'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
+}
+
+
+class ModelBusyError(Exception):
+    """No se ha liberado ningún hueco de generación dentro de LLM_QUEUE_TIMEOUT."""
+
+
+async def _acquire_generation_slot(app):
+    try:
+        await asyncio.wait_for(app['llm_semaphore'].acquire(), timeout=LLM_QUEUE_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise ModelBusyError()
+
+async def complete(app, knowledge, question):
+    """Genera la respuesta completa (sin streaming), a través de la cola de micro-lotes si está activa."""
+    if app['batcher'] is not None:
+        return await app['batcher'].submit(build_prompt(knowledge, question))
+    await _acquire_generation_slot(app)
+    try:
+        async with app['llm_session'].post(LLAMA_API_URL, json=build_payload(knowledge, question)) as response:
+            response.raise_for_status()
+            return extract_completion_text(await response.json(content_type=None))
+    finally:
+        app['llm_semaphore'].release()
+
+async def stream_completion(app, knowledge, question):
+    """
+    Generador asíncrono de fragmentos de texto a medida que el modelo los produce.
+    Si quien lo consume deja de leerlo (cliente desconectado), al cerrarse se
+    cierra también la conexión con el modelo y la generación se detiene.
+    """
+    await _acquire_generation_slot(app)
+    try:
+        async with app['llm_session'].post(LLAMA_API_URL, json=build_payload(knowledge, question, stream=True)) as response:
+            response.raise_for_status()
+            async for raw_line in response.content:
+                line = raw_line.decode('utf-8', errors='replace').strip()
+                if not line.startswith('data:'):
+                    continue
+                data = line[len('data:'):].strip()
+                if data == '[DONE]':
+                    break
+                try:
+                    delta = extract_stream_delta(json.loads(data))
+                except json.JSONDecodeError:
+                    continue
+                if delta:
+                    yield delta
+    finally:
+        app['llm_semaphore'].release()
+
+
+def _sse_event(data, event=None):
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data, ensure_ascii=False)}\n\n".encode('utf-8')
+
+def _check_knowledge(app):
+    """Generación de la base de conocimientos; si cambió (la caché ya se ha vaciado), reconstruye el índice."""
+    generation = app['answer_cache'].check_knowledge()
+    if generation != app['knowledge_generation']:
+        app['knowledge_index'] = build_knowledge_index(knowledge_base_path)
+        app['knowledge_generation'] = generation
+    return generation
+
+def _prepare_question(app, question, region):
+    """Hechos relevantes y pregunta con el contexto de región; solo hace falta si la respuesta no está en caché."""
+    contextualized_question = f"Contexto de región: {region}. Pregunta: {question}"
+    with telemetry.timed("retrieval"):
+        knowledge = retrieve_knowledge(app['knowledge_index'], f"{question} {region}", top_k=TOP_K_FACTS)
+    return knowledge, contextualized_question
+
+async def _complete_answer(app, question, region, knowledge, contextualized_question, generation):
+    """Respuesta completa como (respuesta, mensaje de error, estado HTTP); la guarda en caché si no hubo error."""
+    mode = "batch" if app['batcher'] is not None else "complete"
+    try:
+        with telemetry.timed("llm", mode=mode):
+            answer = await complete(app, knowledge, contextualized_question)
+    except ModelBusyError:
+        telemetry.inc("errors_total", stage="llm", mode=mode)
+        return None, 'El asistente está ocupado, inténtalo de nuevo en unos segundos.', 503
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        telemetry.inc("errors_total", stage="llm", mode=mode)
+        return None, f"{MODEL_ERROR_PREFIX}: {e}", 200
+    if answer:
+        app['answer_cache'].put(question, region, answer, generation)
+    return answer, None, 200
+
+async def ask(request):
+    try:
+        data = await request.json()
+    except json.JSONDecodeError:
+        data = {}
+    question = data.get('question', '')
+    region = data.get('region', 'Región no especificada')
+    if not question:
+        return web.json_response({'answer': 'Pregunta no válida.'}, status=400)
+
+    app = request.app
+    generation = _check_knowledge(app)
+    wants_stream = 'text/event-stream' in request.headers.get('Accept', '') or data.get('stream') is True
+    cached_answer = app['answer_cache'].get(question, region)
+    telemetry.inc("cache_requests_total", cache="answers", result="miss" if cached_answer is None else "hit")
+    if cached_answer is None:
+        knowledge, contextualized_question = _prepare_question(app, question, region)
+
+    if not wants_stream:
+        if cached_answer is not None:
+            return web.json_response({'answer': cached_answer, 'cached': True})
+        answer, error, status = await _complete_answer(app, question, region, knowledge, contextualized_question, generation)
+        return web.json_response({'answer': answer or error}, status=status)
+
+    response = web.StreamResponse(headers={
+        'Content-Type': 'text/event-stream; charset=utf-8',
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+        **CORS_HEADERS, # Las cabeceras salen en prepare(), antes de que actúe el middleware
+    })
+    await response.prepare(request)
+    if cached_answer is not None:
+        await response.write(_sse_event({'delta': cached_answer}))
+        await response.write(_sse_event({'answer': cached_answer, 'cached': True}, event='done'))
+        return response
+    if app['batcher'] is not None:
+        answer, error, _ = await _complete_answer(app, question, region, knowledge, contextualized_question, generation)
+        if error:
+            await response.write(_sse_event({'error': error}, event='error'))
+        else:
+            await response.write(_sse_event({'delta': answer}))
+            await response.write(_sse_event({'answer': answer}, event='done'))
+        return response
+
+    parts = []
+    start = time.perf_counter()
+    try:
+        # aclosing: al salir por error o cancelación se cierra la conexión con el modelo en el acto
+        async with contextlib.aclosing(stream_completion(app, knowledge, contextualized_question)) as deltas:
+            async for delta in deltas:
+                if not parts:
+                    telemetry.observe(telemetry.STAGE_METRIC, time.perf_counter() - start, stage="llm_first_token")
+                parts.append(delta)
+                # Si el navegador se ha ido, write() lanza ConnectionResetError y se cancela la generación
+                await response.write(_sse_event({'delta': delta}))
+    except ModelBusyError:
+        telemetry.inc("errors_total", stage="llm", mode="stream")
+        await response.write(_sse_event({'error': 'El asistente está ocupado, inténtalo de nuevo en unos segundos.'}, event='error'))
+        return response
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        telemetry.inc("errors_total", stage="llm", mode="stream")
+        await response.write(_sse_event({'error': f"{MODEL_ERROR_PREFIX}: {e}"}, event='error'))
+        return response
+    telemetry.observe(telemetry.STAGE_METRIC, time.perf_counter() - start, stage="llm", mode="stream")
+
+    answer = ''.join(parts).strip()
+    if answer:
+        app['answer_cache'].put(question, region, answer, generation)
+    await response.write(_sse_event({'answer': answer}, event='done'))
+    return response
+
+async def cache_stats(request):
+    return web.json_response(request.app['answer_cache'].stats())
+
+async def water_balance(request):
+    """Riego necesario hasta diciembre, como /water-balance de api_assistant.py."""
+    region = request.query.get('region', '')
+    crop = request.query.get('crop')
+    try:
+        month = int(request.query.get('month', datetime.now().month))
+        humidity = request.query.get('humidity')
+        humidity = float(humidity) if humidity not in (None, '') else None
+    except ValueError:
+        return web.json_response({'error': 'Parámetros month/humidity no válidos.'}, status=400)
+    if not region or not 1 <= month <= 12 or (crop and crop not in CROP_COEFFICIENTS):
+        return web.json_response({'error': 'Región, mes (1-12) o cultivo no válidos.',
+                                  'crops': list(CROP_COEFFICIENTS)}, status=400)
+
+    model = request.app['water_balance_model']
+    if model is None:
+        return web.json_response({'error': 'Balance hídrico no disponible: no se pudieron cargar los datos históricos.'},
+                                 status=503)
+    crops = {crop: CROP_COEFFICIENTS[crop]} if crop else CROP_COEFFICIENTS
+    # Unos milisegundos de numpy: se calcula en el propio bucle de eventos
+    with telemetry.timed("water_balance"):
+        projection = model.project(region, month - 1, humidity, crops=crops,
+                                   daily=request.query.get('daily') == '1')
+    if projection is None:
+        return web.json_response({'error': f'Sin datos históricos para la región {region}.'}, status=404)
+    return web.json_response({'region': region, 'startMonth': month, 'initialHumidity': humidity, 'crops': projection})
+
+async def metrics(request):
+    """Tiempos por etapa y contadores en formato Prometheus (ver telemetry.py)."""
+    return web.Response(text=telemetry.render_prometheus(), content_type='text/plain')
+
+async def batch_stats(request):
+    batcher = request.app['batcher']
+    return web.json_response(batcher.stats() if batcher is not None else {'enabled': False})
+
+
+@web.middleware
+async def cors_middleware(request, handler):
+    """Equivalente a flask_cors.CORS(app): permite peticiones desde cualquier origen."""
+    if request.method == 'OPTIONS':
+        response = web.Response()
+    else:
+        response = await handler(request)
+    if not response.prepared:
+        response.headers.update(CORS_HEADERS)
+    return response
+
+async def on_startup(app):
+    app['llm_session'] = aiohttp.ClientSession(
+        timeout=LLM_TIMEOUT,
+        connector=aiohttp.TCPConnector(limit=LLM_CONCURRENCY, keepalive_timeout=60),
+    )
+    app['llm_semaphore'] = asyncio.Semaphore(LLM_CONCURRENCY)
+    app['batcher'] = None
+    if BATCH_WINDOW_MS > 0:
+        app['batcher'] = MicroBatcher(app['llm_session'], window_seconds=BATCH_WINDOW_MS / 1000.0,
+                                      max_batch_size=BATCH_MAX_SIZE, semaphore=app['llm_semaphore'])
+        app['batcher'].start()
+
+async def on_cleanup(app):
+    if app['batcher'] is not None:
+        await app['batcher'].close()
+    await app['llm_session'].close()
+
+def load_water_balance_model():
+    """Se carga una vez al arrancar; si falla, /water-balance responde 503 en lugar de tumbar el servidor."""
+    try:
+        model = WaterBalanceModel.load(aemet_data_path)
+    except Exception as e:
+        print(f"Balance hídrico no disponible: {e}")
+        return None
+    return model if model.keys else None
+
+def create_app():
+    app = web.Application(middlewares=[cors_middleware])
+    # El índice de recuperación y la caché se crean una vez al arrancar, como en api_assistant.py
+    app['knowledge_index'] = build_knowledge_index(knowledge_base_path)
+    app['answer_cache'] = AnswerCache.from_env(knowledge_base_path)
+    app['knowledge_generation'] = app['answer_cache'].generation
+    app['water_balance_model'] = load_water_balance_model()
+    app.router.add_route('POST', '/ask', ask)
+    app.router.add_route('OPTIONS', '/ask', ask)
+    app.router.add_route('GET', '/cache/stats', cache_stats)
+    app.router.add_route('GET', '/batch/stats', batch_stats)
+    app.router.add_route('GET', '/water-balance', water_balance)
+    app.router.add_route('GET', '/metrics', metrics)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+
+if __name__ == '__main__':
+    # handler_cancellation: si el cliente cierra la conexión se cancela su petición
+    # (y con ella la generación en curso en el servidor del modelo)
+    telemetry.configure_from_env("async_api_assistant")
+    web.run_app(create_app(), host='0.0.0.0', port=5000, handler_cancellation=True)
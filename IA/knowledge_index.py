@@ -0,0 +1,99 @@
+import math
+import re
+import unicodedata
+from collections import Counter
+
+# Índice léxico (BM25) sobre la base de conocimientos: cada línea "- ..." es un
+# hecho independiente. En lugar de enviar el fichero completo al modelo en cada
+# pregunta, se recuperan solo los hechos más relevantes.
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+DEFAULT_TOP_K = 8
+
+STOPWORDS = {
+    "a", "al", "algo", "ante", "antes", "como", "con", "cual", "cuando", "de", "del", "desde", "donde",
+    "durante", "e", "el", "ella", "ellas", "ellos", "en", "entre", "es", "esa", "ese", "eso", "esta", "este",
+    "esto", "estan", "hay", "la", "las", "le", "les", "lo", "los", "mas", "me", "mi", "mis", "muy", "no",
+    "o", "para", "pero", "por", "que", "se", "segun", "ser", "si", "sin", "sobre", "son", "su", "sus",
+    "tambien", "te", "tu", "un", "una", "uno", "unos", "unas", "y", "ya", "debo", "puedo", "hacer",
+    "pregunta", "contexto", "region", "mejor", "cuales",
+}
+
+# Verbos frecuentes en las preguntas -> sustantivo usado en la base de conocimientos
+SYNONYMS = {
+    "regar": "riego", "riega": "riego", "riegue": "riego", "regado": "riego",
+    "abonar": "abono", "abona": "abono", "sembrar": "siembra", "siembro": "siembra",
+    "fertilizar": "fertilizante", "podar": "poda", "cosechar": "cosecha",
+}
+
+def normalize_text(text):
+    """Minúsculas y sin tildes ('Región' -> 'region')."""
+    decomposed = unicodedata.normalize('NFD', text.lower())
+    return ''.join(c for c in decomposed if unicodedata.category(c) != 'Mn')
+
+def simple_stem(token):
+    """Reducción mínima de plurales para que 'cultivos' coincida con 'cultivo'."""
+    if len(token) > 5 and token.endswith('es'):
+        return token[:-2]
+    if len(token) > 4 and token.endswith('s'):
+        return token[:-1]
+    return token
+
+def tokenize(text):
+    return [simple_stem(SYNONYMS.get(t, t)) for t in re.findall(r"[a-z0-9ñ]+", normalize_text(text))
+            if t not in STOPWORDS and len(t) > 1]
+
+def split_facts(knowledge_text):
+    """Separa la base de conocimientos en hechos (una viñeta por hecho), sin repetidos."""
+    facts = []
+    seen = set()
+    for line in knowledge_text.splitlines():
+        line = line.strip()
+        fact = line[1:].strip() if line.startswith('-') else line
+        if fact and fact not in seen:
+            seen.add(fact)
+            facts.append(fact)
+    return facts
+
+
+class KnowledgeIndex:
+    """Índice BM25 en memoria. Se construye una vez y responde búsquedas top-k."""
+
+    def __init__(self, facts):
+        self.facts = facts
+        self._doc_terms = [Counter(tokenize(fact)) for fact in facts]
+        self._doc_lengths = [sum(terms.values()) for terms in self._doc_terms]
+        self._avg_length = (sum(self._doc_lengths) / len(facts)) if facts else 0.0
+        document_frequency = Counter()
+        for terms in self._doc_terms:
+            document_frequency.update(terms.keys())
+        n = len(facts)
+        self._idf = {term: math.log(1 + (n - df + 0.5) / (df + 0.5)) for term, df in document_frequency.items()}
+        # Índice invertido: término -> [(posición del hecho, frecuencia)]
+        self._postings = {}
+        for doc_id, terms in enumerate(self._doc_terms):
+            for term, freq in terms.items():
+                self._postings.setdefault(term, []).append((doc_id, freq))
+
+    @classmethod
+    def from_text(cls, knowledge_text):
+        return cls(split_facts(knowledge_text))
+
+    @classmethod
+    def from_file(cls, file_path):
+        with open(file_path, 'r', encoding='utf-8') as f:
+            return cls.from_text(f.read())
+
+    def search(self, query, k=DEFAULT_TOP_K):
+        """Devuelve los k hechos con mayor puntuación BM25 para la consulta (en su orden original)."""
+        scores = Counter()
+        for term in set(tokenize(query)):
+            idf = self._idf.get(term)
+            if idf is None:
+                continue
+            for doc_id, freq in self._postings[term]:
+                length_norm = 1 - BM25_B + BM25_B * self._doc_lengths[doc_id] / self._avg_length
+                scores[doc_id] += idf * freq * (BM25_K1 + 1) / (freq + BM25_K1 * length_norm)
+        best = sorted(doc_id for doc_id, _ in scores.most_common(k))
+        return [self.facts[doc_id] for doc_id in best]
@@ -0,0 +1,181 @@
+import asyncio
+import os
+import time
+from collections import Counter, deque
+from agriculture_assistant import GENERATION_PARAMS, extract_completion_text
+
+# Cola de micro-lotes delante del modelo local. Las preguntas que llegan dentro de
+# una misma ventana (window_seconds) se agrupan y se envían juntas en una única
+# petición de completions con una lista de prompts. Todos los prompts empiezan
+# por las mismas instrucciones del sistema (agriculture_assistant.SYSTEM_PROMPT,
+# antes de los hechos recuperados), así que con "cache_prompt" el servidor
+# reutiliza la caché KV de ese prefijo;
+# dentro del lote los prompts se ordenan para que los prefijos comunes queden
+# contiguos y los prompts idénticos se envían una sola vez.
+#
+# Si el servidor no admite varios prompts por petición (devuelve menos
+# resultados que prompts), el lote se envía como peticiones individuales
+# simultáneas y el resto de lotes ya se envían así.
+
+LLAMA_BATCH_API_URL = os.environ.get("LLAMA_BATCH_API_URL", "http://localhost:8000/v1/completions")
+DEFAULT_WINDOW_SECONDS = 0.05
+DEFAULT_MAX_BATCH_SIZE = 8
+METRICS_SAMPLES = 1000 # Muestras recientes guardadas para los percentiles
+
+def _percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(round((len(sorted_values) - 1) * p / 100.0)))]
+
+def parse_batch_results(result):
+    """Textos de una respuesta con varios prompts: lista de resultados (llama.cpp) o 'choices' con 'index'."""
+    if isinstance(result, list):
+        return [extract_completion_text(item) for item in result]
+    choices = sorted(result.get("choices") or [], key=lambda choice: choice.get("index", 0))
+    return [extract_completion_text({"choices": [choice]}) for choice in choices]
+
+
+class MicroBatcher:
+    """
+    submit(prompt) encola un prompt y devuelve (await) el texto generado.
+    Un lote se envía cuando reúne max_batch_size prompts o cuando han pasado
+    window_seconds desde que llegó el primero. `semaphore` (opcional) limita
+    los lotes en vuelo contra el modelo.
+    """
+
+    def __init__(self, session, url=LLAMA_BATCH_API_URL, window_seconds=DEFAULT_WINDOW_SECONDS,
+                 max_batch_size=DEFAULT_MAX_BATCH_SIZE, semaphore=None):
+        self.session = session
+        self.url = url
+        self.window_seconds = window_seconds
+        self.max_batch_size = max(1, max_batch_size)
+        self.semaphore = semaphore
+        self.supports_multi_prompt = True
+        self._queue = asyncio.Queue()
+        self._worker = None
+        self._inflight = set()
+        # Métricas
+        self.requests = 0
+        self.batches = 0
+        self.coalesced = 0 # prompts repetidos dentro de un lote, enviados una sola vez
+        self.cancelled = 0
+        self.failed_batches = 0
+        self._queue_waits = deque(maxlen=METRICS_SAMPLES) # segundos
+        self._batch_sizes = deque(maxlen=METRICS_SAMPLES)
+        self._batch_size_counts = Counter()
+
+    def start(self):
+        if self._worker is None:
+            self._worker = asyncio.get_running_loop().create_task(self._collect_batches())
+
+    async def close(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+        if self._inflight:
+            await asyncio.gather(*self._inflight, return_exceptions=True)
+
+    async def submit(self, prompt):
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        self.requests += 1
+        await self._queue.put((prompt, future, time.perf_counter()))
+        # Si quien espera se cancela (cliente desconectado), el futuro queda cancelado
+        # y su prompt se descarta al formar el lote si aún no se ha enviado
+        return await future
+
+    async def _collect_batches(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.window_seconds
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout=remaining))
+                except asyncio.TimeoutError:
+                    break
+            task = loop.create_task(self._dispatch(batch))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+
+    async def _dispatch(self, batch):
+        pending = []
+        for prompt, future, enqueued_at in batch:
+            if future.cancelled():
+                self.cancelled += 1
+            else:
+                pending.append((prompt, future, enqueued_at))
+        if not pending:
+            return
+
+        # Prompts únicos, ordenados para que los prefijos comunes queden juntos
+        prompts = sorted({prompt for prompt, _, _ in pending})
+        self.coalesced += len(pending) - len(prompts)
+
+        if self.semaphore is not None:
+            await self.semaphore.acquire()
+        try:
+            dispatched_at = time.perf_counter()
+            for _, _, enqueued_at in pending:
+                self._queue_waits.append(dispatched_at - enqueued_at)
+            self._batch_sizes.append(len(pending))
+            self._batch_size_counts[len(pending)] += 1
+            self.batches += 1
+            texts = await self._generate(prompts)
+        except Exception as e:
+            self.failed_batches += 1
+            for _, future, _ in pending:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            if self.semaphore is not None:
+                self.semaphore.release()
+
+        answers = dict(zip(prompts, texts))
+        for prompt, future, _ in pending:
+            if not future.done():
+                future.set_result(answers[prompt])
+
+    async def _generate(self, prompts):
+        if self.supports_multi_prompt and len(prompts) > 1:
+            texts = parse_batch_results(await self._post(prompts))
+            if len(texts) == len(prompts):
+                return texts
+            print(f"The model server returned {len(texts)} results for {len(prompts)} prompts; "
+                  f"sending batches as individual requests from now on.")
+            self.supports_multi_prompt = False
+        results = await asyncio.gather(*(self._post(prompt) for prompt in prompts))
+        return [extract_completion_text(result) for result in results]
+
+    async def _post(self, prompt):
+        payload = {"prompt": prompt, **GENERATION_PARAMS, "cache_prompt": True}
+        async with self.session.post(self.url, json=payload) as response:
+            response.raise_for_status()
+            return await response.json(content_type=None)
+
+    def stats(self):
+        waits = sorted(self._queue_waits)
+        sizes = list(self._batch_sizes)
+        return {
+            'requests': self.requests,
+            'batches': self.batches,
+            'queued': self._queue.qsize(),
+            'inflightBatches': len(self._inflight),
+            'windowMs': round(self.window_seconds * 1000, 1),
+            'maxBatchSize': self.max_batch_size,
+            'multiPrompt': self.supports_multi_prompt,
+            'coalesced': self.coalesced,
+            'cancelled': self.cancelled,
+            'failedBatches': self.failed_batches,
+            'meanBatchSize': round(sum(sizes) / len(sizes), 2) if sizes else None,
+            'batchSizeHistogram': {str(size): count for size, count in sorted(self._batch_size_counts.items())},
+            'queueWaitMs': {f"p{p}": (round(_percentile(waits, p) * 1000, 2) if waits else None) for p in (50, 95, 99)},
+        }
@@ -0,0 +1,136 @@
+from datetime import datetime
+import hashlib
+import json
+import os
+import threading
+import time
+
+# --- On-disk cache of AEMET OpenData responses ---
+# AemetClient looks a response up here before running the two HTTP hops. Entries
+# are keyed by base URL + endpoint + parameters and each endpoint family has its
+# own time-to-live: the station inventory changes about once a month, while the
+# conventional observations are published hourly. For observation data the
+# newest 'fint' timestamp in the response tells when AEMET can have something
+# newer, so those entries stay fresh until the next expected publication.
+#
+# Set AEMET_CACHE_DIR to an empty string to disable the cache.
+
+AEMET_CACHE_DIR = os.environ.get("AEMET_CACHE_DIR", ".aemet_cache")
+DEFAULT_TTL_SECONDS = 10 * 60
+# Endpoint path prefix -> TTL in seconds (the longest matching prefix wins)
+ENDPOINT_TTLS = {
+    "valores/climatologicos/inventarioestaciones": 30 * 24 * 3600,
+    "valores/climatologicos": 24 * 3600,
+    "observacion/convencional": 3600,
+}
+# Observations: one per hour, available some minutes after the hour they describe
+OBSERVATION_INTERVAL_SECONDS = 3600
+OBSERVATION_PUBLICATION_DELAY_SECONDS = 20 * 60
+MIN_REFRESH_SECONDS = 5 * 60 # Never re-ask sooner than this, even when AEMET is late publishing
+FINT_FORMAT = "%Y-%m-%dT%H:%M:%S%z"
+
+def parse_fint(value):
+    """Parses an AEMET observation timestamp ('2025-05-13T00:00:00+0000') into an aware datetime, or None."""
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value, FINT_FORMAT)
+    except (TypeError, ValueError):
+        return None
+
+def latest_fint(data):
+    """Newest 'fint' of an observation response (list of observations) as a UNIX timestamp, or None."""
+    if not isinstance(data, list):
+        return None
+    newest = None
+    for item in data:
+        fint = parse_fint(item.get('fint')) if isinstance(item, dict) else None
+        if fint is not None and (newest is None or fint > newest):
+            newest = fint
+    return newest.timestamp() if newest is not None else None
+
+def ttl_for(endpoint):
+    matches = [prefix for prefix in ENDPOINT_TTLS if endpoint.startswith(prefix)]
+    return ENDPOINT_TTLS[max(matches, key=len)] if matches else DEFAULT_TTL_SECONDS
+
+
+class AemetResponseCache:
+    """
+    One JSON file per cached response, written to a temporary file and renamed
+    so concurrent readers (or a crash mid-write) never see a partial entry.
+    """
+
+    def __init__(self, cache_dir=AEMET_CACHE_DIR):
+        self.cache_dir = cache_dir
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+
+    def key_for(self, base_url, endpoint_path, params=None):
+        material = json.dumps([base_url, endpoint_path, params or {}], sort_keys=True)
+        return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+    def lock_for(self, key):
+        """Per-key lock, so concurrent callers asking for the same response download it once."""
+        with self._locks_lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def load(self, key):
+        """Returns the stored entry ({endpoint, fetchedAt, expiresAt, latestFint, data}) or None."""
+        try:
+            with open(self._path(key), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def get(self, key, now=None):
+        """Returns the cached data if the entry is still fresh, else None."""
+        entry = self.load(key)
+        if entry is not None and entry.get('expiresAt', 0) > (now or time.time()):
+            return entry['data']
+        return None
+
+    def get_stale(self, key):
+        """Returns the cached data regardless of age (used when AEMET cannot be reached), or None."""
+        entry = self.load(key)
+        if entry is None:
+            return None
+        return entry['data']
+
+    def expiry_for(self, endpoint, data, fetched_at):
+        newest = latest_fint(data)
+        if newest is not None:
+            next_publication = newest + OBSERVATION_INTERVAL_SECONDS + OBSERVATION_PUBLICATION_DELAY_SECONDS
+            return max(next_publication, fetched_at + MIN_REFRESH_SECONDS), newest
+        return fetched_at + ttl_for(endpoint), None
+
+    def put(self, key, endpoint, data):
+        fetched_at = time.time()
+        expires_at, newest = self.expiry_for(endpoint, data, fetched_at)
+        entry = {'endpoint': endpoint, 'fetchedAt': fetched_at, 'expiresAt': expires_at,
+                 'latestFint': newest, 'data': data}
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(entry, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Could not write AEMET cache entry for {endpoint}: {e}")
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+def get_default_response_cache():
+    """Process-wide cache in AEMET_CACHE_DIR, or None when the cache is disabled."""
+    global _default_cache
+    if not AEMET_CACHE_DIR:
+        return None
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = AemetResponseCache(AEMET_CACHE_DIR)
+        return _default_cache
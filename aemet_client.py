@@ -0,0 +1,307 @@
+import requests
+from requests.adapters import HTTPAdapter
+from aemet_cache import get_default_response_cache
+import telemetry
+import json
+import os
+import random
+import threading
+import time
+
+# --- Configuration ---
+# Base URL of the AEMET OpenData API. Can be pointed at a local stand-in
+# (see fake_aemet_server.py) through the AEMET_API_BASE_URL environment variable.
+AEMET_API_BASE_URL = os.environ.get("AEMET_API_BASE_URL", "https://opendata.aemet.es/opendata/api").rstrip('/')
+# AEMET throttles each API key; stay a little under the documented ~50 requests/minute.
+AEMET_REQUESTS_PER_MINUTE = float(os.environ.get("AEMET_REQUESTS_PER_MINUTE", "45"))
+AEMET_BURST = 5 # Requests that may be sent back-to-back before the rate limit applies
+# Maximum simultaneous requests per endpoint (metadata hop) and for the 'datos' downloads
+ENDPOINT_CONCURRENCY = 4
+DATOS_CONCURRENCY = 8
+# Retry policy: exponential backoff with full jitter
+MAX_RETRIES = 4 # Retries of the whole two-hop request
+DATOS_RETRIES = 2 # Extra attempts on the 'datos' URL before asking for a new one
+BACKOFF_BASE_SECONDS = 1.0
+BACKOFF_MAX_SECONDS = 30.0
+REQUEST_TIMEOUT = (5, 30) # (connect, read) seconds
+DEFAULT_POOL_SIZE = 16
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class RetryableAemetError(Exception):
+    """A transient AEMET failure (throttling, 5xx, broken 'datos' download) worth retrying."""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+# --- Rate limiting ---
+class TokenBucket:
+    """
+    Thread-safe token bucket. acquire() blocks until a token is available, so
+    all threads sharing the bucket together never exceed `rate` requests per
+    second (after an initial burst of `capacity`).
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self._tokens = float(capacity)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def penalize(self, seconds):
+        """Drains the bucket so nobody sends for `seconds` (used after a 429)."""
+        with self._lock:
+            self._refill()
+            self._tokens = min(self._tokens, 0.0) - seconds * self.rate
+
+
+_shared_limiters = {}
+_shared_limiters_lock = threading.Lock()
+
+def get_shared_rate_limiter(api_key):
+    """Returns the process-wide token bucket for an API key (AEMET throttles per key)."""
+    with _shared_limiters_lock:
+        if api_key not in _shared_limiters:
+            _shared_limiters[api_key] = TokenBucket(AEMET_REQUESTS_PER_MINUTE / 60.0, AEMET_BURST)
+        return _shared_limiters[api_key]
+
+
+def backoff_delay(attempt, base=BACKOFF_BASE_SECONDS, cap=BACKOFF_MAX_SECONDS):
+    """Exponential backoff with full jitter: a random delay in [0, min(cap, base * 2**attempt)]."""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+def create_http_session(pool_size=DEFAULT_POOL_SIZE):
+    """
+    Creates a requests Session whose connection pool can hold one keep-alive
+    connection per worker, so concurrent fetches reuse TCP/TLS connections.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def _retry_after_seconds(response):
+    value = response.headers.get('Retry-After') if response is not None else None
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+# --- Client ---
+class AemetClient:
+    """
+    AEMET OpenData client shared by the ingestion scripts. Every request goes
+    through the per-key token bucket and a per-endpoint concurrency cap, and
+    transient failures on either hop are retried with jittered backoff.
+    Responses are kept in the on-disk cache of aemet_cache.py (the shared one
+    unless `cache` is given; use_cache=False disables it), so fresh data is
+    served locally without any HTTP request.
+    """
+
+    def __init__(self, api_key, session=None, base_url=AEMET_API_BASE_URL, extra_headers=None,
+                 rate_limiter=None, endpoint_concurrency=ENDPOINT_CONCURRENCY,
+                 datos_concurrency=DATOS_CONCURRENCY, max_retries=MAX_RETRIES, cache=None, use_cache=True):
+        self.api_key = api_key
+        self.session = session if session is not None else create_http_session()
+        self.base_url = base_url.rstrip('/')
+        self.headers = {'accept': "application/json"}
+        if extra_headers:
+            self.headers.update(extra_headers)
+        self.rate_limiter = rate_limiter if rate_limiter is not None else get_shared_rate_limiter(api_key)
+        self.endpoint_concurrency = endpoint_concurrency
+        self.max_retries = max_retries
+        self._endpoint_slots = {}
+        self._endpoint_slots_lock = threading.Lock()
+        self._datos_slots = threading.BoundedSemaphore(datos_concurrency)
+        self.cache = (cache if cache is not None else get_default_response_cache()) if use_cache else None
+
+    def close(self):
+        self.session.close()
+
+    def _slots_for(self, endpoint_key):
+        with self._endpoint_slots_lock:
+            if endpoint_key not in self._endpoint_slots:
+                self._endpoint_slots[endpoint_key] = threading.BoundedSemaphore(self.endpoint_concurrency)
+            return self._endpoint_slots[endpoint_key]
+
+    def fetch(self, endpoint_path, description, endpoint_key=None, refresh=False, allow_stale=True):
+        """
+        Fetches the data behind an AEMET endpoint (metadata hop + 'datos' hop).
+        endpoint_key groups requests for the concurrency cap, e.g. the path
+        template without the station id. A fresh cached response is returned
+        without contacting AEMET unless refresh=True. If AEMET cannot be
+        reached (network errors or retries exhausted, not 401/404), the last
+        cached response, even if expired, is returned unless allow_stale=False.
+        Returns the decoded data or None; use fetch_result() to know whether
+        the data is stale.
+        """
+        data, stale = self.fetch_result(endpoint_path, description, endpoint_key, refresh)
+        return None if stale and not allow_stale else data
+
+    def fetch_result(self, endpoint_path, description, endpoint_key=None, refresh=False):
+        """Like fetch(), but returns (data, stale): stale is True when an expired cached response was served."""
+        if not self.api_key:
+            print("AEMET API key is missing.")
+            return None, False
+        if self.cache is None:
+            return self._fetch_uncached(endpoint_path, description, endpoint_key)[0], False
+
+        key = self.cache.key_for(self.base_url, endpoint_path)
+        with self.cache.lock_for(key):
+            if not refresh:
+                cached = self.cache.get(key)
+                if cached is not None:
+                    telemetry.inc("cache_requests_total", cache="aemet", result="hit")
+                    print(f"Using cached AEMET data for {description}.")
+                    return cached, False
+                telemetry.inc("cache_requests_total", cache="aemet", result="miss")
+            data, transient = self._fetch_uncached(endpoint_path, description, endpoint_key)
+            if data is not None:
+                self.cache.put(key, endpoint_path, data)
+                return data, False
+            if not transient: # Bad key, unknown endpoint...: an old copy would hide the error
+                return None, False
+            stale = self.cache.get_stale(key)
+            if stale is None:
+                return None, False
+            telemetry.inc("cache_requests_total", cache="aemet", result="stale")
+            print(f"WARNING: AEMET unreachable; the last cached (expired) data for {description} is stale.")
+            return stale, True
+
+    def _fetch_uncached(self, endpoint_path, description, endpoint_key=None):
+        """Returns (data or None, True if the failure was transient: network errors or retries exhausted)."""
+        slots = self._slots_for(endpoint_key or endpoint_path)
+        for attempt in range(self.max_retries + 1):
+            try:
+                with slots:
+                    data_url = self._fetch_data_url(endpoint_path, description)
+                if data_url is None:
+                    return None, False
+                return self._fetch_datos(data_url, description), False
+            except RetryableAemetError as e:
+                if attempt == self.max_retries:
+                    print(f"Giving up on {description} after {attempt + 1} attempts: {e}")
+                    return None, True
+                telemetry.inc("retries_total", hop="request")
+                delay = backoff_delay(attempt)
+                if e.retry_after is not None:
+                    delay = max(delay, e.retry_after)
+                print(f"Transient AEMET error for {description} ({e}). Retrying in {delay:.1f}s...")
+                time.sleep(delay)
+            except requests.exceptions.RequestException as e:
+                print(f"Network error during AEMET API call for {description}: {e}")
+                return None, True
+            except Exception as e:
+                print(f"An unexpected error occurred during AEMET API call for {description}: {e}")
+                return None, False
+        return None, True
+
+    def _fetch_data_url(self, endpoint_path, description):
+        """First hop: returns the 'datos' URL, None on a permanent error, or raises RetryableAemetError."""
+        url = f"{self.base_url}/{endpoint_path}"
+        self.rate_limiter.acquire()
+        print(f"Fetching data URL from AEMET for {description}...")
+        try:
+            with telemetry.timed("aemet_metadata"):
+                response = self.session.get(url, headers=self.headers, params={'api_key': self.api_key},
+                                            timeout=REQUEST_TIMEOUT)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            raise RetryableAemetError(f"connection error on metadata request: {e}")
+
+        if response.status_code in RETRYABLE_STATUS_CODES:
+            retry_after = _retry_after_seconds(response)
+            if response.status_code == 429:
+                self.rate_limiter.penalize(retry_after or BACKOFF_BASE_SECONDS)
+            raise RetryableAemetError(f"HTTP {response.status_code} on metadata request", retry_after)
+        try:
+            response.raise_for_status()
+            metadata = response.json()
+        except requests.exceptions.RequestException as e:
+            print(f"RequestException during AEMET API call: {e}")
+            print(f"Response content: {response.text}")
+            return None
+        except ValueError as e:
+            raise RetryableAemetError(f"invalid JSON in metadata response: {e}")
+
+        estado = metadata.get("estado")
+        if estado == 200:
+            data_url = metadata.get("datos")
+            print(f"Successfully obtained data URL: {data_url}")
+            return data_url
+        elif estado == 401:
+            print(f"Error: Unauthorized. Check your AEMET API key. Description: {metadata.get('descripcion')}")
+        elif estado == 404:
+            print(f"Error: Not Found. Possibly invalid {description} or endpoint. Description: {metadata.get('descripcion')}")
+        elif estado == 429:
+            self.rate_limiter.penalize(BACKOFF_BASE_SECONDS)
+            raise RetryableAemetError(f"Too Many Requests: {metadata.get('descripcion')}")
+        elif estado in RETRYABLE_STATUS_CODES:
+            raise RetryableAemetError(f"estado {estado}: {metadata.get('descripcion')}")
+        else:
+            print(f"Error fetching data from AEMET. Status: {estado}, Description: {metadata.get('descripcion')}")
+        return None
+
+    def _fetch_datos(self, data_url, description):
+        """Second hop: downloads and decodes the 'datos' URL, retrying transient failures."""
+        last_error = None
+        for attempt in range(DATOS_RETRIES + 1):
+            if attempt > 0:
+                telemetry.inc("retries_total", hop="datos")
+                time.sleep(backoff_delay(attempt - 1))
+            try:
+                with self._datos_slots:
+                    print(f"Fetching actual data from AEMET for {description}...")
+                    with telemetry.timed("aemet_datos"):
+                        response = self.session.get(data_url, headers=self.headers, timeout=REQUEST_TIMEOUT)
+                        content = response.content # Downloaded here, so the timing covers the whole body
+                response.raise_for_status()
+            except requests.exceptions.RequestException as e:
+                last_error = f"'datos' download failed: {e}"
+                continue
+
+            try:
+                with telemetry.timed("aemet_decode", encoding="utf-8"):
+                    data = response.json()
+            except ValueError:
+                try:
+                    print("JSONDecodeError with UTF-8, trying with latin-1 encoding...")
+                    with telemetry.timed("aemet_decode", encoding="latin-1"):
+                        data = json.loads(content.decode('latin-1', errors='ignore'))
+                except ValueError as e:
+                    last_error = f"invalid JSON in 'datos' response: {e}"
+                    continue
+
+            # The 'datos' URL answers with an {"estado": ...} object when the file is not ready
+            if isinstance(data, dict) and "estado" in data and data.get("estado") != 200:
+                last_error = f"'datos' returned estado {data.get('estado')}: {data.get('descripcion')}"
+                continue
+
+            print(f"Successfully fetched actual data for {description}.")
+            if isinstance(data, list):
+                telemetry.inc("rows_total", len(data), source="aemet")
+            return data
+
+        raise RetryableAemetError(last_error)
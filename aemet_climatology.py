@@ -0,0 +1,71 @@
+import numpy as np
+import warnings
+from aemet_csv_parser import MONTH_NAMES_STANDARD
+
+# Multi-year summaries of the aemetHistoricalData documents, one per
+# (region, parameter). Written by upload_all_aemet_data.py so the dashboard can
+# read the climatology of a region in a single document.
+
+PERCENTILES = [10, 25, 50, 75, 90]
+
+def _to_firestore_values(array_1d):
+    """Maps a 12-month array to {month name: float or None}."""
+    return {month: (None if np.isnan(value) else round(float(value), 3))
+            for month, value in zip(MONTH_NAMES_STANDARD, array_1d)}
+
+def compute_climatologies(documents):
+    """
+    Computes the climatology of every (region, parameter code) at once.
+
+    `documents` are the {"region", "year", "payload"} entries produced by
+    aemet_csv_parser. Values are laid out in a single (groups, years, 12) array,
+    so the statistics for all groups come from one set of NumPy reductions.
+    Returns {(region, parameter code): climatology payload}.
+    """
+    if not documents:
+        return {}
+
+    group_keys = sorted({(d["region"], d["payload"]["parameterCodeUsed"]) for d in documents})
+    years = sorted({int(d["year"]) for d in documents})
+    group_index = {key: i for i, key in enumerate(group_keys)}
+    year_index = {year: i for i, year in enumerate(years)}
+
+    values = np.full((len(group_keys), len(years), 12), np.nan)
+    group_info = {}
+    for d in documents:
+        key = (d["region"], d["payload"]["parameterCodeUsed"])
+        monthly = d["payload"]["monthlyValues"]
+        values[group_index[key], year_index[int(d["year"])]] = [
+            np.nan if monthly.get(month) is None else monthly[month] for month in MONTH_NAMES_STANDARD
+        ]
+        group_info.setdefault(key, d["payload"])
+
+    with warnings.catch_warnings():
+        # Months without data in any year legitimately produce all-NaN slices
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        mean = np.nanmean(values, axis=1)
+        minimum = np.nanmin(values, axis=1)
+        maximum = np.nanmax(values, axis=1)
+        percentiles = np.nanpercentile(values, PERCENTILES, axis=1) # (len(PERCENTILES), groups, 12)
+    anomalies = values - mean[:, np.newaxis, :]
+    has_year = ~np.isnan(values).all(axis=2) # (groups, years)
+
+    climatologies = {}
+    for key, g in group_index.items():
+        info = group_info[key]
+        group_years = [year for year, y in year_index.items() if has_year[g, y]]
+        climatologies[key] = {
+            "region": key[0],
+            "regionOriginal": info["regionOriginal"],
+            "parameterCodeUsed": key[1],
+            "baseParameter": info["baseParameter"],
+            "regionType": info["regionType"],
+            "years": group_years,
+            "yearCount": len(group_years),
+            "monthlyMean": _to_firestore_values(mean[g]),
+            "monthlyMin": _to_firestore_values(minimum[g]),
+            "monthlyMax": _to_firestore_values(maximum[g]),
+            "monthlyPercentiles": {f"p{p}": _to_firestore_values(percentiles[i, g]) for i, p in enumerate(PERCENTILES)},
+            "anomalies": {str(year): _to_firestore_values(anomalies[g, year_index[year]]) for year in group_years},
+        }
+    return climatologies
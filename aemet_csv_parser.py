@@ -0,0 +1,169 @@
+import pandas as pd
+import os
+
+# Parsing stage of upload_all_aemet_data.py. This module has no Firebase
+# dependency so it can run inside worker processes.
+
+MONTH_NAMES_STANDARD = ["enero", "febrero", "marzo", "abril", "mayo", "junio", "julio", "agosto", "septiembre", "octubre", "noviembre", "diciembre"]
+REGIONAL_TYPES = ["Provincia", "GrandesCuencas", "ComunidadesAutonomas"]
+
+def get_region_type_from_suffix(filename_suffix):
+    """Determines the region type from the filename suffix."""
+    if "_Provincias" in filename_suffix: return "Provincia"
+    elif "_GrandesCuencas" in filename_suffix: return "GrandesCuencas"
+    elif "_ComunidadesAutonomas" in filename_suffix: return "ComunidadesAutonomas"
+    elif "_Nacional" in filename_suffix: return "Nacional"
+    else: return "Unknown" # Default if suffix doesn't match
+
+def get_parameter_code_from_prefix(prefix):
+    """Maps file prefix to a standardized parameter code (without suffix)."""
+    prefix_upper = prefix.upper()
+    if prefix_upper == "AD25": return "AD25mm"
+    elif prefix_upper == "AD75": return "AD75mm"
+    elif prefix_upper == "PADMAX": return "ADRmax"
+    elif prefix_upper == "ETO": return "ETo"
+    elif prefix_upper == "PREC": return "Precipitacion"
+    else:
+        print(f"Warning: Unrecognized parameter prefix '{prefix}'. Using as is.")
+        return prefix
+
+def describe_aemet_csv(csv_filepath, year):
+    """
+    Derives (basename, base parameter code, region type) from a file name like
+    PREC_2019_Provincias.csv. Returns None if the file does not match the year
+    or uses an unknown prefix/suffix.
+    """
+    basename = os.path.basename(csv_filepath)
+    parts = basename.split('_')
+    if len(parts) < 3 or not parts[1] == str(year):
+        return None
+
+    parameter_prefix = parts[0]
+    filename_suffix = "_" + "_".join(parts[2:])
+    region_type = get_region_type_from_suffix(filename_suffix)
+    base_parameter_code = get_parameter_code_from_prefix(parameter_prefix)
+    if region_type == "Unknown" or not base_parameter_code:
+        print(f"Skipping file {basename} due to unrecognized suffix or prefix.")
+        return None
+    return basename, base_parameter_code, region_type
+
+def read_aemet_csv(csv_filepath):
+    """Reads an AEMET semicolon CSV as strings (UTF-8, falling back to latin-1)."""
+    try: return pd.read_csv(csv_filepath, sep=';', encoding='utf-8', dtype=str)
+    except UnicodeDecodeError: return pd.read_csv(csv_filepath, sep=';', encoding='latin-1', dtype=str)
+
+def to_numeric_columns(df, columns):
+    """
+    Column-wise conversion of month cells to float. Accepts both decimal
+    separators ('171.2' and '171,2'); empty or invalid cells become NaN.
+    """
+    return df[columns].apply(
+        lambda col: pd.to_numeric(col.str.strip().str.replace(',', '.', regex=False), errors='coerce')
+    )
+
+def parse_aemet_frame(csv_filepath, year):
+    """
+    Parses one AEMET CSV into a clean table, without touching Firestore.
+
+    Returns None for files that are not part of the dataset, otherwise
+    (info, frame): info = {basename, baseParameter, parameterCode, regionType}
+    and frame has one row per named region with the columns region (sanitized),
+    regionOriginal, parameterDescription and one float column per month
+    (NaN for empty or invalid cells).
+    """
+    description = describe_aemet_csv(csv_filepath, year)
+    if description is None:
+        return None
+    basename, base_parameter_code, region_type = description
+
+    # Construct the parameter code to use for subcollection names (e.g., AD25mm_Provincia)
+    info = {"basename": basename, "baseParameter": base_parameter_code,
+            "parameterCode": f"{base_parameter_code}_{region_type}", "regionType": region_type}
+    empty_frame = pd.DataFrame(columns=["region", "regionOriginal", "parameterDescription"])
+
+    df = read_aemet_csv(csv_filepath)
+    if df.empty or len(df.columns) < 2: # Need at least param desc and region
+        print(f"Warning: File {basename} is empty or has too few columns. Skipping.")
+        return info, empty_frame
+
+    parameter_desc_col = df.columns[0]
+    region_col = df.columns[1] # 'región'
+    if region_col.strip().lower() != 'región':
+        print(f"Warning: Second column in {basename} is not named 'región'. Assuming it's the region column: '{region_col}'.")
+
+    region_original = df[region_col].fillna('').str.strip()
+    region_sanitized = region_original.str.replace('/', '_', regex=False).str.replace('.', '', regex=False)
+    named_rows = region_original.ne('') & region_sanitized.ne('')
+
+    # --- Vectorized month values ---
+    month_cols = [m for m in df.columns[2:] if m.strip().lower() in MONTH_NAMES_STANDARD]
+    values = to_numeric_columns(df, month_cols)
+    values.columns = [m.strip().lower() for m in month_cols]
+
+    frame = pd.concat([
+        pd.DataFrame({
+            "region": region_sanitized,
+            "regionOriginal": region_original,
+            "parameterDescription": df[parameter_desc_col].fillna('').str.strip(),
+        }),
+        values,
+    ], axis=1)[named_rows].reset_index(drop=True)
+    return info, frame
+
+def build_documents(info, frame, year):
+    """
+    Builds the aemetHistoricalData payloads for a parsed file: one document per
+    region row with at least one valid month. Non-regional files (Nacional)
+    produce no documents.
+    """
+    month_cols = [m for m in frame.columns if m in MONTH_NAMES_STANDARD]
+    if info["regionType"] not in REGIONAL_TYPES or not month_cols or frame.empty:
+        return []
+
+    values = frame[month_cols]
+    upload_rows = values.notna().any(axis=1)
+    if not upload_rows.any():
+        return []
+    rows = frame[upload_rows]
+    monthly_values_records = values[upload_rows].astype(object).where(values[upload_rows].notna(), None).to_dict('records')
+
+    documents = []
+    for region_name, original_name, param_desc, monthly_values_data in zip(
+            rows["region"].tolist(), rows["regionOriginal"].tolist(),
+            rows["parameterDescription"].tolist(), monthly_values_records):
+        documents.append({
+            "region": region_name,
+            "year": int(year),
+            "payload": {
+                "parameterDescriptionCSV": param_desc,
+                "monthlyValues": monthly_values_data,
+                "regionOriginal": original_name,
+                "year": int(year),
+                "parameterCodeUsed": info["parameterCode"],
+                "baseParameter": info["baseParameter"], # Store base param
+                "regionType": info["regionType"], # Store type
+                "sourceFile": info["basename"]
+            }
+        })
+    return documents
+
+def parse_aemet_csv(csv_filepath, year):
+    """
+    Parses one AEMET CSV into the documents to upload, without touching Firestore.
+
+    Returns None for files that are not part of the dataset, otherwise a dict with:
+      basename, parameterCode (e.g. AD25mm_Provincia), regionType,
+      regions: {sanitized region name: region type} for every named row,
+      documents: [{"region": sanitized name, "year": year, "payload": {...}}].
+    """
+    parsed = parse_aemet_frame(csv_filepath, year)
+    if parsed is None:
+        return None
+    info, frame = parsed
+    if info["regionType"] not in REGIONAL_TYPES:
+        print(f"Skipping file {info['basename']} data upload (type: {info['regionType']}), but will record region name if applicable.")
+
+    # All named rows (including non-regional files) feed the metadata document
+    return {"basename": info["basename"], "parameterCode": info["parameterCode"], "regionType": info["regionType"],
+            "regions": dict.fromkeys(frame["region"], info["regionType"]),
+            "documents": build_documents(info, frame, year)}
@@ -0,0 +1,157 @@
+from collections import OrderedDict
+
+# --- Typed AEMET conventional observation ---
+# One Observation per hourly row of the observacion/convencional endpoints (see
+# real_time_data_example.txt). The schema below lists every documented field;
+# fields AEMET adds later are kept in `extra` instead of being dropped.
+#
+# Firestore layout written by fetch_aemet_realtime.py (one document per day,
+# one map per variable keyed by hour, so each hourly run merges new hours into
+# the day without reading it first):
+#
+#   aemetRealtimeObservations/{idema}                    station, latest observation and the last rows received
+#   aemetRealtimeObservations/{idema}/days/{YYYYMMDD}    {"columns": {"ta": {"00": 8.3, "01": 8.8, ...}, ...}}
+
+# (field, type, description)
+OBSERVATION_SCHEMA = [
+    ("idema", str, "Indicativo climatológico de la estación"),
+    ("ubi", str, "Nombre de la ubicación de la estación"),
+    ("lon", float, "Longitud (grados)"),
+    ("lat", float, "Latitud (grados)"),
+    ("alt", float, "Altitud (m)"),
+    ("fint", str, "Fin del periodo de observación (UTC)"),
+    ("prec", float, "Precipitación acumulada en la hora (mm)"),
+    ("pacutp", float, "Precipitación acumulada del pluviómetro de pesada (mm)"),
+    ("pliqtp", float, "Precipitación líquida del pluviómetro de pesada (mm)"),
+    ("psolt", float, "Precipitación sólida (mm)"),
+    ("vmax", float, "Racha máxima del viento (m/s)"),
+    ("vv", float, "Velocidad media del viento (m/s)"),
+    ("vmaxu", float, "Racha máxima del viento, sensor ultrasónico (m/s)"),
+    ("vvu", float, "Velocidad media del viento, sensor ultrasónico (m/s)"),
+    ("dv", float, "Dirección media del viento (grados)"),
+    ("dvu", float, "Dirección media del viento, sensor ultrasónico (grados)"),
+    ("dmax", float, "Dirección de la racha máxima (grados)"),
+    ("dmaxu", float, "Dirección de la racha máxima, sensor ultrasónico (grados)"),
+    ("stdvv", float, "Desviación estándar de la velocidad del viento (m/s)"),
+    ("stddv", float, "Desviación estándar de la dirección del viento (grados)"),
+    ("stdvvu", float, "Desviación estándar de la velocidad del viento, sensor ultrasónico (m/s)"),
+    ("stddvu", float, "Desviación estándar de la dirección del viento, sensor ultrasónico (grados)"),
+    ("hr", float, "Humedad relativa (%)"),
+    ("inso", float, "Insolación en la hora (h)"),
+    ("pres", float, "Presión a nivel de la estación (hPa)"),
+    ("pres_nmar", float, "Presión reducida al nivel del mar (hPa)"),
+    ("ts", float, "Temperatura del suelo (°C)"),
+    ("tss20cm", float, "Temperatura del subsuelo a 20 cm (°C)"),
+    ("tss5cm", float, "Temperatura del subsuelo a 5 cm (°C)"),
+    ("ta", float, "Temperatura del aire (°C)"),
+    ("tpr", float, "Temperatura del punto de rocío (°C)"),
+    ("tamin", float, "Temperatura mínima en la hora (°C)"),
+    ("tamax", float, "Temperatura máxima en la hora (°C)"),
+    ("vis", float, "Visibilidad (km)"),
+    ("geo700", float, "Altura geopotencial del nivel de 700 hPa (m)"),
+    ("geo850", float, "Altura geopotencial del nivel de 850 hPa (m)"),
+    ("geo925", float, "Altura geopotencial del nivel de 925 hPa (m)"),
+    ("rviento", float, "Recorrido del viento en la hora (Hm)"),
+    ("nieve", float, "Espesor de la nieve (cm)"),
+]
+FIELD_TYPES = OrderedDict((name, field_type) for name, field_type, _ in OBSERVATION_SCHEMA)
+STATION_FIELDS = ("idema", "ubi", "lon", "lat", "alt") # Same for every hour of a station
+MEASUREMENT_FIELDS = tuple(name for name in FIELD_TYPES if name not in STATION_FIELDS and name != "fint")
+
+def _coerce(value, field_type):
+    if value is None or value == "":
+        return None
+    if field_type is float:
+        try:
+            return float(str(value).replace(',', '.'))
+        except ValueError:
+            return None
+    return str(value)
+
+
+class Observation:
+    """One hourly observation of a station; absent fields are None."""
+
+    __slots__ = tuple(FIELD_TYPES) + ("extra",)
+
+    def __init__(self, **values):
+        for name in FIELD_TYPES:
+            setattr(self, name, values.get(name))
+        self.extra = values.get("extra") or {}
+
+    @classmethod
+    def from_dict(cls, raw):
+        """Builds an Observation from one row of the AEMET payload, converting every field to its schema type."""
+        values = {name: _coerce(raw.get(name), field_type) for name, field_type in FIELD_TYPES.items()}
+        values["extra"] = {k: v for k, v in raw.items() if k not in FIELD_TYPES}
+        return cls(**values)
+
+    @property
+    def date_key(self):
+        """'2025-05-13T07:00:00+0000' -> '20250513' (UTC day of the observation)."""
+        return self.fint[:10].replace('-', '') if self.fint else None
+
+    @property
+    def hour_key(self):
+        """'2025-05-13T07:00:00+0000' -> '07'."""
+        return self.fint[11:13] if self.fint else None
+
+    def measurements(self):
+        """{field: value} of the measured variables present in this observation (extra fields included)."""
+        values = {name: getattr(self, name) for name in MEASUREMENT_FIELDS if getattr(self, name) is not None}
+        values.update({k: v for k, v in self.extra.items() if isinstance(v, (int, float)) and not isinstance(v, bool)})
+        return values
+
+    def to_dict(self):
+        values = {name: getattr(self, name) for name in FIELD_TYPES if getattr(self, name) is not None}
+        values.update(self.extra)
+        return values
+
+    def __repr__(self):
+        return f"Observation(idema={self.idema!r}, fint={self.fint!r})"
+
+
+def parse_observations(station_data_list):
+    """Typed observations with a 'fint', oldest first."""
+    observations = [Observation.from_dict(raw) for raw in station_data_list or [] if isinstance(raw, dict)]
+    return sorted((obs for obs in observations if obs.fint), key=lambda obs: obs.fint)
+
+def station_info(observation):
+    return {name: getattr(observation, name) for name in STATION_FIELDS if getattr(observation, name) is not None}
+
+def to_columns(observations):
+    """Columnar form of consecutive observations: {'fint': [...], field: [value or None, ...]} for every field seen."""
+    fields = []
+    for obs in observations:
+        for name in obs.measurements():
+            if name not in fields:
+                fields.append(name)
+    columns = {'fint': [obs.fint for obs in observations]}
+    for name in fields:
+        columns[name] = [obs.measurements().get(name) for obs in observations]
+    return columns
+
+def build_day_documents(station_idema, observations):
+    """
+    Groups observations by UTC day: {YYYYMMDD: day document}. Each variable is a
+    map hour -> value, so writing the document with merge=True adds the new hours
+    to what is already stored for that day.
+    """
+    days = {}
+    for obs in observations:
+        day = days.setdefault(obs.date_key, {'idema': station_idema, 'date': obs.date_key, 'columns': {}})
+        for name, value in obs.measurements().items():
+            day['columns'].setdefault(name, {})[obs.hour_key] = value
+        day['latestFint'] = max(day.get('latestFint') or obs.fint, obs.fint)
+    return days
+
+def build_station_document(station_idema, observations):
+    """Station summary: location, the latest observation in full and the rows received in columnar form."""
+    latest = observations[-1]
+    return {
+        'idema': station_idema,
+        'station': station_info(latest),
+        'latestFint': latest.fint,
+        'latest': latest.to_dict(),
+        'recent': to_columns(observations),
+    }
@@ -0,0 +1,168 @@
+import pyarrow as pa
+import pandas as pd
+from aemet_csv_parser import parse_aemet_frame, build_documents, describe_aemet_csv, MONTH_NAMES_STANDARD
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import glob
+import os
+
+# --- Configuration ---
+# Single columnar file holding every value of the EBH annual statistics under aemetDATA/.
+# Arrow IPC (uncompressed) is used instead of Parquet so the file can be memory-mapped
+# and read without copying or decoding.
+DEFAULT_DATA_ROOT = "./aemetDATA/"
+DEFAULT_STORE_PATH = "aemet_historical.arrow"
+
+# One row per (region, region type, parameter, year, month)
+# (string columns are dictionary-encoded: a handful of distinct values repeated many times)
+DICTIONARY_STRING = pa.dictionary(pa.int32(), pa.string())
+STORE_SCHEMA = pa.schema([
+    ("region", DICTIONARY_STRING),
+    ("regionOriginal", DICTIONARY_STRING),
+    ("regionType", DICTIONARY_STRING),
+    ("baseParameter", DICTIONARY_STRING),
+    ("parameterCode", DICTIONARY_STRING),
+    ("parameterDescription", DICTIONARY_STRING),
+    ("year", pa.int16()),
+    ("month", pa.int8()), # 1 = enero ... 12 = diciembre
+    ("value", pa.float64()), # null for empty or invalid cells
+    ("sourceFile", DICTIONARY_STRING),
+])
+SORT_KEYS = ["regionType", "region", "baseParameter", "year", "month"]
+MONTH_NUMBERS = {name: number for number, name in enumerate(MONTH_NAMES_STANDARD, start=1)}
+
+def list_csv_files(data_root_directory):
+    """Lists (csv path, year) for every CSV inside the ebh_estadistica_anual_YYYY folders."""
+    csv_files = []
+    for year_folder_name in sorted(os.listdir(data_root_directory)):
+        year_folder_path = os.path.join(data_root_directory, year_folder_name)
+        if os.path.isdir(year_folder_path) and year_folder_name.startswith("ebh_estadistica_anual_"):
+            try:
+                year = int(year_folder_name.split('_')[-1])
+            except ValueError:
+                print(f"Skipping folder {year_folder_name}: no year in its name.")
+                continue
+            for csv_file in sorted(glob.glob(os.path.join(year_folder_path, "*.csv"))):
+                if describe_aemet_csv(csv_file, year) is not None:
+                    csv_files.append((csv_file, year))
+    return csv_files
+
+def csv_to_long_frame(csv_filepath, year):
+    """Parses one CSV and melts it into the long (one row per month) store layout."""
+    parsed = parse_aemet_frame(csv_filepath, year)
+    if parsed is None:
+        return None
+    info, frame = parsed
+    month_cols = [m for m in frame.columns if m in MONTH_NUMBERS]
+    if frame.empty or not month_cols:
+        return None
+
+    long_frame = frame.melt(id_vars=["region", "regionOriginal", "parameterDescription"],
+                            value_vars=month_cols, var_name="monthName", value_name="value")
+    long_frame["month"] = long_frame.pop("monthName").map(MONTH_NUMBERS)
+    long_frame["regionType"] = info["regionType"]
+    long_frame["baseParameter"] = info["baseParameter"]
+    long_frame["parameterCode"] = info["parameterCode"]
+    long_frame["sourceFile"] = info["basename"]
+    long_frame["year"] = int(year)
+    return long_frame
+
+def compile_store(data_root_directory=DEFAULT_DATA_ROOT, store_path=DEFAULT_STORE_PATH, workers=None):
+    """
+    Consolidates every CSV under data_root_directory into one typed Arrow file,
+    sorted by (region type, region, parameter, year, month). CSVs are parsed in
+    a process pool. The file is written to a temporary path and then renamed,
+    so readers never see a partial store. Returns the number of rows written.
+    """
+    csv_files = list_csv_files(data_root_directory)
+    if not csv_files:
+        print(f"No AEMET CSV files found under '{data_root_directory}'.")
+        return 0
+
+    print(f"Compiling {len(csv_files)} CSV files into '{store_path}'...")
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        frames = [f for f in pool.map(csv_to_long_frame, *zip(*csv_files)) if f is not None]
+    if not frames:
+        print("The CSV files contained no data rows. Store not written.")
+        return 0
+
+    combined = pd.concat(frames, ignore_index=True).sort_values(SORT_KEYS, kind="stable")
+    arrays = []
+    for field in STORE_SCHEMA:
+        column = combined[field.name]
+        if pa.types.is_dictionary(field.type):
+            arrays.append(pa.array(column.astype(str), from_pandas=True).dictionary_encode())
+        else:
+            arrays.append(pa.array(column, type=field.type, from_pandas=True)) # NaN -> null
+    table = pa.Table.from_arrays(arrays, schema=STORE_SCHEMA)
+
+    tmp_path = store_path + ".tmp"
+    with pa.OSFile(tmp_path, 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(tmp_path, store_path)
+    print(f"Wrote {table.num_rows} rows ({combined['region'].nunique()} regions, "
+          f"{combined['year'].nunique()} years) to '{store_path}'.")
+    return table.num_rows
+
+def load_store(store_path=DEFAULT_STORE_PATH):
+    """
+    Memory-maps the compiled store and returns it as a pyarrow Table. Column
+    buffers point straight into the mapped file, so loading is near-instant and
+    pages are only read from disk when they are touched.
+    """
+    source = pa.memory_map(store_path, 'r')
+    return pa.ipc.open_file(source).read_all()
+
+def load_store_frame(store_path=DEFAULT_STORE_PATH):
+    """Convenience loader returning the store as a pandas DataFrame (categoricals for strings)."""
+    return load_store(store_path).to_pandas()
+
+def iter_parsed_files(table):
+    """
+    Projects the store back into the per-file structure produced by
+    aemet_csv_parser.parse_aemet_csv (basename, parameterCode, regionType,
+    regions, documents), so the Firestore upload can run from the store
+    instead of re-parsing the CSVs.
+    """
+    df = table.to_pandas()
+    for column in ["region", "regionOriginal", "parameterDescription", "regionType",
+                   "baseParameter", "parameterCode", "sourceFile"]:
+        df[column] = df[column].astype(str)
+
+    for (source_file, year), file_rows in df.groupby(["sourceFile", "year"], sort=True):
+        first = file_rows.iloc[0]
+        info = {"basename": source_file, "baseParameter": first["baseParameter"],
+                "parameterCode": first["parameterCode"], "regionType": first["regionType"]}
+        wide = (file_rows.groupby(["region", "regionOriginal", "parameterDescription", "month"], sort=False)["value"]
+                .first().unstack("month"))
+        wide.columns = [MONTH_NAMES_STANDARD[int(m) - 1] for m in wide.columns]
+        wide = wide.reset_index()
+        yield {"basename": source_file, "parameterCode": info["parameterCode"], "regionType": info["regionType"],
+               "regions": dict.fromkeys(wide["region"], info["regionType"]),
+               "documents": build_documents(info, wide, int(year))}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Builds or inspects the columnar store of the AEMET historical statistics.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    compile_parser = subparsers.add_parser("compile", help="Consolidate the aemetDATA/ CSVs into the Arrow store.")
+    compile_parser.add_argument("--data-root", default=DEFAULT_DATA_ROOT)
+    compile_parser.add_argument("--store", default=DEFAULT_STORE_PATH)
+    compile_parser.add_argument("--workers", type=int, default=None, help="Parser processes (default: one per CPU core).")
+    info_parser = subparsers.add_parser("info", help="Print a summary of an existing store.")
+    info_parser.add_argument("--store", default=DEFAULT_STORE_PATH)
+    args = parser.parse_args()
+
+    if args.command == "compile":
+        compile_store(args.data_root, args.store, workers=args.workers)
+    else:
+        if not os.path.exists(args.store):
+            print(f"ERROR: Store '{args.store}' not found. Run 'python aemet_store.py compile' first.")
+            exit()
+        store_table = load_store(args.store)
+        store_df = store_table.to_pandas()
+        print(f"Store '{args.store}': {store_table.num_rows} rows, {store_table.nbytes / 1e6:.2f} MB")
+        print(f"  Years: {sorted(store_df['year'].unique().tolist())}")
+        print(f"  Parameters: {sorted(store_df['parameterCode'].astype(str).unique().tolist())}")
+        print(f"  Regions: {store_df['region'].nunique()}")
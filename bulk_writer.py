@@ -0,0 +1,371 @@
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from datetime import datetime, timezone
+import argparse
+import json
+import os
+import random
+import threading
+import time
+from document_store import LocalDocumentStore, transform_kind, uses_local_backend, get_local_document_store
+import telemetry
+
+# --- Shared Firestore bulk writer ---
+# Used by every bulk upload (historical CSVs, climatologies, station map,
+# real-time observations):
+#
+#   with BulkWriter(db) as writer:
+#       future = writer.set(doc_ref, data, merge=...)   # resolves to True once committed
+#   writer.written, writer.dead_lettered                # exact counts once the block exits
+#
+# Writes are grouped into batches of up to FIRESTORE_BATCH_SIZE operations and up
+# to max_in_flight batches are committed at the same time. A batch is atomic, so
+# when its commit fails none of its writes happened: each one is then retried
+# individually with exponential backoff. A set() of plain values (and of
+# SERVER_TIMESTAMP, ArrayUnion, Maximum/Minimum) gives the same document however
+# many times it is applied; Increment does not: a commit that timed out after
+# the server applied it is applied again by the retry or by a replay, so exact
+# counters should not be written through here. Writes that still fail are
+# appended to a dead-letter JSONL file, which `python bulk_writer.py replay`
+# writes again later.
+#
+# Throughput follows Firestore's 500/50/5 ramp-up rule: at most 500 operations
+# per second at first, then 50% more every 5 minutes. Local stores
+# (STORAGE_BACKEND=sqlite|memory) are not throttled, nor is anything with
+# FIRESTORE_RAMP_UP=0 (e.g. against the emulator).
+
+FIRESTORE_BATCH_SIZE = 490 # Stay below Firestore's 500 operations per batch limit
+DEFAULT_MAX_IN_FLIGHT = 4
+MAX_WRITE_RETRIES = 5 # Individual attempts per write after its batch failed
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_MAX_SECONDS = 30.0
+RAMP_UP_START_OPS = 500 # Operations per second at the start
+RAMP_UP_FACTOR = 1.5 # ... increased by 50% ...
+RAMP_UP_PERIOD_SECONDS = 5 * 60 # ... every 5 minutes
+RAMP_UP_ENABLED = os.environ.get("FIRESTORE_RAMP_UP", "1") != "0"
+DEFAULT_DEAD_LETTER_PATH = "firestore_dead_letter.jsonl"
+# Errors that no retry can fix (google.api_core exception class names)
+PERMANENT_ERRORS = {"InvalidArgument", "PermissionDenied", "Unauthenticated", "FailedPrecondition", "NotFound"}
+
+
+def backoff_delay(attempt):
+    """Exponential backoff with full jitter for retry number `attempt` (0-based)."""
+    return random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * (2 ** attempt)))
+
+def is_retryable(error):
+    return not isinstance(error, (ValueError, TypeError)) and type(error).__name__ not in PERMANENT_ERRORS
+
+
+class RampUpLimiter:
+    """
+    Token bucket whose rate grows by `factor` every `period` seconds.
+    acquire(n) reserves n operations and sleeps until the bucket has paid
+    them back, so a full batch never has to wait for n tokens to accumulate.
+    """
+
+    def __init__(self, start_rate=RAMP_UP_START_OPS, factor=RAMP_UP_FACTOR, period=RAMP_UP_PERIOD_SECONDS):
+        self.start_rate = float(start_rate)
+        self.factor = factor
+        self.period = period
+        self._started = time.monotonic()
+        self._last = self._started
+        self._tokens = self.start_rate
+        self._lock = threading.Lock()
+
+    def rate(self, now=None):
+        elapsed = (now or time.monotonic()) - self._started
+        return self.start_rate * self.factor ** int(elapsed // self.period)
+
+    def acquire(self, ops=1):
+        with self._lock:
+            now = time.monotonic()
+            rate = self.rate(now)
+            self._tokens = min(rate, self._tokens + (now - self._last) * rate)
+            self._last = now
+            self._tokens -= ops
+            wait_seconds = -self._tokens / rate if self._tokens < 0 else 0.0
+        if wait_seconds > 0:
+            time.sleep(wait_seconds)
+
+
+# --- Dead-letter encoding (write transforms and datetimes survive the round trip) ---
+def encode_value(value):
+    kind = transform_kind(value)
+    if kind == "server_timestamp":
+        return {"__transform__": "SERVER_TIMESTAMP"}
+    if kind == "delete":
+        return {"__transform__": "DELETE_FIELD"}
+    if kind in ("ArrayUnion", "ArrayRemove"):
+        return {"__transform__": kind, "values": [encode_value(v) for v in value.values]}
+    if kind in ("Increment", "Maximum", "Minimum"):
+        return {"__transform__": kind, "value": value.value}
+    if isinstance(value, datetime):
+        return {"__datetime__": value.isoformat()}
+    if isinstance(value, dict):
+        return {k: encode_value(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [encode_value(v) for v in value]
+    if hasattr(value, 'item'): # numpy scalars from the CSV parser
+        return value.item()
+    return value
+
+def decode_value(value):
+    if isinstance(value, list):
+        return [decode_value(v) for v in value]
+    if not isinstance(value, dict):
+        return value
+    if "__datetime__" in value and len(value) == 1:
+        return datetime.fromisoformat(value["__datetime__"])
+    if "__transform__" in value:
+        from firebase_admin import firestore
+        kind = value["__transform__"]
+        if kind in ("SERVER_TIMESTAMP", "DELETE_FIELD"):
+            return getattr(firestore, kind)
+        if kind in ("ArrayUnion", "ArrayRemove"):
+            return getattr(firestore, kind)([decode_value(v) for v in value["values"]])
+        return getattr(firestore, kind)(value["value"])
+    return {k: decode_value(v) for k, v in value.items()}
+
+
+class _Write:
+    __slots__ = ("reference", "data", "merge", "future")
+
+    def __init__(self, reference, data, merge):
+        self.reference = reference
+        self.data = data
+        self.merge = merge
+        self.future = Future()
+
+
+class BulkWriter:
+    """Concurrent batched writes with per-write retry and a dead-letter file. Thread-safe."""
+
+    def __init__(self, db_client, batch_size=FIRESTORE_BATCH_SIZE, max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+                 max_retries=MAX_WRITE_RETRIES, dead_letter_path=DEFAULT_DEAD_LETTER_PATH, limiter=None):
+        self.db = db_client
+        self.batch_size = max(1, min(batch_size, FIRESTORE_BATCH_SIZE))
+        self.max_retries = max_retries
+        self.dead_letter_path = dead_letter_path
+        if limiter is None and RAMP_UP_ENABLED and not isinstance(db_client, LocalDocumentStore):
+            limiter = RampUpLimiter()
+        self.limiter = limiter
+        self._pending = []
+        self._lock = threading.Lock()
+        self._dead_letter_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_in_flight) # Backpressure: set() waits when all slots are busy
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix="bulk-writer")
+        self._batches = set()
+        self.queued = 0
+        self.written = 0
+        self.retried = 0
+        self.dead_lettered = 0
+        self.commits = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def set(self, reference, data, merge=False):
+        """Queues a write; returns a Future that resolves to True once it is committed (or raises if dead-lettered)."""
+        write = _Write(reference, data, merge)
+        with self._lock:
+            self._pending.append(write)
+            self.queued += 1
+            full = len(self._pending) >= self.batch_size
+            writes = self._take_pending() if full else None
+        if writes:
+            self._submit(writes)
+        return write.future
+
+    def _take_pending(self):
+        writes, self._pending = self._pending, []
+        return writes
+
+    def _submit(self, writes):
+        self._slots.acquire()
+        future = self._executor.submit(self._commit_batch, writes)
+        with self._lock:
+            self._batches.add(future)
+        future.add_done_callback(self._batch_done)
+
+    def _batch_done(self, future):
+        with self._lock:
+            self._batches.discard(future)
+        self._slots.release()
+
+    def flush(self):
+        """Sends the writes still buffered and waits until every batch in flight has finished."""
+        with self._lock:
+            writes = self._take_pending()
+        if writes:
+            self._submit(writes)
+        while True:
+            with self._lock:
+                batches = list(self._batches)
+            if not batches:
+                return
+            wait(batches)
+
+    def close(self):
+        self.flush()
+        self._executor.shutdown(wait=True)
+        if self.dead_lettered:
+            print(f"{self.dead_lettered} writes could not be committed and were saved to '{self.dead_letter_path}'. "
+                  f"Replay them with: python bulk_writer.py replay")
+        return self.stats()
+
+    def stats(self):
+        with self._lock:
+            return {'queued': self.queued, 'written': self.written, 'retried': self.retried,
+                    'deadLettered': self.dead_lettered, 'commits': self.commits}
+
+    def _commit(self, writes):
+        if self.limiter is not None:
+            self.limiter.acquire(len(writes))
+        batch = self.db.batch()
+        for write in writes:
+            batch.set(write.reference, write.data, merge=write.merge)
+        collection = writes[0].reference.path.split('/', 1)[0]
+        with telemetry.timed("firestore_commit", collection=collection):
+            batch.commit()
+        with self._lock:
+            self.written += len(writes)
+            self.commits += 1
+        telemetry.inc("writes_total", len(writes), collection=collection)
+        for write in writes:
+            write.future.set_result(True)
+
+    def _commit_batch(self, writes):
+        try:
+            self._commit(writes)
+        except Exception as e:
+            print(f"Batch of {len(writes)} writes failed ({type(e).__name__}: {e}). Retrying them one by one...")
+            for write in writes:
+                self._retry_write(write, e)
+
+    def _retry_write(self, write, error):
+        attempts = 0
+        # The first individual attempt is immediate and unconditional: a batch often fails
+        # because of one bad document, so the batch's error says nothing about this write.
+        # Later attempts depend on this write's own error.
+        while attempts == 0 or (attempts <= self.max_retries and is_retryable(error)):
+            if attempts > 0:
+                time.sleep(backoff_delay(attempts - 1))
+            attempts += 1
+            with self._lock:
+                self.retried += 1
+            telemetry.inc("retries_total", hop="firestore_write")
+            try:
+                self._commit([write])
+                return
+            except Exception as e:
+                error = e
+        self._dead_letter(write, error, attempts)
+
+    def _dead_letter(self, write, error, attempts):
+        entry = {'path': write.reference.path, 'data': encode_value(write.data),
+                 'merge': write.merge if isinstance(write.merge, bool) else list(write.merge),
+                 'error': f"{type(error).__name__}: {error}", 'attempts': attempts,
+                 'failedAt': datetime.now(timezone.utc).isoformat()}
+        try:
+            with self._dead_letter_lock:
+                with open(self.dead_letter_path, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(entry, ensure_ascii=False, default=str) + "\n")
+        except OSError as e:
+            print(f"Could not record failed write of {write.reference.path} in '{self.dead_letter_path}': {e}")
+        with self._lock:
+            self.dead_lettered += 1
+        telemetry.inc("dead_letter_total", collection=write.reference.path.split('/', 1)[0])
+        print(f"Gave up writing {write.reference.path} after {attempts} attempts: {error}")
+        write.future.set_exception(RuntimeError(f"write to {write.reference.path} failed: {error}"))
+
+
+def on_all_written(futures, callback):
+    """Calls callback() once every future has resolved, only if all the writes succeeded."""
+    futures = list(futures)
+    if not futures:
+        callback()
+        return
+    state = {'remaining': len(futures), 'failed': False}
+    lock = threading.Lock()
+
+    def done(future):
+        with lock:
+            state['remaining'] -= 1
+            state['failed'] = state['failed'] or future.exception() is not None
+            finished = state['remaining'] == 0 and not state['failed']
+        if finished:
+            callback()
+
+    for future in futures:
+        future.add_done_callback(done)
+
+
+# --- Dead-letter replay ---
+def read_dead_letters(path=DEFAULT_DEAD_LETTER_PATH):
+    entries = []
+    if not os.path.exists(path):
+        return entries
+    with open(path, 'r', encoding='utf-8') as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                print(f"Skipping malformed line {line_number} of '{path}'.")
+    return entries
+
+def replay_dead_letters(db_client, path=DEFAULT_DEAD_LETTER_PATH, **writer_options):
+    """
+    Writes the dead-lettered documents again. The entries are moved first to
+    {path}.replaying, so writes that fail again go to a fresh dead-letter file;
+    that copy is removed once the writer has closed. A .replaying file left by
+    an interrupted replay is merged in, never overwritten. Returns the writer stats.
+    """
+    replaying_path = path + ".replaying"
+    if not os.path.exists(path) and not os.path.exists(replaying_path):
+        print(f"No dead-letter file '{path}'. Nothing to replay.")
+        return None
+    # Leftover of an interrupted replay first, so the newer failures in `path` win
+    entries = read_dead_letters(replaying_path) + read_dead_letters(path)
+    # The latest failure of each document wins (a document may have failed in several runs)
+    latest = {entry['path']: entry for entry in entries if entry.get('path')}
+    if os.path.exists(path):
+        tmp_path = replaying_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for entry in latest.values():
+                f.write(json.dumps(entry, ensure_ascii=False, default=str) + "\n")
+        os.replace(tmp_path, replaying_path) # Both files hold every entry until `path` is removed
+        os.remove(path)
+    print(f"Replaying {len(latest)} dead-lettered writes from '{path}'...")
+    with BulkWriter(db_client, dead_letter_path=path, **writer_options) as writer:
+        for entry in latest.values():
+            writer.set(db_client.document(entry['path']), decode_value(entry['data']), merge=entry.get('merge', False))
+    os.remove(replaying_path)
+    stats = writer.stats()
+    print(f"Replayed {stats['written']}/{len(latest)} writes ({stats['deadLettered']} failed again).")
+    return stats
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replays or lists the writes saved in the Firestore dead-letter file.")
+    parser.add_argument("command", choices=["replay", "list"])
+    parser.add_argument("--file", default=DEFAULT_DEAD_LETTER_PATH, help=f"Dead-letter file (default: {DEFAULT_DEAD_LETTER_PATH}).")
+    args = parser.parse_args()
+
+    if args.command == "list":
+        for entry in read_dead_letters(args.file):
+            print(f"{entry.get('failedAt')}  {entry.get('path')}  ({entry.get('error')})")
+    else:
+        if uses_local_backend():
+            db_client = get_local_document_store()
+        else:
+            import firebase_admin
+            from firebase_admin import credentials, firestore
+            SERVICE_ACCOUNT_KEY_PATH = "sensorizacao-e-ambiente-51347-firebase-adminsdk-fbsvc-d6499a3058.json"
+            if not firebase_admin._apps:
+                firebase_admin.initialize_app(credentials.Certificate(SERVICE_ACCOUNT_KEY_PATH))
+            db_client = firestore.client()
+        replay_dead_letters(db_client, args.file)
@@ -0,0 +1,497 @@
+from datetime import datetime, timezone
+import copy
+import json
+import os
+import random
+import sqlite3
+import string
+import threading
+
+# --- Pluggable document store ---
+# The ingestion scripts talk to Firestore through a small part of its client API:
+#
+#   db.collection(name).document(id).set(data, merge=...) / .get() / .collection(sub)
+#   db.collection(name).document() / .add(data) / .stream()
+#   db.collection(name).where(field, op, value).order_by(field, direction).limit(n).stream()
+#   batch = db.batch(); batch.set(ref, data, merge=...); batch.commit()
+#
+# plus the SERVER_TIMESTAMP, DELETE_FIELD, ArrayUnion, ArrayRemove, Increment, Maximum and Minimum
+# values from firebase_admin.firestore. The local backends below implement that
+# same surface, so the scripts run unchanged against:
+#
+#   STORAGE_BACKEND=firestore   the real Firestore client (default)
+#   STORAGE_BACKEND=sqlite      an embedded SQLite file (WAL mode, one transaction per batch)
+#   STORAGE_BACKEND=memory      a process-local dict, for tests and benchmarks
+#
+# STORAGE_SQLITE_PATH chooses the SQLite file (default local_documents.sqlite3).
+
+STORAGE_BACKENDS = ("firestore", "sqlite", "memory")
+DEFAULT_SQLITE_PATH = "local_documents.sqlite3"
+AUTO_ID_ALPHABET = string.ascii_letters + string.digits
+AUTO_ID_LENGTH = 20
+
+def storage_backend():
+    backend = os.environ.get("STORAGE_BACKEND", "firestore").strip().lower() or "firestore"
+    if backend not in STORAGE_BACKENDS:
+        raise ValueError(f"Unknown STORAGE_BACKEND '{backend}'. Use one of: {', '.join(STORAGE_BACKENDS)}.")
+    return backend
+
+def uses_local_backend():
+    return storage_backend() != "firestore"
+
+_memory_store = None
+_sqlite_stores = {}
+_stores_lock = threading.Lock()
+
+def get_local_document_store(backend=None, sqlite_path=None):
+    """
+    Returns the process-wide local store for `backend` (default: STORAGE_BACKEND).
+    The entry points call this instead of firestore.client() when a local
+    backend is selected.
+    """
+    global _memory_store
+    backend = backend or storage_backend()
+    with _stores_lock:
+        if backend == "memory":
+            if _memory_store is None:
+                _memory_store = MemoryDocumentStore()
+                print("Using the in-memory document store.")
+            return _memory_store
+        if backend == "sqlite":
+            path = sqlite_path or os.environ.get("STORAGE_SQLITE_PATH", DEFAULT_SQLITE_PATH)
+            if path not in _sqlite_stores:
+                _sqlite_stores[path] = SQLiteDocumentStore(path)
+                print(f"Using the SQLite document store at '{path}'.")
+            return _sqlite_stores[path]
+    raise ValueError(f"'{backend}' is not a local document store backend.")
+
+
+# --- Firestore write transforms (recognized by type, so no firebase_admin import is needed) ---
+def transform_kind(value):
+    kind = type(value).__name__
+    if kind == "Sentinel":
+        description = getattr(value, "description", "").lower()
+        if "server timestamp" in description:
+            return "server_timestamp"
+        if "delete" in description:
+            return "delete"
+    if kind in ("ArrayUnion", "ArrayRemove", "Increment", "Maximum", "Minimum"):
+        return kind
+    return None
+
+def _apply_transform(value, current):
+    """Resolves `value` against the field's current value; returns (keep field?, new value)."""
+    kind = transform_kind(value)
+    if kind is None:
+        if isinstance(value, dict): # Transforms can be nested inside maps
+            return True, _deep_merge({}, value)
+        return True, copy.deepcopy(value)
+    if kind == "server_timestamp":
+        return True, datetime.now(timezone.utc)
+    if kind == "delete":
+        return False, None
+    if kind == "ArrayUnion":
+        result = list(current) if isinstance(current, list) else []
+        for item in value.values:
+            if item not in result:
+                result.append(copy.deepcopy(item))
+        return True, result
+    if kind == "ArrayRemove":
+        return True, [item for item in (current if isinstance(current, list) else []) if item not in value.values]
+    if kind == "Increment":
+        return True, (current if isinstance(current, (int, float)) else 0) + value.value
+    if kind == "Maximum":
+        return True, value.value if not isinstance(current, (int, float)) else max(current, value.value)
+    return True, value.value if not isinstance(current, (int, float)) else min(current, value.value) # Minimum
+
+def _deep_merge(target, data):
+    for key, value in data.items():
+        if isinstance(value, dict) and transform_kind(value) is None and isinstance(target.get(key), dict):
+            _deep_merge(target[key], value)
+            continue
+        keep, resolved = _apply_transform(value, target.get(key))
+        if keep:
+            target[key] = resolved
+        else:
+            target.pop(key, None)
+    return target
+
+def _get_path(data, field_path):
+    for part in field_path.split('.'):
+        if not isinstance(data, dict) or part not in data:
+            return None, False
+        data = data[part]
+    return data, True
+
+def _set_path(data, field_path, value, delete=False):
+    parts = field_path.split('.')
+    for part in parts[:-1]:
+        if not isinstance(data.get(part), dict):
+            data[part] = {}
+        data = data[part]
+    if delete:
+        data.pop(parts[-1], None)
+    else:
+        data[parts[-1]] = value
+
+def apply_write(existing, data, merge=False, update=False):
+    """
+    New content of a document after set(data, merge) or update(data) on
+    `existing` (None if the document does not exist), following Firestore's rules.
+    """
+    if update:
+        # update(): keys are field paths ('a.b'), each replaced as a whole
+        result = copy.deepcopy(existing or {})
+        for field_path, value in data.items():
+            current, _ = _get_path(result, field_path)
+            keep, resolved = _apply_transform(value, current)
+            _set_path(result, field_path, resolved, delete=not keep)
+        return result
+    if merge is True:
+        return _deep_merge(copy.deepcopy(existing or {}), data)
+    if merge:
+        # merge=[field paths]: only the listed fields are written, each replaced as a whole
+        result = copy.deepcopy(existing or {})
+        for field_path in merge:
+            value, present = _get_path(data, field_path)
+            if not present:
+                continue
+            current, _ = _get_path(result, field_path)
+            keep, resolved = _apply_transform(value, current)
+            _set_path(result, field_path, resolved, delete=not keep)
+        return result
+    return _deep_merge({}, data)
+
+
+# --- Client objects mirroring the Firestore API ---
+class DocumentSnapshot:
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self._data = data
+
+    @property
+    def exists(self):
+        return self._data is not None
+
+    def to_dict(self):
+        return copy.deepcopy(self._data) if self._data is not None else None
+
+    def get(self, field_path):
+        value, _ = _get_path(self._data or {}, field_path)
+        return copy.deepcopy(value)
+
+
+class DocumentReference:
+    def __init__(self, store, path):
+        self._store = store
+        self.path = path
+        self.id = path.rsplit('/', 1)[-1]
+
+    @property
+    def parent(self):
+        return CollectionReference(self._store, self.path.rsplit('/', 1)[0])
+
+    def collection(self, name):
+        return CollectionReference(self._store, f"{self.path}/{name}")
+
+    def get(self):
+        return DocumentSnapshot(self, self._store._load_one(self.path))
+
+    def set(self, data, merge=False):
+        self._store._commit([("set", self.path, data, merge)])
+
+    def update(self, data):
+        self._store._commit([("update", self.path, data, False)])
+
+    def delete(self):
+        self._store._commit([("delete", self.path, None, False)])
+
+
+class Query:
+    def __init__(self, store, collection_path, filters=(), orders=(), limit_count=None):
+        self._store = store
+        self._collection_path = collection_path
+        self._filters = list(filters)
+        self._orders = list(orders)
+        self._limit = limit_count
+
+    def _copy(self, **changes):
+        values = {'filters': self._filters, 'orders': self._orders, 'limit_count': self._limit}
+        values.update(changes)
+        return Query(self._store, self._collection_path, **values)
+
+    def where(self, field_path=None, op_string=None, value=None, filter=None):
+        if filter is not None: # where(filter=FieldFilter(field, op, value))
+            field_path, op_string, value = filter.field_path, filter.op_string, filter.value
+        return self._copy(filters=self._filters + [(field_path, op_string, value)])
+
+    def order_by(self, field_path, direction="ASCENDING"):
+        return self._copy(orders=self._orders + [(field_path, str(direction).upper().startswith("DESC"))])
+
+    def limit(self, count):
+        return self._copy(limit_count=count)
+
+    def stream(self):
+        documents = sorted(self._store._load_collection(self._collection_path).items())
+        results = [(path, data) for path, data in documents if all(_matches(data, f) for f in self._filters)]
+        for field_path, descending in reversed(self._orders):
+            # Firestore leaves out documents without the ordered field
+            results = [(p, d) for p, d in results if _get_path(d, field_path)[1]]
+            results.sort(key=lambda item: _sort_key(_get_path(item[1], field_path)[0]), reverse=descending)
+        if self._limit is not None:
+            results = results[:self._limit]
+        for path, data in results:
+            yield DocumentSnapshot(DocumentReference(self._store, path), data)
+
+    def get(self):
+        return list(self.stream())
+
+
+class CollectionReference(Query):
+    def __init__(self, store, path):
+        super().__init__(store, path)
+        self.path = path
+        self.id = path.rsplit('/', 1)[-1]
+
+    def document(self, document_id=None):
+        document_id = document_id or ''.join(random.choice(AUTO_ID_ALPHABET) for _ in range(AUTO_ID_LENGTH))
+        return DocumentReference(self._store, f"{self.path}/{document_id}")
+
+    def add(self, data, document_id=None):
+        reference = self.document(document_id)
+        reference.set(data)
+        return datetime.now(timezone.utc), reference
+
+
+class WriteBatch:
+    """Collects writes and applies them atomically on commit()."""
+
+    def __init__(self, store):
+        self._store = store
+        self._writes = []
+
+    def set(self, reference, data, merge=False):
+        self._writes.append(("set", reference.path, data, merge))
+
+    def update(self, reference, data):
+        self._writes.append(("update", reference.path, data, False))
+
+    def delete(self, reference):
+        self._writes.append(("delete", reference.path, None, False))
+
+    def commit(self):
+        writes, self._writes = self._writes, []
+        self._store._commit(writes)
+        return writes
+
+
+def _sort_key(value):
+    # Firestore orders values of different types by type first
+    if value is None:
+        return (0, 0)
+    if isinstance(value, bool):
+        return (1, value)
+    if isinstance(value, (int, float)):
+        return (2, value)
+    if isinstance(value, datetime):
+        return (3, value.timestamp())
+    if isinstance(value, str):
+        return (4, value)
+    return (5, json.dumps(value, sort_keys=True, default=str))
+
+def _matches(data, condition):
+    field_path, op, expected = condition
+    value, present = _get_path(data, field_path)
+    if op == "!=":
+        return present and value != expected
+    if not present:
+        return False
+    try:
+        if op == "==":
+            return value == expected
+        if op == "<":
+            return value < expected
+        if op == "<=":
+            return value <= expected
+        if op == ">":
+            return value > expected
+        if op == ">=":
+            return value >= expected
+        if op == "in":
+            return value in expected
+        if op == "not-in":
+            return value not in expected
+        if op == "array-contains":
+            return isinstance(value, list) and expected in value
+        if op == "array-contains-any":
+            return isinstance(value, list) and any(item in value for item in expected)
+    except TypeError: # Comparing different types never matches, as in Firestore
+        return False
+    raise ValueError(f"Unsupported query operator '{op}'.")
+
+def _parent_path(document_path):
+    return document_path.rsplit('/', 1)[0]
+
+
+class LocalDocumentStore:
+    """Shared logic of the local backends; subclasses provide the storage primitives."""
+
+    def collection(self, path):
+        return CollectionReference(self, path)
+
+    def document(self, path):
+        return DocumentReference(self, path)
+
+    def batch(self):
+        return WriteBatch(self)
+
+    def _commit(self, writes):
+        """Applies the writes of one batch atomically."""
+        with self._transaction() as transaction:
+            pending = {}
+            for kind, path, data, merge in writes:
+                existing = pending[path] if path in pending else transaction.load(path)
+                if kind == "delete":
+                    pending[path] = None
+                elif kind == "update" and existing is None:
+                    raise KeyError(f"No document to update: {path}")
+                else:
+                    pending[path] = apply_write(existing, data, merge=merge, update=(kind == "update"))
+            transaction.store(pending)
+
+
+class _MemoryTransaction:
+    def __init__(self, store):
+        self._documents = store._documents
+
+    def load(self, path):
+        return self._documents.get(path)
+
+    def store(self, documents):
+        for path, data in documents.items():
+            if data is None:
+                self._documents.pop(path, None)
+            else:
+                self._documents[path] = data
+
+
+class MemoryDocumentStore(LocalDocumentStore):
+    """All documents in a dict keyed by path; a lock makes every batch atomic."""
+
+    def __init__(self):
+        self._documents = {}
+        self._lock = threading.RLock()
+
+    def _transaction(self):
+        store = self
+
+        class _Context:
+            def __enter__(self_inner):
+                store._lock.acquire()
+                return _MemoryTransaction(store)
+
+            def __exit__(self_inner, *exc):
+                store._lock.release()
+                return False
+        return _Context()
+
+    def _load_one(self, path):
+        with self._lock:
+            return copy.deepcopy(self._documents.get(path))
+
+    def _load_collection(self, collection_path):
+        with self._lock:
+            return {path: copy.deepcopy(data) for path, data in self._documents.items()
+                    if _parent_path(path) == collection_path}
+
+    def __len__(self):
+        return len(self._documents)
+
+
+# JSON with datetimes (SERVER_TIMESTAMP values and sensor timestamps) preserved
+def _encode_value(value):
+    if isinstance(value, datetime):
+        return {"__datetime__": value.isoformat()}
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def _decode_object(obj):
+    if len(obj) == 1 and "__datetime__" in obj:
+        return datetime.fromisoformat(obj["__datetime__"])
+    return obj
+
+def _dumps(data):
+    return json.dumps(data, default=_encode_value, ensure_ascii=False, separators=(',', ':'))
+
+def _loads(text):
+    return json.loads(text, object_hook=_decode_object)
+
+
+class _SQLiteTransaction:
+    def __init__(self, connection):
+        self._connection = connection
+
+    def load(self, path):
+        row = self._connection.execute("SELECT data FROM documents WHERE path = ?", (path,)).fetchone()
+        return _loads(row[0]) if row else None
+
+    def store(self, documents):
+        upserts = [(path, _parent_path(path), _dumps(data)) for path, data in documents.items() if data is not None]
+        deletes = [(path,) for path, data in documents.items() if data is None]
+        if upserts:
+            self._connection.executemany(
+                "INSERT INTO documents (path, collection, data) VALUES (?, ?, ?) "
+                "ON CONFLICT(path) DO UPDATE SET data = excluded.data", upserts)
+        if deletes:
+            self._connection.executemany("DELETE FROM documents WHERE path = ?", deletes)
+
+
+class SQLiteDocumentStore(LocalDocumentStore):
+    """
+    Documents as JSON rows in one SQLite table, indexed by parent collection.
+    WAL journaling lets readers (another process, the dashboard exporter)
+    proceed while a batch is being written; each batch is one transaction
+    with a bulk executemany insert.
+    """
+
+    def __init__(self, path=DEFAULT_SQLITE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS documents (path TEXT PRIMARY KEY, collection TEXT NOT NULL, data TEXT NOT NULL)")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS documents_collection ON documents (collection)")
+
+    def _transaction(self):
+        store = self
+
+        class _Context:
+            def __enter__(self_inner):
+                store._lock.acquire()
+                store._connection.execute("BEGIN IMMEDIATE")
+                return _SQLiteTransaction(store._connection)
+
+            def __exit__(self_inner, exc_type, *exc):
+                try:
+                    store._connection.execute("ROLLBACK" if exc_type else "COMMIT")
+                finally:
+                    store._lock.release()
+                return False
+        return _Context()
+
+    def _load_one(self, path):
+        with self._lock:
+            row = self._connection.execute("SELECT data FROM documents WHERE path = ?", (path,)).fetchone()
+        return _loads(row[0]) if row else None
+
+    def _load_collection(self, collection_path):
+        with self._lock:
+            rows = self._connection.execute("SELECT path, data FROM documents WHERE collection = ?",
+                                            (collection_path,)).fetchall()
+        return {path: _loads(data) for path, data in rows}
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
@@ -0,0 +1,146 @@
+import argparse
+import json
+import os
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse
+
+# --- Configuration ---
+# Recorded AEMET observation payload used when no --payload file is given
+SAMPLE_PAYLOAD_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "real_time_data_example.txt")
+DEFAULT_PORT = 8081
+
+# Paths served by the stand-in (same layout as opendata.aemet.es)
+API_PREFIX = "/opendata/api/"
+DATA_PREFIX = "/opendata/sh/"
+
+
+def load_recorded_observations(filepath):
+    """
+    Loads a recorded list of observations. Accepts either a plain JSON file or a
+    capture like real_time_data_example.txt, where the 'datos' array is embedded
+    in free text.
+    """
+    with open(filepath, 'r', encoding='utf-8') as f:
+        content = f.read()
+    try:
+        data = json.loads(content)
+        return data if isinstance(data, list) else [data]
+    except json.JSONDecodeError:
+        pass
+
+    # real_time_data_example.txt: the observations follow the "datos :" marker
+    datos_pos = content.find("datos :")
+    start = content.find('[', datos_pos if datos_pos >= 0 else 0)
+    decoder = json.JSONDecoder()
+    observations, _ = decoder.raw_decode(content[start:])
+    return observations
+
+
+def replicate_observations(observations, station_count):
+    """
+    Clones the recorded rows for station_count synthetic stations (idema
+    'FAKE0001', 'FAKE0002', ...) so a single recording can stand in for the
+    whole network.
+    """
+    replicated = []
+    for i in range(1, station_count + 1):
+        idema = f"FAKE{i:04d}"
+        for obs in observations:
+            row = dict(obs)
+            row['idema'] = idema
+            row['ubi'] = f"ESTACION SIMULADA {i}"
+            replicated.append(row)
+    return replicated
+
+
+class FakeAemetHandler(BaseHTTPRequestHandler):
+    """Serves the two-hop AEMET protocol from the observations held by the server."""
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+
+        if path.startswith(API_PREFIX):
+            endpoint = path[len(API_PREFIX):].strip('/')
+            if endpoint == "observacion/convencional/todas":
+                return self._send_metadata("todas")
+            if endpoint.startswith("observacion/convencional/datos/estacion/"):
+                idema = endpoint.rsplit('/', 1)[-1]
+                if idema not in self.server.observations_by_station:
+                    return self._send_json({"descripcion": "No hay datos que satisfagan esos criterios", "estado": 404})
+                return self._send_metadata(f"estacion/{idema}")
+            return self._send_json({"descripcion": "Endpoint no soportado por el servidor de pruebas", "estado": 404})
+
+        if path.startswith(DATA_PREFIX):
+            key = path[len(DATA_PREFIX):].strip('/')
+            if key == "todas":
+                return self._send_json(self.server.observations)
+            if key.startswith("estacion/"):
+                idema = key.split('/', 1)[1]
+                return self._send_json(self.server.observations_by_station.get(idema, []))
+
+        self.send_error(404)
+
+    def _send_metadata(self, data_key):
+        host = self.headers.get('Host') or f"{self.server.server_address[0]}:{self.server.server_address[1]}"
+        self._send_json({
+            "descripcion": "exito",
+            "estado": 200,
+            "datos": f"http://{host}{DATA_PREFIX}{data_key}",
+            "metadatos": f"http://{host}{DATA_PREFIX}metadatos"
+        })
+
+    def _send_json(self, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+def start_fake_aemet_server(observations, host="127.0.0.1", port=0, verbose=False):
+    """
+    Starts the stand-in in a background thread and returns (server, base_url).
+    port=0 picks a free port. Call server.shutdown() to stop it.
+    """
+    server = ThreadingHTTPServer((host, port), FakeAemetHandler)
+    server.daemon_threads = True
+    server.verbose = verbose
+    server.observations = observations
+    server.observations_by_station = {}
+    for obs in observations:
+        server.observations_by_station.setdefault(obs.get('idema'), []).append(obs)
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    base_url = f"http://{host}:{server.server_address[1]}{API_PREFIX.rstrip('/')}"
+    return server, base_url
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for the AEMET OpenData observation endpoints.")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--payload", default=SAMPLE_PAYLOAD_PATH,
+                        help="Recorded observations (JSON list or a capture like real_time_data_example.txt).")
+    parser.add_argument("--replicate", type=int, default=0,
+                        help="Clone the recorded rows for this many synthetic stations.")
+    args = parser.parse_args()
+
+    observations = load_recorded_observations(args.payload)
+    if args.replicate > 0:
+        observations = replicate_observations(observations, args.replicate)
+
+    server, base_url = start_fake_aemet_server(observations, host="0.0.0.0", port=args.port, verbose=True)
+    stations = len(server.observations_by_station)
+    print(f"Fake AEMET server serving {len(observations)} observations from {stations} stations.")
+    print(f"Use it with: AEMET_API_BASE_URL=http://localhost:{args.port}{API_PREFIX.rstrip('/')}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        print("\nStopping fake AEMET server.")
+        server.shutdown()
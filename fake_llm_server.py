@@ -0,0 +1,101 @@
+import argparse
+import json
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse
+
+# --- Configuration ---
+DEFAULT_PORT = 8001
+DEFAULT_DELAY_SECONDS = 0.05 # Simulated generation time per request
+STUB_ANSWER = ("Respuesta simulada: mantenga la humedad del suelo entre el 40 y el 85 %, "
+               "revise el pH y evite regar en las horas de más calor.")
+
+# Paths served by the stand-in (same as llama.cpp's OpenAI-compatible server)
+CHAT_COMPLETIONS_PATH = "/v1/chat/completions"
+COMPLETIONS_PATH = "/v1/completions"
+
+
+class FakeLLMHandler(BaseHTTPRequestHandler):
+    """Answers chat and completion requests with a fixed text after a fixed delay."""
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            payload = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            return self._send_json({"error": "invalid JSON"}, status=400)
+
+        time.sleep(self.server.delay)
+        with self.server.stats_lock:
+            self.server.requests_served += 1
+
+        if path == CHAT_COMPLETIONS_PATH:
+            if payload.get("stream"):
+                return self._send_stream()
+            return self._send_json({"choices": [{"index": 0, "message": {"role": "assistant", "content": self.server.answer}}]})
+        if path == COMPLETIONS_PATH:
+            # A list of prompts (micro-batched by IA/llm_batcher.py) gets one choice per prompt
+            prompts = payload.get("prompt")
+            prompts = prompts if isinstance(prompts, list) else [prompts]
+            return self._send_json({"choices": [{"index": i, "text": self.server.answer} for i in range(len(prompts))]})
+        self.send_error(404)
+
+    def _send_stream(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.end_headers()
+        for word in self.server.answer.split(' '):
+            chunk = {"choices": [{"index": 0, "delta": {"content": word + ' '}}]}
+            self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode('utf-8'))
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.close_connection = True
+
+    def _send_json(self, payload, status=200):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+def start_fake_llm_server(host="127.0.0.1", port=0, delay=DEFAULT_DELAY_SECONDS, answer=STUB_ANSWER, verbose=False):
+    """
+    Starts the stand-in in a background thread and returns (server, chat
+    completions URL). port=0 picks a free port. Call server.shutdown() to stop it.
+    """
+    server = ThreadingHTTPServer((host, port), FakeLLMHandler)
+    server.daemon_threads = True
+    server.verbose = verbose
+    server.delay = delay
+    server.answer = answer
+    server.requests_served = 0
+    server.stats_lock = threading.Lock()
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, f"http://{host}:{server.server_address[1]}{CHAT_COMPLETIONS_PATH}"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for the llama.cpp OpenAI-compatible endpoints.")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--delay", type=float, default=DEFAULT_DELAY_SECONDS,
+                        help="Seconds each request takes to 'generate' its answer.")
+    args = parser.parse_args()
+
+    server, url = start_fake_llm_server(host="0.0.0.0", port=args.port, delay=args.delay, verbose=True)
+    print(f"Fake LLM server answering after {args.delay} s.")
+    print(f"Use it with: LLAMA_API_URL=http://localhost:{args.port}{CHAT_COMPLETIONS_PATH} "
+          f"LLAMA_BATCH_API_URL=http://localhost:{args.port}{COMPLETIONS_PATH}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        print("\nStopping fake LLM server.")
+        server.shutdown()
@@ -1,7 +1,15 @@
 import firebase_admin
 from firebase_admin import credentials, firestore
-import requests
-import json
+from document_store import uses_local_backend, get_local_document_store
+import telemetry
+from bulk_writer import BulkWriter, on_all_written
+from materialize_region_bundle import materialize_region_bundles
+from aemet_client import AemetClient, create_http_session
+from observation_watermarks import WatermarkStore, DEFAULT_STATE_PATH
+from aemet_observation import parse_observations, build_day_documents, build_station_document
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import argparse
+import threading
 import os
 from datetime import datetime
 
@@ -14,17 +22,48 @@ AEMET_API_KEY_PATH = "api_key.txt"
 # You need to find the IDEMA for your specific region/station of interest.
 # Example: '9434' (Madrid, Ciudad Universitaria) - REPLACE WITH YOUR TARGET STATION ID
 SELECTED_STATION_IDEMA = "YOUR_STATION_IDEMA_HERE" # IMPORTANT: Update this
+# Endpoint paths (relative to AEMET_API_BASE_URL in aemet_client.py, which can be
+# pointed at fake_aemet_server.py through the environment) used by this script
+STATION_OBSERVATION_ENDPOINT = "observacion/convencional/datos/estacion/{idema}"
+ALL_STATIONS_OBSERVATION_ENDPOINT = "observacion/convencional/todas"
+# Firestore collection written by import_requestsIDEMAs.py (one station per province)
+STATION_MAP_COLLECTION = "aemetProvinceStationMap"
+# Collection that receives the latest precipitation observation per station
+REALTIME_COLLECTION = "aemetRealtimePrecipitation"
+# Concurrency settings for the all-stations mode
+MAX_CONCURRENT_STATIONS = 16 # Worker threads; each one runs both AEMET hops for a station
+# Every field of every hour, one columnar document per station and day (see aemet_observation.py):
+# aemetRealtimeObservations/{idema} and aemetRealtimeObservations/{idema}/days/{YYYYMMDD}
+OBSERVATIONS_COLLECTION = "aemetRealtimeObservations"
+DAYS_SUBCOLLECTION = "days"
+# Station document fields replaced as a whole on every write (the rest is merged)
+STATION_DOCUMENT_REPLACED_FIELDS = ['idema', 'station', 'latestFint', 'latest', 'recent']
 
 # --- Firebase Setup ---
-try:
-    cred = credentials.Certificate(SERVICE_ACCOUNT_KEY_PATH)
-    if not firebase_admin._apps: # Check if already initialized
-        firebase_admin.initialize_app(cred)
-    db = firestore.client()
-    print("Successfully connected to Firebase Firestore.")
-except Exception as e:
-    print(f"Error initializing Firebase: {e}")
-    exit()
+db = None
+
+def initialize_firebase(db_client=None):
+    """
+    Sets the global Firestore client: the given one (e.g. shared by
+    ingestion_daemon.py) or a new one from the service account key.
+    """
+    global db
+    if db_client is not None:
+        db = db_client
+        return db
+    if uses_local_backend(): # STORAGE_BACKEND=sqlite|memory (see document_store.py)
+        db = get_local_document_store()
+        return db
+    try:
+        cred = credentials.Certificate(SERVICE_ACCOUNT_KEY_PATH)
+        if not firebase_admin._apps: # Check if already initialized
+            firebase_admin.initialize_app(cred)
+        db = firestore.client()
+        print("Successfully connected to Firebase Firestore.")
+        return db
+    except Exception as e:
+        print(f"Error initializing Firebase: {e}")
+        exit()
 
 # --- Function to read AEMET API Key ---
 def get_aemet_api_key(filepath):
@@ -43,147 +82,319 @@ def get_aemet_api_key(filepath):
         print(f"Error reading API key from '{filepath}': {e}")
         return None
 
+# --- Function to fetch data from an AEMET endpoint ---
+def fetch_aemet_endpoint(api_key, endpoint_path, description, client=None, endpoint_key=None):
+    """
+    Fetches the data behind an AEMET OpenData endpoint through the shared
+    AemetClient (rate limiting, retries with backoff and concurrency caps).
+    Pass a client to reuse its pooled keep-alive connections across calls.
+    Expired cached observations are never returned: they are not new data.
+    """
+    if client is not None:
+        return client.fetch(endpoint_path, description, endpoint_key=endpoint_key, allow_stale=False)
+    client = AemetClient(api_key)
+    try:
+        return client.fetch(endpoint_path, description, endpoint_key=endpoint_key, allow_stale=False)
+    finally:
+        client.close()
+
 # --- Function to fetch real-time data from AEMET ---
-def fetch_aemet_station_data(api_key, station_idema):
+def fetch_aemet_station_data(api_key, station_idema, client=None):
     """
     Fetches the latest conventional observation data for a specific AEMET station.
-    AEMET API often requires two requests: one to get a URL for the data,
-    and a second to fetch the actual data from that URL.
     """
-    if not api_key:
-        print("AEMET API key is missing.")
+    endpoint_path = STATION_OBSERVATION_ENDPOINT.format(idema=station_idema)
+    return fetch_aemet_endpoint(api_key, endpoint_path, f"station {station_idema}", client=client,
+                                endpoint_key=STATION_OBSERVATION_ENDPOINT)
+
+def fetch_all_stations_observations(api_key, client=None):
+    """
+    Fetches the conventional observations of every AEMET station in a single
+    download (one metadata hop plus one 'datos' hop for the whole network).
+    """
+    return fetch_aemet_endpoint(api_key, ALL_STATIONS_OBSERVATION_ENDPOINT, "all stations", client=client)
+
+# --- Function to build the Firebase document for a station ---
+def build_precipitation_record(station_idema, station_data_list):
+    """
+    Extracts the latest observation from the station data and returns the
+    document to store in Firebase, or None if the data is not usable.
+    The AEMET station data endpoint returns a list of hourly observations.
+    """
+    if not station_data_list or not isinstance(station_data_list, list) or len(station_data_list) == 0:
+        print(f"No station data for {station_idema}, data is not in expected list format, or list is empty.")
         return None
 
-    initial_url = f"https://opendata.aemet.es/opendata/api/observacion/convencional/datos/estacion/{station_idema}"
-    
-    # Using api_key as a query parameter, which is common for AEMET
-    params = {
-        'api_key': api_key
-    }
-    # Standard headers for JSON
-    headers = {
-        'accept': "application/json"
-    }
+    # Pick the most recent hour by 'fint' instead of relying on the list order
+    # (the sample in real_time_data_example.txt comes oldest first).
+    timed_observations = [obs for obs in station_data_list if isinstance(obs, dict) and obs.get('fint')]
+    if not timed_observations:
+        print(f"Observation timestamp ('fint') not found in data for {station_idema}. Skipping Firebase update for this entry.")
+        print(f"Problematic observation data: {station_data_list[0]}")
+        return None
+    latest_observation = max(timed_observations, key=lambda obs: obs['fint'])
 
-    print(f"Fetching data URL from AEMET for station: {station_idema}...")
-    try:
-        # First request to get the URL for the actual data
-        response_initial = requests.get(initial_url, headers=headers, params=params)
-        response_initial.raise_for_status()
-        
-        data_initial = response_initial.json()
-        
-        if data_initial.get("estado") == 200:
-            data_url = data_initial.get("datos")
-            print(f"Successfully obtained data URL: {data_url}")
-            
-            # Second request to get the actual data
-            # No api_key param needed for this direct data_url, but headers might be good practice
-            print("Fetching actual data from AEMET...")
-            response_data = requests.get(data_url, headers=headers) 
-            response_data.raise_for_status()
-            
-            try:
-                actual_data = response_data.json()
-            except json.JSONDecodeError:
-                print("JSONDecodeError with UTF-8, trying with latin-1 encoding...")
-                actual_data = json.loads(response_data.content.decode('latin-1', errors='ignore'))
-
-            print("Successfully fetched actual data.")
-            return actual_data
-            
-        elif data_initial.get("estado") == 401:
-            print(f"Error: Unauthorized. Check your AEMET API key. Description: {data_initial.get('descripcion')}")
-            return None
-        elif data_initial.get("estado") == 404:
-             print(f"Error: Not Found. Possibly invalid station ID '{station_idema}' or endpoint. Description: {data_initial.get('descripcion')}")
-             return None
-        elif data_initial.get("estado") == 429:
-            print(f"Error: Too Many Requests. API rate limit exceeded. Description: {data_initial.get('descripcion')}")
-            return None
-        else:
-            print(f"Error fetching data from AEMET. Status: {data_initial.get('estado')}, Description: {data_initial.get('descripcion')}")
-            return None
+    observation_time_utc_str = latest_observation.get('fint')
+    precipitation_mm = latest_observation.get('prec', 0.0)
+    location_name = latest_observation.get('ubi', station_idema)
 
-    except requests.exceptions.RequestException as e:
-        print(f"RequestException during AEMET API call: {e}")
-        if hasattr(e, 'response') and e.response is not None:
-            print(f"Response content: {e.response.text}")
+    try:
+        return {
+            'stationIdema': station_idema,
+            'locationName': location_name,
+            'observationTimeUTC': observation_time_utc_str, # Storing as ISO string
+            'precipitation_mm': float(precipitation_mm if precipitation_mm is not None else 0.0),
+            'lastUpdatedFirebase': firestore.SERVER_TIMESTAMP
+        }
+    except (TypeError, ValueError) as e:
+        print(f"Error processing data for station {station_idema}: {e}")
+        print(f"Data being processed: {latest_observation}")
         return None
-    except json.JSONDecodeError as e:
-        print(f"JSONDecodeError parsing AEMET response: {e}")
-        # Log the content that failed to parse for debugging
-        if 'response_initial' in locals() and response_initial:
-             print(f"Initial Response content that caused error: {response_initial.text}")
-        if 'response_data' in locals() and response_data:
-             print(f"Data Response content that caused error: {response_data.text}")
+
+# --- Change detection ---
+def build_station_update(station_idema, station_data_list, watermarks, force=False, record=None):
+    """
+    Compares the station's observations with its watermark. Returns None when
+    nothing newer than the last written 'fint' is available; otherwise a dict
+    with the newest 'fint', the full record, the fields that changed since the
+    last write, the station summary document and the per-day columnar
+    documents holding every new observation. Pass 'record' when the caller has
+    already built it with build_precipitation_record().
+    """
+    if record is None:
+        record = build_precipitation_record(station_idema, station_data_list)
+    if record is None:
         return None
-    except Exception as e:
-        print(f"An unexpected error occurred during AEMET API call: {e}")
+    fint = record['observationTimeUTC']
+    if not force and not watermarks.is_newer(station_idema, fint):
+        print(f"No new observation for station {station_idema} (latest 'fint' {fint} already written). Skipping.")
         return None
 
+    last_fint = None if force else watermarks.last_fint(station_idema)
+    observations = parse_observations(station_data_list)
+    new_observations = [obs for obs in observations if last_fint is None or obs.fint > last_fint]
+    return {
+        'fint': fint,
+        'record': record,
+        'fields': record if force else watermarks.changed_fields(station_idema, record),
+        'station': build_station_document(station_idema, observations),
+        'days': build_day_documents(station_idema, new_observations),
+        'newObservations': len(new_observations),
+    }
+
+def commit_station_updates(db_client, updates, watermarks):
+    """
+    Writes {station_idema: update} through the shared bulk writer: the changed
+    fields of the precipitation document (merged, so unchanged fields are not
+    rewritten), the station observation summary and the new hours merged into
+    their day documents. A station's watermark only advances once all of its
+    writes have committed. Returns the number of stations written.
+    """
+    written = 0
+    written_lock = threading.Lock()
+
+    def station_written(station_idema, update):
+        def callback():
+            nonlocal written
+            with written_lock: # Runs on the writer threads
+                watermarks.advance(station_idema, update['fint'], update['record'])
+                written += 1
+        return callback
+
+    with BulkWriter(db_client) as writer:
+        for station_idema, update in updates.items():
+            futures = [writer.set(db_client.collection(REALTIME_COLLECTION).document(station_idema), update['fields'], merge=True)]
+            observations_ref = db_client.collection(OBSERVATIONS_COLLECTION).document(station_idema)
+            futures.append(writer.set(observations_ref, {**update['station'], 'lastUpdatedFirebase': firestore.SERVER_TIMESTAMP},
+                                      merge=STATION_DOCUMENT_REPLACED_FIELDS + ['lastUpdatedFirebase']))
+            for day_key, day_document in update['days'].items():
+                futures.append(writer.set(observations_ref.collection(DAYS_SUBCOLLECTION).document(day_key), day_document, merge=True))
+            on_all_written(futures, station_written(station_idema, update))
+
+    if updates:
+        print(f"Committed {written} of {len(updates)} station updates ({writer.written} writes).")
+    watermarks.save()
+    return written
+
 # --- Function to extract precipitation and update Firebase ---
-def process_and_upload_precipitation(station_idema, station_data_list):
+def process_and_upload_precipitation(station_idema, station_data_list, watermarks=None, force=False):
     """
-    Processes the station data to find precipitation and uploads it to Firebase.
+    Processes the station data to find precipitation and uploads it to Firebase
+    if AEMET has published a newer observation than the last one written.
     The AEMET station data endpoint returns a list of observations.
     """
-    if not station_data_list or not isinstance(station_data_list, list) or len(station_data_list) == 0:
-        print("No station data, data is not in expected list format, or list is empty.")
+    watermarks = watermarks if watermarks is not None else WatermarkStore(None)
+    update = build_station_update(station_idema, station_data_list, watermarks, force=force)
+    if update is None:
         return
 
-    latest_observation = station_data_list[0] # AEMET usually returns the latest as the first element
-    
-    observation_time_utc_str = latest_observation.get('fint')
-    precipitation_mm = latest_observation.get('prec', 0.0) 
-    location_name = latest_observation.get('ubi', station_idema) 
+    if commit_station_updates(db, {station_idema: update}, watermarks):
+        record = update['record']
+        print(f"Successfully uploaded precipitation data to Firebase for station {station_idema}:")
+        print(f"  Time (UTC): {record['observationTimeUTC']}, Precipitation: {record['precipitation_mm']} mm "
+              f"({update['newObservations']} new hourly observations)")
 
-    if observation_time_utc_str is None:
-        print("Observation timestamp ('fint') not found in data. Skipping Firebase update for this entry.")
-        print(f"Problematic observation data: {latest_observation}")
-        return
+# --- All-stations mode ---
+def load_station_idemas(db_client):
+    """
+    Reads the province -> station map written by import_requestsIDEMAs.py and
+    returns the list of unique station IDEMAs to refresh.
+    """
+    station_idemas = []
+    seen = set()
+    for doc in db_client.collection(STATION_MAP_COLLECTION).stream():
+        idema = (doc.to_dict() or {}).get('idema')
+        if idema and idema not in seen:
+            seen.add(idema)
+            station_idemas.append(idema)
+    print(f"Loaded {len(station_idemas)} stations from '{STATION_MAP_COLLECTION}'.")
+    return station_idemas
 
+def ingest_all_stations(api_key, station_idemas, max_workers=MAX_CONCURRENT_STATIONS, watermarks=None, force=False,
+                        client=None):
+    """
+    Fetches every station concurrently (both AEMET hops per station run inside a
+    worker thread over a shared keep-alive session) and uploads the results in
+    batched Firebase commits. The shared AemetClient keeps the workers within
+    AEMET's rate limit. Stations without a newer observation are not written.
+    Pass a client to reuse its connections (it is then left open).
+    """
+    if not station_idemas:
+        print("No stations to ingest.")
+        return 0
+
+    watermarks = watermarks if watermarks is not None else WatermarkStore(None)
+    updates = {}
+    failed = []
+    own_client = client is None
+    if own_client:
+        client = AemetClient(api_key, session=create_http_session(pool_size=max_workers))
     try:
-        # Prepare data for Firebase
-        data_to_upload = {
-            'stationIdema': station_idema,
-            'locationName': location_name,
-            'observationTimeUTC': observation_time_utc_str, # Storing as ISO string
-            'precipitation_mm': float(precipitation_mm), 
-            'lastUpdatedFirebase': firestore.SERVER_TIMESTAMP 
-        }
-        
-        doc_ref = db.collection('aemetRealtimePrecipitation').document(station_idema)
-        doc_ref.set(data_to_upload) # Overwrites the document with the latest observation
-        
-        print(f"Successfully uploaded precipitation data to Firebase for station {station_idema}:")
-        print(f"  Time (UTC): {observation_time_utc_str}, Precipitation: {precipitation_mm} mm")
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                executor.submit(fetch_aemet_station_data, api_key, idema, client): idema
+                for idema in station_idemas
+            }
+            for future in as_completed(futures):
+                idema = futures[future]
+                try:
+                    station_data = future.result()
+                except Exception as e:
+                    print(f"Unexpected error fetching station {idema}: {e}")
+                    station_data = None
+                record = build_precipitation_record(idema, station_data) if station_data else None
+                if record is None:
+                    failed.append(idema)
+                    continue
+                update = build_station_update(idema, station_data, watermarks, force=force, record=record)
+                if update is not None:
+                    updates[idema] = update
+    finally:
+        if own_client:
+            client.close()
 
-    except Exception as e:
-        print(f"Error processing data or uploading to Firebase: {e}")
-        print(f"Data being processed: {latest_observation}")
+    written = commit_station_updates(db, updates, watermarks)
+    unchanged = len(station_idemas) - len(failed) - len(updates)
+    print(f"Ingested {written}/{len(station_idemas)} stations ({unchanged} unchanged). Failed: {len(failed)}.")
+    if failed:
+        print(f"  Stations without data: {', '.join(sorted(failed))}")
+    return written
+
+# --- Bulk mode (single all-stations download) ---
+def group_observations_by_station(observations, station_idemas=None):
+    """
+    Groups the rows of the all-stations dump by 'idema'. When station_idemas is
+    given, rows of any other station are dropped in memory.
+    """
+    wanted = set(station_idemas) if station_idemas is not None else None
+    grouped = {}
+    for obs in observations or []:
+        if not isinstance(obs, dict):
+            continue
+        idema = obs.get('idema')
+        if not idema or (wanted is not None and idema not in wanted):
+            continue
+        grouped.setdefault(idema, []).append(obs)
+    return grouped
+
+def ingest_all_stations_bulk(api_key, station_idemas, watermarks=None, force=False, client=None):
+    """
+    Downloads the all-stations observation dump once, keeps only the stations of
+    the province -> station map and uploads the stations with newer observations
+    in batched Firebase commits.
+    """
+    watermarks = watermarks if watermarks is not None else WatermarkStore(None)
+    observations = fetch_all_stations_observations(api_key, client=client)
+    if not observations or not isinstance(observations, list):
+        print("Failed to retrieve the all-stations observation dump. Firebase not updated.")
+        return 0
+
+    grouped = group_observations_by_station(observations, station_idemas)
+    print(f"All-stations dump: {len(observations)} rows, {len(grouped)} of {len(station_idemas)} mapped stations present.")
+
+    updates = {}
+    for idema, station_rows in grouped.items():
+        update = build_station_update(idema, station_rows, watermarks, force=force)
+        if update is not None:
+            updates[idema] = update
+
+    missing = sorted(set(station_idemas) - set(grouped))
+    written = commit_station_updates(db, updates, watermarks)
+    print(f"Ingested {written}/{len(station_idemas)} stations from the bulk dump "
+          f"({len(grouped) - len(updates)} unchanged). Missing: {len(missing)}.")
+    if missing:
+        print(f"  Stations without data: {', '.join(missing)}")
+    return written
 
 
 # --- Main Execution ---
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Uploads AEMET real-time precipitation observations to Firebase.")
+    parser.add_argument("--all-stations", action="store_true",
+                        help=f"Refresh every station in '{STATION_MAP_COLLECTION}' concurrently.")
+    parser.add_argument("--bulk", action="store_true",
+                        help="Like --all-stations, but with a single download of AEMET's all-stations observations.")
+    parser.add_argument("--station", default=SELECTED_STATION_IDEMA,
+                        help="Station IDEMA for single-station mode (defaults to SELECTED_STATION_IDEMA).")
+    parser.add_argument("--workers", type=int, default=MAX_CONCURRENT_STATIONS,
+                        help="Number of concurrent station fetches in --all-stations mode.")
+    parser.add_argument("--state", default=DEFAULT_STATE_PATH,
+                        help="Local file with the last observation written per station.")
+    parser.add_argument("--force", action="store_true",
+                        help="Write every station even if its latest observation was already uploaded.")
+    args = parser.parse_args()
+    telemetry.configure_from_env("fetch_aemet_realtime")
+
     print(f"--- Starting AEMET Real-time Precipitation Script ({datetime.now()}) ---")
-    
-    if SELECTED_STATION_IDEMA == "YOUR_STATION_IDEMA_HERE" or not SELECTED_STATION_IDEMA:
-        print("CRITICAL ERROR: 'SELECTED_STATION_IDEMA' is not set. Please update the script.")
+    initialize_firebase()
+
+    if not (args.all_stations or args.bulk) and (args.station == "YOUR_STATION_IDEMA_HERE" or not args.station):
+        print("CRITICAL ERROR: 'SELECTED_STATION_IDEMA' is not set. Please update the script, pass --station or use --all-stations/--bulk.")
         exit()
 
     aemet_api_key = get_aemet_api_key(AEMET_API_KEY_PATH)
 
     if aemet_api_key:
         print(f"Using AEMET API Key from: {AEMET_API_KEY_PATH}")
-        
-        station_data = fetch_aemet_station_data(aemet_api_key, SELECTED_STATION_IDEMA)
-        
-        if station_data:
-            process_and_upload_precipitation(SELECTED_STATION_IDEMA, station_data)
+
+        watermarks = WatermarkStore(args.state)
+        if not args.force:
+            watermarks.seed_from_firestore(db, REALTIME_COLLECTION)
+
+        if args.bulk:
+            ingest_all_stations_bulk(aemet_api_key, load_station_idemas(db), watermarks=watermarks, force=args.force)
+        elif args.all_stations:
+            ingest_all_stations(aemet_api_key, load_station_idemas(db), max_workers=max(1, args.workers),
+                                watermarks=watermarks, force=args.force)
         else:
-            print(f"Failed to retrieve or process data for station {SELECTED_STATION_IDEMA}. Firebase not updated.")
+            station_data = fetch_aemet_station_data(aemet_api_key, args.station)
+
+            if station_data:
+                process_and_upload_precipitation(args.station, station_data, watermarks=watermarks, force=args.force)
+            else:
+                print(f"Failed to retrieve or process data for station {args.station}. Firebase not updated.")
+        materialize_region_bundles(db)
     else:
         print("Failed to load AEMET API Key. Cannot proceed. Exiting.")
 
-    print(f"--- Script finished ({datetime.now()}) ---\n")
\ No newline at end of file
+    print(f"--- Script finished ({datetime.now()}) ---\n")
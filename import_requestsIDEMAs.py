@@ -1,6 +1,11 @@
-import requests
+from aemet_client import AemetClient
+from station_index import DEFAULT_INVENTORY_PATH
 import firebase_admin
 from firebase_admin import credentials, firestore
+from document_store import uses_local_backend, get_local_document_store
+from bulk_writer import BulkWriter
+from materialize_region_bundle import materialize_region_bundles
+import json
 import os
 
 # === CONFIGURATION ===
@@ -10,9 +15,15 @@ AEMET_API_KEY = 'eyJhbGciOiJIUzI1NiJ9.eyJzdWIiOiJ0eGRpdnN4dEBnbWFpbC5jb20iLCJqdG
 FIREBASE_CREDENTIALS_PATH = 'sensorizacao-e-ambiente-51347-firebase-adminsdk-fbsvc-d6499a3058.json' 
 # Name of the Firestore collection to store the province-IDEMA mapping
 FIRESTORE_COLLECTION_NAME = 'aemetProvinceStationMap'
+# AEMET endpoint with the full station inventory (relative to the AEMET API base URL)
+INVENTORY_ENDPOINT = "valores/climatologicos/inventarioestaciones/todasestaciones/"
+# Local copy of the full inventory, loaded by station_index.StationIndex for nearest-station lookups
+STATION_INVENTORY_PATH = DEFAULT_INVENTORY_PATH
 
 def initialize_firebase():
-    """Initializes Firebase Admin SDK."""
+    """Initializes Firebase Admin SDK (or the local store selected by STORAGE_BACKEND)."""
+    if uses_local_backend():
+        return get_local_document_store()
     try:
         cred = credentials.Certificate(FIREBASE_CREDENTIALS_PATH)
         if not firebase_admin._apps: # Initialize only if not already initialized
@@ -24,43 +35,36 @@ def initialize_firebase():
         print(f"Error initializing Firebase: {e}")
         exit()
 
-def fetch_all_aemet_stations():
+def fetch_all_aemet_stations(client=None):
     """Fetches all station inventory data from AEMET."""
     print("Fetching all AEMET stations inventory...")
-    endpoint = "https://opendata.aemet.es/opendata/api/valores/climatologicos/inventarioestaciones/todasestaciones/"
-    headers = {'api_key': AEMET_API_KEY, 'cache-control': "no-cache"}
-    
+    own_client = client is None
+    if own_client:
+        client = AemetClient(AEMET_API_KEY, extra_headers={'cache-control': "no-cache"})
+
     try:
-        response_meta = requests.get(endpoint, headers=headers, verify=True)
-        response_meta.raise_for_status()
-        metadata = response_meta.json()
-
-        if metadata.get("estado") == 200:
-            data_url = metadata.get("datos")
-            print(f"Fetching actual station data from: {data_url}")
-            response_data = requests.get(data_url, headers={'cache-control': "no-cache"}, verify=True)
-            response_data.raise_for_status()
-            
-            # AEMET data often needs latin-1 decoding
-            try:
-                stations_json = response_data.json()
-            except requests.exceptions.JSONDecodeError:
-                # Try decoding with latin-1 if utf-8 fails
-                stations_text = response_data.content.decode('latin-1')
-                stations_json = requests.utils.json.loads(stations_text)
-
-            print(f"Successfully fetched {len(stations_json)} stations.")
-            return stations_json
-        else:
-            print(f"AEMET API error when fetching station list: {metadata.get('descripcion', 'Unknown error')}")
-            return None
-    except requests.exceptions.RequestException as e:
-        print(f"Request failed when fetching station list: {e}")
-        return None
-    except Exception as e:
-        print(f"An unexpected error occurred: {e}")
+        # The shared client handles both hops, the latin-1 fallback, rate limiting and retries
+        stations_json = client.fetch(INVENTORY_ENDPOINT, "station inventory")
+    finally:
+        if own_client:
+            client.close()
+
+    if not isinstance(stations_json, list):
+        print("AEMET API error when fetching station list. See messages above.")
         return None
 
+    print(f"Successfully fetched {len(stations_json)} stations.")
+    return stations_json
+
+
+def save_station_inventory(stations_data, filepath=STATION_INVENTORY_PATH):
+    """Saves the complete station inventory locally (written to a temporary file and renamed)."""
+    tmp_path = filepath + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(stations_data, f, ensure_ascii=False)
+    os.replace(tmp_path, filepath)
+    print(f"Saved the full inventory of {len(stations_data)} stations to '{filepath}'.")
+
 
 def select_one_station_per_province(stations_data):
     if not stations_data:
@@ -110,82 +114,52 @@ def select_one_station_per_province(stations_data):
     return selected_stations
 
 def upload_to_firestore(db_client, data_to_upload):
-    """Uploads the selected station data to Firestore."""
+    """
+    Uploads the selected station data to Firestore through the shared bulk
+    writer. Returns the number of documents actually written.
+    """
     if not data_to_upload:
         print("No data to upload to Firestore.")
-        return
+        return 0
 
     print(f"\nUploading {len(data_to_upload)} province-station mappings to Firestore collection '{FIRESTORE_COLLECTION_NAME}'...")
-    batch = db_client.batch()
-    count = 0
-    skipped_count = 0 
-
-    for province_doc_id_original, station_data in data_to_upload.items(): # Renamed for clarity
-        # --- VALIDATION AND SANITIZATION ---
-        if not province_doc_id_original or not isinstance(province_doc_id_original, str) or not province_doc_id_original.strip():
-            print(f"    SKIPPING: Invalid original province ID (empty or not a string): '{province_doc_id_original}' for station: {station_data.get('nombre')}")
-            skipped_count += 1
-            continue
-        
-        # Sanitize the province name for use as a Firestore document ID
-        # Replace '/' with '_' and '.' with empty (Firestore doesn't like '.' in IDs if they look like numbers, safer to remove)
-        province_doc_id_sanitized = province_doc_id_original.replace('/', '_').replace('.', '')
-        
-        # After sanitization, check if it became empty (e.g., if original was just "/" or ".")
-        if not province_doc_id_sanitized.strip():
-            print(f"    SKIPPING: Province ID became empty after sanitization. Original: '{province_doc_id_original}', Station: {station_data.get('nombre')}")
-            skipped_count += 1
-            continue
-            
-        print(f"  Processing Original Province ID: '{province_doc_id_original}', Sanitized ID: '{province_doc_id_sanitized}'")
-        # --- ---
+    skipped_count = 0
 
-        try:
-            doc_ref = db_client.collection(FIRESTORE_COLLECTION_NAME).document(province_doc_id_sanitized) # USE SANITIZED ID
-            
-            # Add the sanitized ID to the data being stored if you want to reference it easily
-            # station_data['sanitized_id_for_firestore'] = province_doc_id_sanitized 
-            
-            batch.set(doc_ref, station_data)
-            count += 1
-            if count > 0 and count % 490 == 0: 
-                print(f"    Committing batch of (up to) 490 operations...")
-                batch.commit()
-                batch = db_client.batch() 
-                print(f"    Committed. Continuing with next batch...")
-        except ValueError as ve: 
-            print(f"    VALUE ERROR creating doc_ref for '{province_doc_id_sanitized}' (Original: '{province_doc_id_original}'): {ve}")
-            print(f"    Station data was: {station_data}")
-            skipped_count += 1
-            continue 
-        except Exception as e:
-            print(f"    UNEXPECTED ERROR for '{province_doc_id_sanitized}' (Original: '{province_doc_id_original}'): {e}")
-            print(f"    Station data was: {station_data}")
-            skipped_count += 1
-            continue
+    with BulkWriter(db_client) as writer:
+        for province_doc_id_original, station_data in data_to_upload.items(): # Renamed for clarity
+            # --- VALIDATION AND SANITIZATION ---
+            if not province_doc_id_original or not isinstance(province_doc_id_original, str) or not province_doc_id_original.strip():
+                print(f"    SKIPPING: Invalid original province ID (empty or not a string): '{province_doc_id_original}' for station: {station_data.get('nombre')}")
+                skipped_count += 1
+                continue
+
+            # Sanitize the province name for use as a Firestore document ID
+            # Replace '/' with '_' and '.' with empty (Firestore doesn't like '.' in IDs if they look like numbers, safer to remove)
+            province_doc_id_sanitized = province_doc_id_original.replace('/', '_').replace('.', '')
+
+            # After sanitization, check if it became empty (e.g., if original was just "/" or ".")
+            if not province_doc_id_sanitized.strip():
+                print(f"    SKIPPING: Province ID became empty after sanitization. Original: '{province_doc_id_original}', Station: {station_data.get('nombre')}")
+                skipped_count += 1
+                continue
+
+            print(f"  Processing Original Province ID: '{province_doc_id_original}', Sanitized ID: '{province_doc_id_sanitized}'")
+            # --- ---
+
+            try:
+                doc_ref = db_client.collection(FIRESTORE_COLLECTION_NAME).document(province_doc_id_sanitized) # USE SANITIZED ID
+                writer.set(doc_ref, station_data)
+            except ValueError as ve:
+                print(f"    VALUE ERROR creating doc_ref for '{province_doc_id_sanitized}' (Original: '{province_doc_id_original}'): {ve}")
+                print(f"    Station data was: {station_data}")
+                skipped_count += 1
+                continue
 
-    if count > 0 and (count % 490 != 0 or (count == len(data_to_upload) - skipped_count and count % 490 == 0)):
-        try:
-            remaining_ops = count % 490 if count % 490 != 0 else (490 if count > 0 else 0)
-            if remaining_ops > 0:
-                print(f"    Committing final batch of {remaining_ops} operations...")
-                batch.commit()
-                print(f"    Final batch committed.")
-        except Exception as e:
-            print(f"    ERROR committing final batch: {e}")
-            # Consider these as skipped for the final count if the batch fails
-            # This part is tricky, as some might have succeeded before the error in a partial batch failure
-            # For simplicity, we'll assume the remaining items in the current batch failed if this commit fails.
-            # A more robust solution would track individual successes/failures within a batch.
-            # skipped_count += remaining_ops 
-
-
-    if skipped_count > 0:
-        print(f"Successfully processed {len(data_to_upload) - skipped_count} documents for upload. Skipped {skipped_count} due to errors.")
-    elif len(data_to_upload) > 0:
-        print(f"All {len(data_to_upload)} documents processed successfully for upload to Firestore.")
-    else:
-        print("No valid data was processed for upload.")
+    # Every queued write is now committed or recorded in the dead-letter file
+    stats = writer.stats()
+    print(f"Wrote {stats['written']} of {len(data_to_upload)} documents to '{FIRESTORE_COLLECTION_NAME}'. "
+          f"Skipped {skipped_count} invalid entries; {stats['deadLettered']} writes failed.")
+    return stats['written']
 
 
 if __name__ == "__main__":
@@ -211,6 +185,8 @@ if __name__ == "__main__":
     if db:
         all_stations = fetch_all_aemet_stations()
         if all_stations:
+            save_station_inventory(all_stations)
             stations_map = select_one_station_per_province(all_stations)
             upload_to_firestore(db, stations_map)
+            materialize_region_bundles(db)
     print("\nScript finished.")
\ No newline at end of file
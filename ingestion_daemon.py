@@ -0,0 +1,345 @@
+import firebase_admin
+from firebase_admin import credentials, firestore
+from document_store import uses_local_backend, get_local_document_store
+import telemetry
+from aemet_client import AemetClient, create_http_session
+from observation_watermarks import WatermarkStore, DEFAULT_STATE_PATH
+import fetch_aemet_realtime
+import import_requestsIDEMAs
+import upload_all_aemet_data
+import materialize_region_bundle
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import signal
+import threading
+import time
+
+# --- Long-running ingestion daemon ---
+# Replaces the cron-invoked one-shot scripts with a single process that connects
+# to Firebase and opens the AEMET connection pool once, then runs:
+#
+#   realtime     fetch_aemet_realtime.py --all-stations (or --bulk)
+#   inventory    import_requestsIDEMAs.py (station inventory + province map)
+#   historical   upload_all_aemet_data.py --incremental
+#   bundles      materialize_region_bundle.py (also run after each of the jobs above)
+#
+# each on its own interval with random jitter, concurrently but never two runs of
+# the same job at once. Per-job run counts, failures and durations are printed
+# periodically and written to a JSON status file.
+#
+#   python ingestion_daemon.py --realtime-interval 600 --historical-interval 86400
+
+SERVICE_ACCOUNT_KEY_PATH = "sensorizacao-e-ambiente-51347-firebase-adminsdk-fbsvc-d6499a3058.json"
+AEMET_API_KEY_PATH = "api_key.txt"
+DEFAULT_STATUS_PATH = "ingestion_daemon_status.json"
+DEFAULT_JITTER = 0.1 # Fraction of the interval added or removed at random on every reschedule
+REPORT_INTERVAL_SECONDS = 300
+AEMET_POOL_SIZE = 16
+
+_firestore_client = None
+_firestore_lock = threading.Lock()
+
+def get_firestore_client():
+    """Initializes firebase_admin on first use and returns the process-wide Firestore client."""
+    global _firestore_client
+    with _firestore_lock:
+        if _firestore_client is None and uses_local_backend(): # STORAGE_BACKEND=sqlite|memory
+            _firestore_client = get_local_document_store()
+        if _firestore_client is None:
+            cred = credentials.Certificate(SERVICE_ACCOUNT_KEY_PATH)
+            if not firebase_admin._apps:
+                firebase_admin.initialize_app(cred)
+            _firestore_client = firestore.client()
+            print("Successfully connected to Firebase Firestore.")
+        return _firestore_client
+
+def utc_now_iso():
+    return datetime.now(timezone.utc).isoformat(timespec='seconds')
+
+
+class Job:
+    """A periodic task plus its run statistics."""
+
+    def __init__(self, name, func, interval, jitter=DEFAULT_JITTER, initial_delay=0.0):
+        self.name = name
+        self.func = func
+        self.interval = float(interval)
+        self.jitter = jitter
+        self.next_run = time.monotonic() + initial_delay
+        self.running = False
+        self.runs = 0
+        self.failures = 0
+        self.skipped_overlaps = 0
+        self.last_duration = None
+        self.max_duration = 0.0
+        self.total_duration = 0.0
+        self.last_started = None
+        self.last_finished = None
+        self.last_error = None
+
+    def schedule_next(self, now):
+        spread = self.interval * self.jitter
+        self.next_run = now + max(1.0, self.interval + random.uniform(-spread, spread))
+
+    def record(self, duration, error=None):
+        self.runs += 1
+        self.last_duration = duration
+        self.max_duration = max(self.max_duration, duration)
+        self.total_duration += duration
+        self.last_finished = utc_now_iso()
+        if error is not None:
+            self.failures += 1
+            self.last_error = f"{type(error).__name__}: {error}"
+
+    def stats(self):
+        return {
+            'intervalSeconds': self.interval,
+            'running': self.running,
+            'runs': self.runs,
+            'failures': self.failures,
+            'skippedOverlaps': self.skipped_overlaps,
+            'lastDurationSeconds': round(self.last_duration, 3) if self.last_duration is not None else None,
+            'meanDurationSeconds': round(self.total_duration / self.runs, 3) if self.runs else None,
+            'maxDurationSeconds': round(self.max_duration, 3),
+            'lastStarted': self.last_started,
+            'lastFinished': self.last_finished,
+            'lastError': self.last_error,
+        }
+
+
+class Scheduler:
+    """
+    Runs jobs on a thread pool when they are due. A job that is still running
+    when it comes due again is not started twice: that occurrence is skipped
+    and counted. A failing job is logged and rescheduled, never fatal.
+    """
+
+    def __init__(self, jobs, status_path=DEFAULT_STATUS_PATH, report_interval=REPORT_INTERVAL_SECONDS):
+        self.jobs = jobs
+        self.status_path = status_path
+        self.report_interval = report_interval
+        self.started = utc_now_iso()
+        self._lock = threading.Lock()
+        self._status_file_lock = threading.Lock() # Jobs finishing together must not share the temporary file
+        self._stop = threading.Event()
+        self._executor = ThreadPoolExecutor(max_workers=max(1, len(jobs)), thread_name_prefix="job")
+
+    def stop(self, *_):
+        print("Stopping the ingestion daemon after the running jobs finish...")
+        self._stop.set()
+
+    def _run(self, job):
+        print(f"[{utc_now_iso()}] Job '{job.name}' started.")
+        start = time.perf_counter()
+        error = None
+        try:
+            # TELEMETRY_PROFILE=cpu|memory captures each job run separately (CPU: the job's own
+            # thread only; memory: shared by overlapping jobs, see telemetry.profile_run)
+            with telemetry.profile_run(f"job-{job.name}"), telemetry.timed("job", job=job.name):
+                job.func()
+        except BaseException as e: # SystemExit from a script's exit() included
+            error = e
+            print(f"Job '{job.name}' failed: {type(e).__name__}: {e}")
+        duration = time.perf_counter() - start
+        with self._lock:
+            job.record(duration, error)
+            job.running = False
+        print(f"[{utc_now_iso()}] Job '{job.name}' {'failed' if error else 'finished'} in {duration:.1f}s.")
+        self.write_status()
+
+    def run_pending(self):
+        now = time.monotonic()
+        with self._lock:
+            for job in self.jobs:
+                if job.next_run > now:
+                    continue
+                job.schedule_next(now)
+                if job.running:
+                    job.skipped_overlaps += 1
+                    print(f"Job '{job.name}' is still running; skipping this occurrence.")
+                    continue
+                job.running = True
+                job.last_started = utc_now_iso()
+                self._executor.submit(self._run, job)
+
+    def run_forever(self):
+        last_report = time.monotonic()
+        while not self._stop.is_set():
+            self.run_pending()
+            if time.monotonic() - last_report >= self.report_interval:
+                self.print_report()
+                last_report = time.monotonic()
+            with self._lock:
+                next_due = min(job.next_run for job in self.jobs)
+            self._stop.wait(min(max(0.5, next_due - time.monotonic()), 30.0))
+        self._executor.shutdown(wait=True)
+        self.print_report()
+        self.write_status()
+
+    def run_once(self):
+        """Runs every job once, concurrently, and waits for all of them."""
+        with self._lock:
+            for job in self.jobs:
+                job.running = True
+                job.last_started = utc_now_iso()
+        futures = [self._executor.submit(self._run, job) for job in self.jobs]
+        for future in futures:
+            future.result()
+        self._executor.shutdown(wait=True)
+        self.print_report()
+
+    def status(self):
+        with self._lock:
+            return {'started': self.started, 'updated': utc_now_iso(),
+                    'jobs': {job.name: job.stats() for job in self.jobs},
+                    'metrics': telemetry.snapshot()}
+
+    def write_status(self):
+        if not self.status_path:
+            return
+        status = self.status()
+        tmp_path = self.status_path + ".tmp"
+        try:
+            with self._status_file_lock:
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(status, f, indent=2)
+                os.replace(tmp_path, self.status_path)
+        except OSError as e:
+            print(f"Could not write daemon status file '{self.status_path}': {e}")
+
+    def print_report(self):
+        print(f"--- Ingestion daemon report ({utc_now_iso()}) ---")
+        for name, stats in self.status()['jobs'].items():
+            print(f"  {name:<11} runs={stats['runs']} failures={stats['failures']} "
+                  f"skipped={stats['skippedOverlaps']} last={stats['lastDurationSeconds']}s "
+                  f"mean={stats['meanDurationSeconds']}s max={stats['maxDurationSeconds']}s")
+
+
+# --- Jobs ---
+class IngestionContext:
+    """Everything the jobs share: the Firestore client, the AEMET client and the real-time watermarks."""
+
+    def __init__(self, api_key, db_client, bulk=False, data_root="./aemetDATA/", store_path=None,
+                 state_path=None, workers=None):
+        self.api_key = api_key
+        self.db = db_client
+        self.bulk = bulk
+        self.data_root = data_root
+        self.store_path = store_path
+        self.workers = workers
+        self.aemet = AemetClient(api_key, session=create_http_session(pool_size=AEMET_POOL_SIZE))
+        fetch_aemet_realtime.initialize_firebase(db_client)
+        upload_all_aemet_data.initialize_firebase(db_client)
+        self.watermarks = WatermarkStore(state_path or DEFAULT_STATE_PATH)
+        self.watermarks.seed_from_firestore(db_client, fetch_aemet_realtime.REALTIME_COLLECTION)
+        self._station_idemas = None
+        self._stations_lock = threading.Lock()
+        self._bundles_lock = threading.Lock()
+
+    def station_idemas(self, reload=False):
+        with self._stations_lock:
+            if reload or self._station_idemas is None:
+                self._station_idemas = fetch_aemet_realtime.load_station_idemas(self.db)
+            return self._station_idemas
+
+    def realtime_job(self):
+        if self.bulk:
+            fetch_aemet_realtime.ingest_all_stations_bulk(self.api_key, self.station_idemas(),
+                                                         watermarks=self.watermarks, client=self.aemet)
+        else:
+            fetch_aemet_realtime.ingest_all_stations(self.api_key, self.station_idemas(), watermarks=self.watermarks,
+                                                    client=self.aemet)
+        self.bundle_job()
+
+    def inventory_job(self):
+        stations = import_requestsIDEMAs.fetch_all_aemet_stations(client=self.aemet)
+        if not stations:
+            raise RuntimeError("the AEMET station inventory could not be fetched")
+        import_requestsIDEMAs.save_station_inventory(stations)
+        import_requestsIDEMAs.upload_to_firestore(self.db, import_requestsIDEMAs.select_one_station_per_province(stations))
+        self.station_idemas(reload=True)
+        self.bundle_job()
+
+    def historical_job(self):
+        upload_all_aemet_data.sync_historical_data(self.data_root, incremental=True, workers=self.workers,
+                                                   store_path=self.store_path)
+        self.bundle_job()
+
+    def bundle_job(self):
+        # Several jobs finish at about the same time: one materialization at a time is enough
+        with self._bundles_lock:
+            materialize_region_bundle.materialize_region_bundles(self.db)
+
+    def close(self):
+        self.aemet.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Long-running AEMET ingestion daemon (real-time, inventory and historical jobs).")
+    parser.add_argument("--realtime-interval", type=float, default=600, help="Seconds between real-time polls (0 disables).")
+    parser.add_argument("--inventory-interval", type=float, default=7 * 24 * 3600,
+                        help="Seconds between station inventory refreshes (0 disables).")
+    parser.add_argument("--historical-interval", type=float, default=24 * 3600,
+                        help="Seconds between incremental historical syncs (0 disables).")
+    parser.add_argument("--bundle-interval", type=float, default=300,
+                        help="Seconds between region bundle refreshes, which pick up new sensor readings (0 disables).")
+    parser.add_argument("--jitter", type=float, default=DEFAULT_JITTER, help="Random fraction of each interval (0-1).")
+    parser.add_argument("--bulk", action="store_true", help="Real-time job downloads all stations at once.")
+    parser.add_argument("--data-root", default="./aemetDATA/", help="Historical CSV directory.")
+    parser.add_argument("--from-store", metavar="STORE_PATH", help="Historical job reads the compiled columnar store.")
+    parser.add_argument("--workers", type=int, default=None, help="Parser processes for the historical job.")
+    parser.add_argument("--state", default=None, help="Real-time watermark state file.")
+    parser.add_argument("--status-file", default=DEFAULT_STATUS_PATH, help="JSON file with per-job statistics.")
+    parser.add_argument("--once", action="store_true", help="Run every enabled job once and exit.")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="Serve stage timings and counters on /metrics (Prometheus) and /metrics.json.")
+    args = parser.parse_args()
+    telemetry.configure_from_env()
+    if args.metrics_port:
+        telemetry.start_metrics_server(args.metrics_port)
+
+    # The historical job parses CSVs in a process pool; starting those processes with
+    # fork from a multi-threaded process holding gRPC channels is unsafe
+    multiprocessing.set_start_method("spawn")
+
+    try:
+        with open(AEMET_API_KEY_PATH, 'r') as f:
+            aemet_api_key = f.read().strip()
+    except OSError as e:
+        print(f"ERROR: Could not read the AEMET API key from '{AEMET_API_KEY_PATH}': {e}")
+        exit()
+    if not aemet_api_key:
+        print(f"ERROR: API key file '{AEMET_API_KEY_PATH}' is empty.")
+        exit()
+
+    context = IngestionContext(aemet_api_key, get_firestore_client(), bulk=args.bulk, data_root=args.data_root,
+                               store_path=args.from_store, state_path=args.state, workers=args.workers)
+    jobs = []
+    # Staggered first runs so the jobs do not start in the same second
+    for offset, (name, func, interval) in enumerate([
+            ("realtime", context.realtime_job, args.realtime_interval),
+            ("inventory", context.inventory_job, args.inventory_interval),
+            ("historical", context.historical_job, args.historical_interval),
+            ("bundles", context.bundle_job, args.bundle_interval)]):
+        if interval > 0:
+            jobs.append(Job(name, func, interval, jitter=args.jitter, initial_delay=offset * 5.0))
+    if not jobs:
+        print("All jobs are disabled. Nothing to do.")
+        exit()
+
+    scheduler = Scheduler(jobs, status_path=args.status_file)
+    try:
+        if args.once:
+            scheduler.run_once()
+        else:
+            signal.signal(signal.SIGINT, scheduler.stop)
+            signal.signal(signal.SIGTERM, scheduler.stop)
+            print(f"Ingestion daemon started with jobs: {', '.join(f'{j.name} every {j.interval:.0f}s' for j in jobs)}")
+            scheduler.run_forever()
+    finally:
+        context.close()
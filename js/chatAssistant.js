@@ -25,20 +25,71 @@ document.addEventListener("DOMContentLoaded", () => {
         try {
             const response = await fetch('http://localhost:5000/ask', {
                 method: 'POST',
-                headers: { 'Content-Type': 'application/json' },
+                headers: {
+                    'Content-Type': 'application/json',
+                    // El servidor asíncrono (async_api_assistant.py) responde en streaming;
+                    // api_assistant.py ignora esta cabecera y devuelve JSON
+                    'Accept': 'text/event-stream, application/json'
+                },
                 body: JSON.stringify({
                     question: userMessage,
                     region: selectedRegion
                 })
             });
 
-            const data = await response.json();
-            updateLastBotMessage(data.answer || "No pude entender la consulta.");
+            const contentType = response.headers.get('Content-Type') || '';
+            if (contentType.includes('text/event-stream') && response.body) {
+                await readAnswerStream(response);
+            } else {
+                const data = await response.json();
+                updateLastBotMessage(data.answer || "No pude entender la consulta.");
+            }
         } catch (err) {
             updateLastBotMessage("Error al contactar con el asistente IA.");
         }
     }
 
+    // Muestra la respuesta a medida que llegan los fragmentos (eventos SSE "data: {...}")
+    async function readAnswerStream(response) {
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        let answer = '';
+
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+
+            let separator;
+            while ((separator = buffer.indexOf('\n\n')) !== -1) {
+                const rawEvent = buffer.slice(0, separator);
+                buffer = buffer.slice(separator + 2);
+
+                let eventName = 'message';
+                let dataText = '';
+                for (const line of rawEvent.split('\n')) {
+                    if (line.startsWith('event:')) eventName = line.slice(6).trim();
+                    else if (line.startsWith('data:')) dataText += line.slice(5).trim();
+                }
+                if (!dataText) continue;
+                const payload = JSON.parse(dataText);
+
+                if (eventName === 'error') {
+                    updateLastBotMessage(payload.error || "Error al contactar con el asistente IA.");
+                    return;
+                }
+                if (eventName === 'done') {
+                    answer = payload.answer || answer;
+                } else if (payload.delta) {
+                    answer += payload.delta;
+                }
+                updateLastBotMessage(answer || "Pensando...");
+            }
+        }
+        if (!answer) updateLastBotMessage("No pude entender la consulta.");
+    }
+
     function appendMessage(sender, text) {
         const messageDiv = document.createElement('div');
         messageDiv.className = `message ${sender}-message`;
@@ -7,6 +7,7 @@ import { getDocs, collection, doc, getDoc, query, orderBy, limit } from "https:/
 let currentUserProfile = null;
 let selectedRegionId = null; // The sanitized region ID from URL (e.g., A_CORUÑA)
 let selectedRegionDisplayName = null; // For display (e.g., A CORUÑA)
+let regionBundle = null; // regionBundle/{regionId} written by materialize_region_bundle.py
 
 // --- DOM Elements for region-dashboard.html ---
 const dashboardTitleSpan = document.getElementById('selected-region-name');
@@ -40,8 +41,6 @@ document.addEventListener('DOMContentLoaded', () => {
         if (!user) {
             window.location.href = "auth.html";
         } else {
-            currentUserProfile = await fetchUserProfile(user.uid);
-            
             const urlParams = new URLSearchParams(window.location.search);
             selectedRegionId = urlParams.get('region');
 
@@ -50,8 +49,15 @@ document.addEventListener('DOMContentLoaded', () => {
                 window.location.href = "index.html";
                 return;
             }
-            
-            await fetchRegionDisplayName();
+
+            // The region bundle holds everything the page shows in one read; without it
+            // (not materialized yet) the individual documents are read as before
+            [currentUserProfile, regionBundle] = await Promise.all([fetchUserProfile(user.uid), fetchRegionBundle(selectedRegionId)]);
+            if (regionBundle) {
+                selectedRegionDisplayName = regionBundle.displayName;
+            } else {
+                await fetchRegionDisplayName();
+            }
             updatePageTitlesAndElements();
             initializeDashboardData();
         }
@@ -68,6 +74,29 @@ async function fetchUserProfile(userId) {
     return null;
 }
 
+async function fetchRegionBundle(regionId) {
+    try {
+        const bundleSnap = await getDoc(doc(db, "regionBundle", regionId));
+        if (bundleSnap.exists()) return bundleSnap.data();
+    } catch (error) { console.warn("Could not fetch the region bundle, reading the individual documents:", error); }
+    return null;
+}
+
+// Historical context of the current month from the monthly values stored in the bundle
+function historicalContextFromBundle(bundle) {
+    const historical = bundle?.historical;
+    const monthNames = ["enero", "febrero", "marzo", "abril", "mayo", "junio", "julio", "agosto", "septiembre", "octubre", "noviembre", "diciembre"];
+    const currentMonthName = monthNames[new Date().getMonth()];
+    if (historical?.monthlyValues?.[currentMonthName] == null) return null;
+    return {
+        value: historical.monthlyValues[currentMonthName],
+        month: currentMonthName,
+        year: historical.period,
+        parameter: historical.parameter,
+        region: historical.region || selectedRegionDisplayName
+    };
+}
+
 async function fetchRegionDisplayName() {
     let displayName = selectedRegionId.replace(/_/g, ' '); 
     if (!selectedRegionId) return;
@@ -119,49 +148,91 @@ async function fetchAndDisplaySensorData(isManualSimulation = false, simulatedDa
         latestSensorData = simulatedData;
     } else {
         try {
-            // Fetch the latest sensor data entry globally for now
-            // In a real app, you might filter sensorData by region if applicable
-            const sensorQuery = query(collection(db, "sensorData"), orderBy("sensor_timestamp", "desc"), limit(1));
-            const sensorSnapshot = await getDocs(sensorQuery);
-            if (!sensorSnapshot.empty) {
-                latestSensorData = sensorSnapshot.docs[0].data();
+            // Latest reading of this region from the sharded layout (sensor_timeseries.py): one document read.
+            // Read live even with a region bundle: the sensor writers do not re-materialize it, so its
+            // sensorSummary is only as fresh as the last bundle job
+            const regionSensorsSnap = await getDoc(doc(db, "sensorRegions", selectedRegionId));
+            if (regionSensorsSnap.exists() && regionSensorsSnap.data().latest) {
+                latestSensorData = regionSensorsSnap.data().latest;
             } else {
-                console.log("No sensor data found in Firestore.");
+                // Fallback: latest sensor data entry globally
+                const sensorQuery = query(collection(db, "sensorData"), orderBy("sensor_timestamp", "desc"), limit(1));
+                const sensorSnapshot = await getDocs(sensorQuery);
+                if (!sensorSnapshot.empty) {
+                    latestSensorData = sensorSnapshot.docs[0].data();
+                } else {
+                    console.log("No sensor data found in Firestore.");
+                }
             }
         } catch (error) {
             console.error("Error fetching sensor data:", error);
-            generateEnhancedRecommendations(null, null, "Error al cargar datos del sensor.");
-            updateSensorSummary(null); // Clear summary
-            return;
+            latestSensorData = regionBundle?.sensorSummary || null; // Last materialized reading, if any
+            if (!latestSensorData) {
+                generateEnhancedRecommendations(null, null, "Error al cargar datos del sensor.");
+                updateSensorSummary(null); // Clear summary
+                return;
+            }
         }
     }
     
     updateSensorSummary(latestSensorData);
 
+    // Advice evaluated server-side over every sensor of the region (recommendation_engine.py)
+    const serverRecommendations = regionBundle?.recommendations;
+    if (!isManualSimulation && serverRecommendations?.recommendations?.length) {
+        const alertLines = (serverRecommendations.alerts || []).map(alert =>
+            `${alert.level} ${alert.message} (${alert.sensors} de ${serverRecommendations.sensorCount} sensores)`);
+        const waterBalanceLines = waterBalanceRecommendations(regionBundle);
+        renderRecommendations([...alertLines, ...serverRecommendations.recommendations, ...waterBalanceLines], serverRecommendations.issuesFound);
+        return;
+    }
+
     let aemetHistoricalContext = null;
-    if (selectedRegionId && latestSensorData) {
+    if (regionBundle && latestSensorData) {
+        aemetHistoricalContext = historicalContextFromBundle(regionBundle);
+    } else if (selectedRegionId && latestSensorData) {
         const currentMonthIndex = new Date().getMonth();
         const monthNames = ["enero", "febrero", "marzo", "abril", "mayo", "junio", "julio", "agosto", "septiembre", "octubre", "noviembre", "diciembre"];
         const currentMonthName = monthNames[currentMonthIndex];
-        let aemetParamCode = "AD25mm_Provincias"; // Default
+        let aemetParamCode = "AD25mm_Provincia"; // Default
         const refYear = "2020"; 
+        // Climatology summary written by upload_all_aemet_data.py (multi-year mean in one read)
+        const climatologyParamCode = "AD25mm_Provincia";
 
         try {
-            const aemetDocRef = doc(db, `aemetHistoricalData/${selectedRegionId}/${aemetParamCode}/${refYear}`);
-            const aemetDocSnap = await getDoc(aemetDocRef);
-            if (aemetDocSnap.exists()) {
-                const data = aemetDocSnap.data();
-                if (data.monthlyValues?.[currentMonthName] !== undefined) {
-                    aemetHistoricalContext = {
-                        value: data.monthlyValues[currentMonthName],
-                        month: currentMonthName,
-                        year: refYear,
-                        parameter: aemetParamCode,
-                        region: data.regionOriginal || selectedRegionDisplayName
-                    };
-                }
+            const climatologyDocRef = doc(db, "aemetHistoricalData", selectedRegionId, "climatology", climatologyParamCode);
+            const climatologySnap = await getDoc(climatologyDocRef);
+            const climatology = climatologySnap.exists() ? climatologySnap.data() : null;
+            if (climatology?.monthlyMean?.[currentMonthName] != null) {
+                const years = climatology.years || [];
+                aemetHistoricalContext = {
+                    value: climatology.monthlyMean[currentMonthName],
+                    month: currentMonthName,
+                    year: years.length ? `${years[0]}-${years[years.length - 1]}` : refYear,
+                    parameter: climatology.parameterCodeUsed || climatologyParamCode,
+                    region: climatology.regionOriginal || selectedRegionDisplayName
+                };
             }
-        } catch (error) { console.error("Error fetching AEMET context for recs:", error); }
+        } catch (error) { console.warn("Error fetching AEMET climatology for recs, falling back to reference year:", error); }
+
+        if (!aemetHistoricalContext) { // Fallback: single reference year
+            try {
+                const aemetDocRef = doc(db, `aemetHistoricalData/${selectedRegionId}/${aemetParamCode}/${refYear}`);
+                const aemetDocSnap = await getDoc(aemetDocRef);
+                if (aemetDocSnap.exists()) {
+                    const data = aemetDocSnap.data();
+                    if (data.monthlyValues?.[currentMonthName] !== undefined) {
+                        aemetHistoricalContext = {
+                            value: data.monthlyValues[currentMonthName],
+                            month: currentMonthName,
+                            year: refYear,
+                            parameter: aemetParamCode,
+                            region: data.regionOriginal || selectedRegionDisplayName
+                        };
+                    }
+                }
+            } catch (error) { console.error("Error fetching AEMET context for recs:", error); }
+        }
     }
     
     generateEnhancedRecommendations(latestSensorData, aemetHistoricalContext);
@@ -239,6 +310,25 @@ function generateEnhancedRecommendations(latestSensor, historicalContext, errorM
         }
     }
 
+    recommendations.push(...waterBalanceRecommendations(regionBundle));
+    renderRecommendations(recommendations, issuesFound);
+}
+
+// Irrigation need until December from the bundle's water balance projection (water_balance.py)
+function waterBalanceRecommendations(bundle) {
+    const crops = bundle?.waterBalance?.crops;
+    if (!crops) return [];
+    const capacity = "75mm";
+    const parts = Object.entries(crops)
+        .filter(([, byCapacity]) => byCapacity[capacity])
+        .map(([crop, byCapacity]) => `${crop.replace('_', ' ')} ${byCapacity[capacity].p50} mm (año seco ${byCapacity[capacity].p90} mm)`);
+    if (parts.length === 0) return [];
+    return [`INFO Riego estimado hasta diciembre (suelo de ${capacity.replace('mm', ' mm')}): ${parts.join(', ')}.`];
+}
+
+function renderRecommendations(recommendations, issuesFound) {
+    if (!recommendationsDiv) return;
+    recommendationsDiv.innerHTML = "";
     if (!issuesFound && recommendations.every(rec => rec.startsWith("INFO"))) {
         recommendationsDiv.innerHTML = "<p>Condiciones generales del suelo parecen estar bien. Continuar monitorizando.</p>";
     } else if (recommendations.length === 0) {
@@ -292,7 +382,14 @@ async function fetchAndDisplayRealtimeAemetSimulated() {
     realtimeAemetStatusMessage.style.color = "orange";
 
     let idemaForRegion = null;
-    if (selectedRegionId) { // selectedRegionId is set from URL param when page loads
+    if (regionBundle) {
+        idemaForRegion = regionBundle.station?.idema || null;
+        if (!idemaForRegion) {
+            realtimeAemetStatusMessage.textContent = `No hay estación AEMET configurada para ${selectedRegionDisplayName || selectedRegionId}.`;
+            realtimeAemetStatusMessage.style.color = "red";
+            return;
+        }
+    } else if (selectedRegionId) { // selectedRegionId is set from URL param when page loads
         try {
             const stationMapDocRef = doc(db, "aemetProvinceStationMap", selectedRegionId);
             // console.log("Fetching IDEMA from Firestore path:", stationMapDocRef.path); 
@@ -332,16 +429,27 @@ async function fetchAndDisplayRealtimeAemetSimulated() {
         return;
     }
 
-    realtimeAemetStatusMessage.textContent = `Cargando observación (simulada) para ${selectedRegionDisplayName} (IDEMA: ${idemaForRegion})...`;
+    realtimeAemetStatusMessage.textContent = `Cargando observación para ${selectedRegionDisplayName} (IDEMA: ${idemaForRegion})...`;
     // color is already orange
 
-    const response = await SIMULATED_getAemetRealtimeObservation(idemaForRegion);
+    // Observations uploaded by fetch_aemet_realtime.py (aemetRealtimeObservations/{idema}); the
+    // simulation is only used when the station has no uploaded data yet.
+    let response = regionBundle
+        ? (regionBundle.latestObservation
+            ? { status: 200, data: [regionBundle.latestObservation], description: "Éxito" }
+            : { status: 404, data: null, description: "Sin observaciones subidas para esta estación" })
+        : await getAemetRealtimeObservation(idemaForRegion);
+    let sourceLabel = "";
+    if (response?.status !== 200) {
+        response = await SIMULATED_getAemetRealtimeObservation(idemaForRegion);
+        sourceLabel = " (simulada)";
+    }
 
     if (response?.status === 200 && response.data?.length > 0) {
         const latestObservation = response.data[response.data.length - 1]; // Get the last (assumed latest) entry
-        console.log("Simulated AEMET observation data:", latestObservation); 
+        console.log("AEMET observation data:", latestObservation);
 
-        realtimeAemetStatusMessage.textContent = `Observación (simulada) para ${latestObservation.ubi || selectedRegionDisplayName}`;
+        realtimeAemetStatusMessage.textContent = `Observación${sourceLabel} para ${latestObservation.ubi || selectedRegionDisplayName}`;
         realtimeAemetStatusMessage.style.color = "green";
 
         rtStationNameSpan.textContent = latestObservation.ubi || "N/A";
@@ -352,13 +460,40 @@ async function fetchAndDisplayRealtimeAemetSimulated() {
         
         realtimeDataValuesDiv.style.display = 'block'; // Show data
     } else {
-        console.warn("Failed to get simulated AEMET data or data was empty. Response:", response);
-        realtimeAemetStatusMessage.textContent = `Error o no hay datos (simulados) para IDEMA ${idemaForRegion}. ${response?.description || ''}`;
+        console.warn("Failed to get AEMET data or data was empty. Response:", response);
+        realtimeAemetStatusMessage.textContent = `Error o no hay datos${sourceLabel} para IDEMA ${idemaForRegion}. ${response?.description || ''}`;
         realtimeAemetStatusMessage.style.color = "red";
         realtimeDataValuesDiv.style.display = 'none'; // Keep hidden
     }
 }
 
+// --- Real-time AEMET Observation from Firestore ---
+// Returns the same { status, data, description } shape as the simulation below, with
+// data rebuilt from the columnar "recent" rows of the station document (oldest first).
+async function getAemetRealtimeObservation(idema) {
+    try {
+        const stationSnap = await getDoc(doc(db, "aemetRealtimeObservations", idema));
+        if (!stationSnap.exists()) {
+            return { status: 404, data: null, description: "Sin observaciones subidas para esta estación" };
+        }
+        const stationDoc = stationSnap.data();
+        const recent = stationDoc.recent || {};
+        const times = recent.fint || [];
+        const rows = times.map((fint, i) => {
+            const row = { ...(stationDoc.station || {}), fint };
+            for (const [field, values] of Object.entries(recent)) {
+                if (field !== 'fint' && values[i] !== null && values[i] !== undefined) row[field] = values[i];
+            }
+            return row;
+        });
+        if (!rows.length && stationDoc.latest) rows.push(stationDoc.latest);
+        return { status: 200, data: rows, description: "Éxito" };
+    } catch (error) {
+        console.error("Error fetching AEMET observations from Firestore:", error);
+        return { status: 500, data: null, description: "Error leyendo las observaciones" };
+    }
+}
+
 // --- Real-time AEMET Observation Logic (Using Simulation) ---
 // This is your proven simulation logic, slightly adapted for the new structure
 async function SIMULATED_getAemetRealtimeObservation(idema) {
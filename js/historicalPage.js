@@ -50,6 +50,12 @@ async function fetchRegionDisplayNameHistorical() {
     let displayName = selectedRegionIdHistorical.replace(/_/g, ' '); 
     if (!selectedRegionIdHistorical) return;
     try {
+        // Region bundle written by materialize_region_bundle.py: the display name in one read
+        const bundleSnap = await getDoc(doc(db, "regionBundle", selectedRegionIdHistorical));
+        if (bundleSnap.exists() && bundleSnap.data().displayName) {
+            selectedRegionDisplayNameHistorical = bundleSnap.data().displayName;
+            return;
+        }
         const stationMapDocRef = doc(db, "aemetProvinceStationMap", selectedRegionIdHistorical);
         const stationSnap = await getDoc(stationMapDocRef);
         if (stationSnap.exists() && stationSnap.data().provincia) {
@@ -0,0 +1,217 @@
+import firebase_admin
+from firebase_admin import credentials, firestore
+from document_store import uses_local_backend, get_local_document_store
+from bulk_writer import BulkWriter
+from water_balance import WaterBalanceModel
+import telemetry
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import argparse
+
+# --- Per-region dashboard bundle ---
+# region-dashboard.html and historical-data.html used to chain several reads per
+# page load (station map, regions metadata, sensor data, historical data). This
+# script denormalizes everything they show into one document per region:
+#
+#   regionBundle/{regionId}
+#     displayName, type          from aemetProvinceStationMap / metadata/regionsWithType
+#     station                    the station mapped to the region (idema, nombre, provincia, ...)
+#     latestObservation          latest AEMET observation of that station (aemetRealtimeObservations)
+#     sensorSummary              latest sensor reading of the region (sensorRegions), or the latest
+#                                global reading when the region has none (sensorSummarySource); the
+#                                dashboard reads sensorRegions live and only falls back to this copy
+#     historical                 monthly values of the climatology (or of the reference year), so the
+#                                page picks the current month without another read
+#     recommendations            server-side advice and alerts (regionRecommendations, recommendation_engine.py)
+#     waterBalance               irrigation need until December (p50 / dry-year p90 per crop and soil
+#                                capacity), starting from the region's sensor humidity (water_balance.py)
+#
+# Run after every ingest or upload (fetch_aemet_realtime.py, upload_all_aemet_data.py,
+# import_requestsIDEMAs.py and ingestion_daemon.py do it themselves):
+#
+#   python materialize_region_bundle.py [--regions MADRID,VALLADOLID]
+
+SERVICE_ACCOUNT_KEY_PATH = "sensorizacao-e-ambiente-51347-firebase-adminsdk-fbsvc-d6499a3058.json"
+BUNDLE_COLLECTION = "regionBundle"
+BUNDLE_VERSION = 1
+STATION_MAP_COLLECTION = "aemetProvinceStationMap"
+OBSERVATIONS_COLLECTION = "aemetRealtimeObservations"
+SENSOR_REGIONS_COLLECTION = "sensorRegions"
+SENSOR_COLLECTION = "sensorData"
+RECOMMENDATIONS_COLLECTION = "regionRecommendations"
+HISTORICAL_COLLECTION = "aemetHistoricalData"
+CLIMATOLOGY_PARAMETER = "AD25mm_Provincia" # Same parameter and fallback as js/dashboardPage.js
+REFERENCE_PARAMETER = "AD25mm_Provincia"
+REFERENCE_YEAR = "2020"
+READ_WORKERS = 8 # Concurrent per-region reads
+DATA_ROOT = "./aemetDATA/" # Forcing of the water balance projection
+STORE_PATH = "aemet_historical.arrow" # Used instead of the CSVs when compiled (aemet_store.py)
+
+_water_balance_model = None
+
+# --- Firebase Setup ---
+def initialize_firebase():
+    """Initializes Firebase Admin SDK and returns the Firestore client."""
+    if uses_local_backend(): # STORAGE_BACKEND=sqlite|memory (see document_store.py)
+        return get_local_document_store()
+    try:
+        cred = credentials.Certificate(SERVICE_ACCOUNT_KEY_PATH)
+        if not firebase_admin._apps:
+            firebase_admin.initialize_app(cred)
+        db_client = firestore.client()
+        print("Successfully connected to Firebase Firestore.")
+        return db_client
+    except Exception as e:
+        print(f"Error initializing Firebase: {e}")
+        return None
+
+# --- Reads ---
+def _get(db_client, path):
+    snapshot = db_client.document(path).get()
+    return snapshot.to_dict() if snapshot.exists else None
+
+def load_regions(db_client):
+    """{regionId: type or None} for every region known to the metadata, the station map or the sensors."""
+    regions = {}
+    metadata = _get(db_client, "metadata/regionsWithType") or {}
+    for region in metadata.get('allRegionsInfo') or []:
+        if region.get('id'):
+            regions[region['id']] = region.get('type')
+    for collection_name in (STATION_MAP_COLLECTION, SENSOR_REGIONS_COLLECTION, RECOMMENDATIONS_COLLECTION):
+        for doc in db_client.collection(collection_name).stream():
+            regions.setdefault(doc.id, None)
+    return regions
+
+def load_latest_global_sensor_reading(db_client):
+    """Latest reading of the whole sensorData collection (the dashboard's fallback for regions without sensors)."""
+    query = db_client.collection(SENSOR_COLLECTION).order_by("sensor_timestamp", direction=firestore.Query.DESCENDING).limit(1)
+    for doc in query.stream():
+        return doc.to_dict()
+    return None
+
+def load_historical(db_client, region_id):
+    """Monthly values of the region's climatology, or of the reference year when there is no climatology."""
+    climatology = _get(db_client, f"{HISTORICAL_COLLECTION}/{region_id}/climatology/{CLIMATOLOGY_PARAMETER}")
+    if climatology and climatology.get('monthlyMean'):
+        years = climatology.get('years') or []
+        return {
+            'monthlyValues': climatology['monthlyMean'],
+            'period': f"{years[0]}-{years[-1]}" if years else REFERENCE_YEAR,
+            'parameter': climatology.get('parameterCodeUsed') or CLIMATOLOGY_PARAMETER,
+            'region': climatology.get('regionOriginal'),
+        }
+    reference = _get(db_client, f"{HISTORICAL_COLLECTION}/{region_id}/{REFERENCE_PARAMETER}/{REFERENCE_YEAR}")
+    if reference and reference.get('monthlyValues'):
+        return {
+            'monthlyValues': reference['monthlyValues'],
+            'period': REFERENCE_YEAR,
+            'parameter': REFERENCE_PARAMETER,
+            'region': reference.get('regionOriginal'),
+        }
+    return None
+
+def get_water_balance_model():
+    """The water balance model of the local historical data, loaded once per process; None if unavailable."""
+    global _water_balance_model
+    if _water_balance_model is None:
+        try:
+            model = WaterBalanceModel.load(DATA_ROOT, STORE_PATH)
+        except Exception as e:
+            print(f"Water balance not available ({e}); bundles are written without it.")
+            model = False
+        _water_balance_model = model if model and model.keys else False
+    return _water_balance_model or None
+
+def project_water_balance(model, region_id, sensor_doc, start_month):
+    """Irrigation need from start_month, from the region's own sensor humidity if any (else the observed soil moisture)."""
+    humidity = ((sensor_doc or {}).get('latest') or {}).get('humedad')
+    projection = model.project(region_id, start_month, humidity)
+    if projection is None:
+        return None
+    return {
+        'startMonth': start_month + 1,
+        'initialHumidity': humidity,
+        'crops': {crop: {capacity: {key: value for key, value in entry.items() if key != 'perYear'}
+                         for capacity, entry in by_capacity.items()}
+                  for crop, by_capacity in projection.items()},
+    }
+
+# --- Bundle ---
+def build_region_bundle(region_id, region_type, station, observation_doc, sensor_doc, global_sensor_reading, historical,
+                        recommendations=None, water_balance=None):
+    """The regionBundle document of one region from the documents it summarizes (any of them may be None)."""
+    display_name = (station or {}).get('provincia') or region_id.replace('_', ' ')
+    sensor_summary, sensor_source = None, None
+    if sensor_doc and sensor_doc.get('latest'):
+        latest = dict(sensor_doc['latest'])
+        latest['sensor_timestamp'] = latest.pop('t', None)
+        sensor_summary, sensor_source = latest, 'region'
+    elif global_sensor_reading:
+        sensor_summary, sensor_source = global_sensor_reading, 'global'
+    return {
+        'version': BUNDLE_VERSION,
+        'regionId': region_id,
+        'displayName': display_name,
+        'type': region_type,
+        'station': station,
+        'latestObservation': (observation_doc or {}).get('latest'),
+        'sensorSummary': sensor_summary,
+        'sensorSummarySource': sensor_source,
+        'sensorCount': len((sensor_doc or {}).get('sensors') or {}),
+        'historical': historical,
+        'recommendations': recommendations,
+        'waterBalance': water_balance,
+        'updatedAt': firestore.SERVER_TIMESTAMP,
+    }
+
+def _read_region(db_client, region_id, region_type, global_sensor_reading, model=None):
+    station = _get(db_client, f"{STATION_MAP_COLLECTION}/{region_id}")
+    observation_doc = _get(db_client, f"{OBSERVATIONS_COLLECTION}/{station['idema']}") if station and station.get('idema') else None
+    sensor_doc = _get(db_client, f"{SENSOR_REGIONS_COLLECTION}/{region_id}")
+    historical = load_historical(db_client, region_id)
+    recommendations = _get(db_client, f"{RECOMMENDATIONS_COLLECTION}/{region_id}")
+    water_balance = project_water_balance(model, region_id, sensor_doc, datetime.now().month - 1) if model else None
+    return build_region_bundle(region_id, region_type, station, observation_doc, sensor_doc,
+                               global_sensor_reading, historical, recommendations, water_balance)
+
+def materialize_region_bundles(db_client, region_ids=None):
+    """
+    Rebuilds regionBundle/{regionId} for the given regions (all known regions
+    by default). Returns the number of bundles written; errors are printed.
+    """
+    try:
+        with telemetry.timed("bundle_reads", collection=BUNDLE_COLLECTION):
+            regions = load_regions(db_client)
+            if region_ids:
+                regions = {region_id: regions.get(region_id) for region_id in region_ids}
+            if not regions:
+                print("No regions found. No bundles written.")
+                return 0
+            global_sensor_reading = load_latest_global_sensor_reading(db_client)
+            model = get_water_balance_model()
+            with ThreadPoolExecutor(max_workers=READ_WORKERS) as executor:
+                bundles = list(executor.map(
+                    lambda item: _read_region(db_client, item[0], item[1], global_sensor_reading, model), regions.items()))
+    except Exception as e:
+        print(f"Error reading the documents summarized by the region bundles: {e}")
+        return 0
+
+    with BulkWriter(db_client) as writer:
+        for bundle in bundles:
+            writer.set(db_client.collection(BUNDLE_COLLECTION).document(bundle['regionId']), bundle)
+    print(f"Materialized {writer.written} of {len(bundles)} region bundles in '{BUNDLE_COLLECTION}'.")
+    return writer.written
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Writes the per-region dashboard bundle documents (regionBundle/{regionId}).")
+    parser.add_argument("--regions", default=None, help="Comma-separated region IDs (default: every known region).")
+    args = parser.parse_args()
+    telemetry.configure_from_env("materialize_region_bundle")
+
+    print(f"--- Materializing region bundles ({datetime.now()}) ---")
+    db = initialize_firebase()
+    if db is None:
+        exit()
+    region_ids = [r.strip() for r in args.regions.split(',') if r.strip()] if args.regions else None
+    materialize_region_bundles(db, region_ids)
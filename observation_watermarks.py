@@ -0,0 +1,76 @@
+import json
+import os
+
+# --- Last-seen observation per station ---
+# fetch_aemet_realtime.py only writes a station when AEMET has published an
+# observation newer than the one already stored. The newest 'fint' written per
+# station (the watermark) and the field values of that write are kept in a local
+# state file, and merged on startup with what is already in Firestore, so a fresh
+# checkout or a second machine does not rewrite every station.
+
+DEFAULT_STATE_PATH = ".aemet_realtime_state.json"
+TIMESTAMP_FIELD = 'observationTimeUTC' # Field of the realtime documents holding the observation 'fint'
+UNTRACKED_FIELDS = {'lastUpdatedFirebase'} # Written on every change, never compared
+
+class WatermarkStore:
+    """Per-station {'fint': newest observation written, 'fields': values of the last write}."""
+
+    def __init__(self, state_path=DEFAULT_STATE_PATH):
+        self.state_path = state_path
+        self.stations = {}
+        self.load()
+
+    def load(self):
+        if not self.state_path or not os.path.exists(self.state_path):
+            return
+        try:
+            with open(self.state_path, 'r', encoding='utf-8') as f:
+                self.stations = json.load(f).get('stations', {})
+        except (OSError, ValueError) as e:
+            print(f"Could not read watermark state '{self.state_path}' ({e}). Starting from Firestore only.")
+            self.stations = {}
+
+    def save(self):
+        """Writes the state to a temporary file and renames it, so an interrupted run never leaves it corrupt."""
+        if not self.state_path:
+            return
+        tmp_path = self.state_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'stations': self.stations}, f, ensure_ascii=False, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.state_path)
+
+    def seed_from_firestore(self, db_client, collection):
+        """Takes the watermark of every station document in `collection` that is newer than the local one."""
+        seeded = 0
+        try:
+            for doc in db_client.collection(collection).stream():
+                data = doc.to_dict() or {}
+                fint = data.get(TIMESTAMP_FIELD)
+                if fint and self.is_newer(doc.id, fint):
+                    fields = {k: v for k, v in data.items() if k not in UNTRACKED_FIELDS}
+                    self.stations[doc.id] = {'fint': fint, 'fields': fields}
+                    seeded += 1
+        except Exception as e:
+            print(f"Could not seed watermarks from '{collection}': {e}")
+            return 0
+        if seeded:
+            print(f"Seeded {seeded} station watermarks from Firestore collection '{collection}'.")
+        return seeded
+
+    def last_fint(self, station_idema):
+        return self.stations.get(station_idema, {}).get('fint')
+
+    def is_newer(self, station_idema, fint):
+        # 'fint' values share one ISO format ('2025-05-13T00:00:00+0000'), so they compare as strings
+        last = self.last_fint(station_idema)
+        return last is None or fint > last
+
+    def changed_fields(self, station_idema, record):
+        """The entries of `record` that differ from the last write of the station (untracked fields always included)."""
+        previous = self.stations.get(station_idema, {}).get('fields', {})
+        return {k: v for k, v in record.items() if k in UNTRACKED_FIELDS or previous.get(k) != v}
+
+    def advance(self, station_idema, fint, record):
+        fields = dict(self.stations.get(station_idema, {}).get('fields', {}))
+        fields.update({k: v for k, v in record.items() if k not in UNTRACKED_FIELDS})
+        self.stations[station_idema] = {'fint': fint, 'fields': fields}
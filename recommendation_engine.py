@@ -0,0 +1,532 @@
+import numpy as np
+import firebase_admin
+from firebase_admin import credentials, firestore
+from document_store import uses_local_backend, get_local_document_store
+from bulk_writer import BulkWriter
+from aemet_csv_parser import MONTH_NAMES_STANDARD
+from sensor_timeseries import METRICS
+import telemetry
+from datetime import datetime, timezone
+import argparse
+import threading
+import time
+
+# --- Server-side recommendation engine over the sensor stream ---
+# Evaluates the pH / humidity / temperature rules of js/dashboardPage.js for every
+# sensor at once, as NumPy operations over each incoming batch of readings, and
+# writes the resulting advice per region:
+#
+#   regionRecommendations/{regionId}
+#     summary            mean of the latest reading of every sensor in the region
+#     recommendations    the same texts the dashboard generated in the browser (ALERTA/AVISO/INFO ...)
+#     alerts             active rules with the number (and some ids) of the sensors raising them
+#
+# Every sensor keeps running statistics per metric (count, mean and variance,
+# merged batch by batch with Welford/Chan's parallel update, plus a short-term
+# exponential mean), so the trend rules compare the recent level with the
+# sensor's own history. An alert only turns on after its rule held for
+# DEBOUNCE_EVALUATIONS consecutive evaluations of the sensor and only turns off
+# after as many evaluations without it; region documents are rewritten when
+# their alerts change, or at most every MIN_WRITE_INTERVAL_SECONDS otherwise.
+#
+#   engine = RecommendationEngine(db)      # add()/flush()/close() like the sensor writers
+#   engine.add(reading)                    # {'regionId', 'sensorId', 'temperatura', 'humedad', 'ph', 'sensor_timestamp'}
+#
+#   python recommendation_engine.py        # follows the flat sensorData collection
+#   python simulateSensor.py --load --recommendations
+
+SERVICE_ACCOUNT_KEY_PATH = "sensorizacao-e-ambiente-51347-firebase-adminsdk-fbsvc-d6499a3058.json"
+RECOMMENDATIONS_COLLECTION = "regionRecommendations"
+SENSOR_COLLECTION = "sensorData"
+BUNDLE_COLLECTION = "regionBundle" # Historical monthly values per region (materialize_region_bundle.py)
+
+# Thresholds of generateEnhancedRecommendations (js/dashboardPage.js)
+PH_LOW = 5.5
+PH_HIGH = 7.8
+HUMIDITY_CRITICAL = 25.0
+HUMIDITY_LOW = 40.0
+HUMIDITY_HIGH = 85.0
+HISTORICAL_DRY_FACTOR = 0.6
+HISTORICAL_WET_FACTOR = 1.4
+TEMPERATURE_HIGH = 38.0
+TEMPERATURE_LOW = 5.0
+
+# Trend rules over the per-sensor running statistics
+EWMA_ALPHA = 0.2 # Weight of each new reading in the short-term mean
+TREND_MIN_READINGS = 30 # Readings of history before a trend rule can fire
+TREND_STD = 1.5 # Short-term mean this many standard deviations from the sensor's mean
+ANOMALY_STD = 3.0 # Latest reading this many standard deviations from the sensor's mean
+
+DEBOUNCE_EVALUATIONS = 3
+MIN_WRITE_INTERVAL_SECONDS = 60.0
+MAX_SENSOR_IDS_PER_ALERT = 10
+DEFAULT_FLUSH_SIZE = 5000
+DEFAULT_FLUSH_INTERVAL = 5.0
+POLL_PAGE_SIZE = 5000
+
+TEMPERATURE, HUMIDITY, PH = (METRICS.index(name) for name in ('temperatura', 'humedad', 'ph'))
+
+# (rule id, level, message); a sensor's flags follow this order
+RULES = (
+    ('ph_acido', 'ALERTA', "pH muy bajo (ácido). Considere aplicar cal."),
+    ('ph_alcalino', 'ALERTA', "pH muy alto (alcalino). Considere aplicar azufre."),
+    ('humedad_muy_baja', 'ALERTA', "Humedad MUY BAJA. ¡RIEGO URGENTE!"),
+    ('humedad_baja', 'AVISO', "Humedad baja. Considerar riego."),
+    ('humedad_muy_alta', 'ALERTA', "Humedad MUY ALTA. ¡Verificar drenaje!"),
+    ('mas_seco_que_historico', 'ALERTA', "Mucho más seco que el promedio histórico del mes."),
+    ('mas_humedo_que_historico', 'ALERTA', "Mucho más húmedo que el promedio histórico del mes."),
+    ('temperatura_muy_alta', 'ALERTA', "Temperatura muy alta. Asegure humedad y considere sombreo."),
+    ('temperatura_muy_baja', 'AVISO', "Temperatura muy baja. Proteger de heladas."),
+    ('humedad_descendiendo', 'AVISO', "La humedad está bajando respecto a lo habitual del sensor."),
+    ('temperatura_anomala', 'AVISO', "Temperatura fuera de lo habitual del sensor."),
+)
+
+
+def _reading_time(reading):
+    ts = reading.get('sensor_timestamp') or reading.get('t')
+    if isinstance(ts, datetime):
+        return (ts if ts.tzinfo else ts.replace(tzinfo=timezone.utc)).timestamp()
+    return time.time()
+
+def _metric_value(reading, metric):
+    value = reading.get(metric)
+    return float(value) if isinstance(value, (int, float)) else np.nan
+
+
+def evaluate_rules(latest, mean, std, ewma, count, historical):
+    """
+    Flags (sensors x RULES) from arrays of shape (sensors, METRICS): the latest
+    values, the running mean, standard deviation and short-term mean and the
+    number of readings. historical holds the monthly humidity mean of each
+    sensor's region (NaN when unknown). NaN never raises a rule.
+    """
+    temperature, humidity, ph = latest[:, TEMPERATURE], latest[:, HUMIDITY], latest[:, PH]
+    with np.errstate(invalid='ignore'):
+        trend_ready = count >= TREND_MIN_READINGS
+        return np.column_stack([
+            ph < PH_LOW,
+            ph > PH_HIGH,
+            humidity < HUMIDITY_CRITICAL,
+            (humidity >= HUMIDITY_CRITICAL) & (humidity < HUMIDITY_LOW),
+            humidity > HUMIDITY_HIGH,
+            humidity < historical * HISTORICAL_DRY_FACTOR,
+            humidity > historical * HISTORICAL_WET_FACTOR,
+            temperature > TEMPERATURE_HIGH,
+            temperature < TEMPERATURE_LOW,
+            trend_ready[:, HUMIDITY] & (ewma[:, HUMIDITY] < mean[:, HUMIDITY] - TREND_STD * std[:, HUMIDITY]),
+            trend_ready[:, TEMPERATURE] & (np.abs(temperature - mean[:, TEMPERATURE]) > ANOMALY_STD * std[:, TEMPERATURE]),
+        ])
+
+def generate_recommendations(reading, historical_context=None):
+    """
+    Python port of generateEnhancedRecommendations (js/dashboardPage.js): the
+    advice texts for one reading and whether any of them is an issue.
+    historical_context: {'value', 'month', 'region'} or None.
+    """
+    recommendations = []
+    issues_found = False
+
+    ph = reading.get('ph')
+    if ph is not None:
+        if ph < PH_LOW:
+            recommendations.append(f"ALERTA pH: El pH ({ph:.1f}) es muy bajo (ácido). Considere aplicar cal.")
+            issues_found = True
+        elif ph > PH_HIGH:
+            recommendations.append(f"ALERTA pH: El pH ({ph:.1f}) es muy alto (alcalino). Considere aplicar azufre.")
+            issues_found = True
+        else:
+            recommendations.append(f"INFO pH: El pH del suelo ({ph:.1f}) está en rango aceptable.")
+
+    humidity = reading.get('humedad')
+    if humidity is not None:
+        text = f"INFO Humedad: Actual {humidity:.1f}%. "
+        if humidity < HUMIDITY_CRITICAL:
+            text += "Nivel MUY BAJO. ¡RIEGO URGENTE!"
+            issues_found = True
+        elif humidity < HUMIDITY_LOW:
+            text += "Nivel bajo. Considerar riego."
+        elif humidity > HUMIDITY_HIGH:
+            text += "Nivel MUY ALTO. ¡Verificar drenaje!"
+            issues_found = True
+        if historical_context and historical_context.get('value') is not None:
+            value = historical_context['value']
+            region = str(historical_context.get('region') or '').split('(')[0].strip()
+            text += f" (Promedio hist. {historical_context['month']} en {region}: {value:.1f}%)."
+            if humidity < value * HISTORICAL_DRY_FACTOR:
+                text += " ¡Mucho más seco que el promedio!"
+                issues_found = True
+            elif humidity > value * HISTORICAL_WET_FACTOR:
+                text += " ¡Mucho más húmedo que el promedio!"
+                issues_found = True
+        recommendations.append(text)
+
+    temperature = reading.get('temperatura')
+    if temperature is not None:
+        if temperature > TEMPERATURE_HIGH:
+            recommendations.append(f"ALERTA Temp: ({temperature:.1f}°C) muy alta. Asegure humedad y considere sombreo.")
+            issues_found = True
+        elif temperature < TEMPERATURE_LOW:
+            recommendations.append(f"AVISO Temp: ({temperature:.1f}°C) muy baja. Proteger de heladas.")
+        else:
+            recommendations.append(f"INFO Temp: ({temperature:.1f}°C) en rango normal.")
+    return recommendations, issues_found
+
+def load_historical_contexts(db_client, month=None):
+    """{regionId: {'value', 'month', 'region'}} for the current month, from the region bundles."""
+    month = month or MONTH_NAMES_STANDARD[datetime.now().month - 1]
+    contexts = {}
+    try:
+        for doc in db_client.collection(BUNDLE_COLLECTION).stream():
+            bundle = doc.to_dict() or {}
+            historical = bundle.get('historical') or {}
+            value = (historical.get('monthlyValues') or {}).get(month)
+            if value is not None:
+                contexts[doc.id] = {'value': value, 'month': month,
+                                    'region': historical.get('region') or bundle.get('displayName') or doc.id}
+    except Exception as e:
+        print(f"Could not load the historical context of the regions: {e}")
+    return contexts
+
+
+class SensorStatistics:
+    """
+    Per-sensor state as (sensors x METRICS) arrays: reading count, running mean
+    and sum of squared deviations (Welford), short-term exponential mean, latest
+    value and its time. Rows are added as new sensors appear.
+    """
+
+    def __init__(self, capacity=1024):
+        self.rows = {} # sensorId -> row
+        self.sensor_ids = []
+        self.regions = [] # region of each row
+        self.size = 0
+        self._allocate(capacity)
+
+    def _allocate(self, capacity):
+        shape = (capacity, len(METRICS))
+        previous = getattr(self, 'count', None)
+        arrays = {'count': np.zeros(shape), 'mean': np.zeros(shape), 'm2': np.zeros(shape),
+                  'ewma': np.full(shape, np.nan), 'latest': np.full(shape, np.nan),
+                  'latest_time': np.full(shape, -np.inf)}
+        if previous is not None:
+            for name, array in arrays.items():
+                array[:len(previous)] = getattr(self, name)
+        for name, array in arrays.items():
+            setattr(self, name, array)
+
+    def row_indices(self, sensor_ids, region_ids):
+        """Row of every reading's sensor, registering the new ones."""
+        rows = np.empty(len(sensor_ids), dtype=np.int64)
+        for i, (sensor_id, region_id) in enumerate(zip(sensor_ids, region_ids)):
+            row = self.rows.get(sensor_id)
+            if row is None:
+                row = self.rows[sensor_id] = self.size
+                self.sensor_ids.append(sensor_id)
+                self.regions.append(region_id)
+                self.size += 1
+            else:
+                self.regions[row] = region_id # A sensor moved to another region
+            rows[i] = row
+        if self.size > len(self.count):
+            self._allocate(max(self.size, 2 * len(self.count)))
+        return rows
+
+    def update(self, rows, values, times):
+        """
+        Merges a batch (rows, values of shape (readings x METRICS) with NaN for
+        missing metrics, times in epoch seconds) into the running statistics.
+        Returns the rows touched.
+        """
+        touched = np.unique(rows)
+        order = np.argsort(times, kind='stable')
+        rows, values, times = rows[order], values[order], times[order]
+        for j in range(len(METRICS)):
+            valid = ~np.isnan(values[:, j])
+            batch_rows, batch_values = rows[valid], values[valid, j]
+            if not len(batch_rows):
+                continue
+            # Count, mean and M2 of the batch per sensor, combined with the running
+            # ones through Chan et al.'s parallel form of Welford's update
+            batch_count = np.bincount(batch_rows, minlength=self.size)[touched].astype(float)
+            batch_sum = np.bincount(batch_rows, weights=batch_values, minlength=self.size)[touched]
+            has_batch = batch_count > 0
+            batch_mean = np.divide(batch_sum, batch_count, out=np.zeros_like(batch_sum), where=has_batch)
+            mean_by_row = np.zeros(self.size)
+            mean_by_row[touched] = batch_mean
+            batch_m2 = np.bincount(batch_rows, weights=(batch_values - mean_by_row[batch_rows]) ** 2,
+                                   minlength=self.size)[touched]
+
+            count, mean = self.count[touched, j], self.mean[touched, j]
+            total = count + batch_count
+            delta = batch_mean - mean
+            safe_total = np.where(total > 0, total, 1.0)
+            self.mean[touched, j] = np.where(has_batch, mean + delta * batch_count / safe_total, mean)
+            self.m2[touched, j] += np.where(has_batch, batch_m2 + delta ** 2 * count * batch_count / safe_total, 0.0)
+            self.count[touched, j] = total
+
+            # Short-term mean: k readings weigh as k exponential steps towards the batch mean
+            decay = (1.0 - EWMA_ALPHA) ** batch_count
+            ewma = self.ewma[touched, j]
+            self.ewma[touched, j] = np.where(~has_batch, ewma,
+                                             np.where(np.isnan(ewma), batch_mean, ewma * decay + batch_mean * (1.0 - decay)))
+
+            # Latest value: the last valid reading of each sensor in time order
+            last_position = np.full(self.size, -1)
+            np.maximum.at(last_position, batch_rows, np.arange(len(batch_rows)))
+            positions = last_position[touched]
+            newer = (positions >= 0) & (times[valid][np.maximum(positions, 0)] >= self.latest_time[touched, j])
+            self.latest[touched[newer], j] = batch_values[positions[newer]]
+            self.latest_time[touched[newer], j] = times[valid][positions[newer]]
+        return touched
+
+    def std(self, rows):
+        count = self.count[rows]
+        return np.sqrt(np.divide(self.m2[rows], count - 1, out=np.zeros_like(count), where=count > 1))
+
+
+class RecommendationEngine:
+    """
+    Buffers readings and, on every flush, updates the sensors' statistics,
+    evaluates the rules for the sensors in the batch, debounces their alerts
+    and writes the regions whose advice changed. Thread-safe.
+    """
+
+    def __init__(self, db_client, collection=RECOMMENDATIONS_COLLECTION, flush_size=DEFAULT_FLUSH_SIZE,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL, debounce=DEBOUNCE_EVALUATIONS,
+                 min_write_interval=MIN_WRITE_INTERVAL_SECONDS, historical_contexts=None):
+        self.db = db_client
+        self.collection = collection
+        self.flush_size = max(1, flush_size)
+        self.flush_interval = flush_interval
+        self.debounce = max(1, debounce)
+        self.min_write_interval = min_write_interval
+        self.historical_contexts = historical_contexts if historical_contexts is not None else load_historical_contexts(db_client)
+        self.stats = SensorStatistics()
+        self._on_streak = np.zeros((len(self.stats.count), len(RULES)), dtype=np.int32)
+        self._off_streak = np.zeros_like(self._on_streak)
+        self._active = np.zeros(self._on_streak.shape, dtype=bool)
+        self._active_since = np.full(self._on_streak.shape, np.nan)
+        self._region_signatures = {} # regionId -> alerts last written
+        self._region_written_at = {} # regionId -> time.monotonic() of the last write
+        self._buffer = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock() # One evaluation at a time keeps the streaks in order
+        self.processed = 0
+        self.evaluations = 0
+        self.region_writes = 0
+        self._stop = threading.Event()
+        self._timer = threading.Thread(target=self._flush_periodically, daemon=True)
+        self._timer.start()
+
+    def add(self, reading):
+        if not reading.get('regionId') or not reading.get('sensorId'):
+            return
+        with self._lock:
+            self._buffer.append(reading)
+            should_flush = len(self._buffer) >= self.flush_size
+        if should_flush:
+            self.flush()
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                readings, self._buffer = self._buffer, []
+            if not readings:
+                return
+            with telemetry.timed("recommendations"):
+                self.process_batch([r['sensorId'] for r in readings], [r['regionId'] for r in readings],
+                                   np.array([[_metric_value(r, metric) for metric in METRICS] for r in readings]),
+                                   np.array([_reading_time(r) for r in readings]))
+
+    def close(self):
+        """Evaluates the pending readings and stops the periodic flush."""
+        self._stop.set()
+        self._timer.join()
+        self.flush()
+
+    def _flush_periodically(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def _grow_state(self):
+        capacity = len(self.stats.count)
+        if capacity == len(self._active):
+            return
+        for name in ('_on_streak', '_off_streak', '_active', '_active_since'):
+            array = getattr(self, name)
+            fill = np.nan if name == '_active_since' else 0
+            grown = np.full((capacity, len(RULES)), fill, dtype=array.dtype)
+            grown[:len(array)] = array
+            setattr(self, name, grown)
+
+    def process_batch(self, sensor_ids, region_ids, values, times):
+        """Evaluates one batch given as arrays; returns the number of region documents written."""
+        stats = self.stats
+        rows = stats.row_indices(sensor_ids, region_ids)
+        self._grow_state()
+        touched = stats.update(rows, values, times)
+        regions = np.array([stats.regions[row] for row in touched], dtype=object)
+
+        historical = np.array([(self.historical_contexts.get(region) or {}).get('value', np.nan) for region in regions],
+                              dtype=float)
+        flags = evaluate_rules(stats.latest[touched], stats.mean[touched], stats.std(touched),
+                               stats.ewma[touched], stats.count[touched], historical)
+
+        # Debounce: a rule turns on/off after `debounce` consecutive evaluations agreeing
+        self._on_streak[touched] = np.where(flags, self._on_streak[touched] + 1, 0)
+        self._off_streak[touched] = np.where(flags, 0, self._off_streak[touched] + 1)
+        was_active = self._active[touched]
+        active = (was_active | (self._on_streak[touched] >= self.debounce)) & ~(self._off_streak[touched] >= self.debounce)
+        self._active[touched] = active
+        now = time.time()
+        self._active_since[touched] = np.where(active & ~was_active, now,
+                                               np.where(active, self._active_since[touched], np.nan))
+
+        self.processed += len(rows)
+        self.evaluations += len(touched)
+        telemetry.inc("rows_total", len(rows), source="recommendations")
+        return self._write_regions(set(regions))
+
+    def region_document(self, region_id, region_rows):
+        """The regionRecommendations document of one region from the state of all its sensors (their rows)."""
+        stats = self.stats
+        latest = stats.latest[region_rows]
+        with np.errstate(invalid='ignore'):
+            summary_values = [np.nanmean(latest[:, j]) if np.any(~np.isnan(latest[:, j])) else None
+                              for j in range(len(METRICS))]
+        summary = {metric: round(float(value), 2) for metric, value in zip(METRICS, summary_values) if value is not None}
+        recommendations, issues_found = generate_recommendations(summary, self.historical_contexts.get(region_id))
+
+        alerts = []
+        active = self._active[region_rows]
+        for r, (rule_id, level, message) in enumerate(RULES):
+            sensors = region_rows[active[:, r]]
+            if not len(sensors):
+                continue
+            alerts.append({
+                'rule': rule_id,
+                'level': level,
+                'message': message,
+                'sensors': int(len(sensors)),
+                'sensorIds': [stats.sensor_ids[row] for row in sensors[:MAX_SENSOR_IDS_PER_ALERT]],
+                'since': datetime.fromtimestamp(float(np.nanmin(self._active_since[sensors, r])), timezone.utc),
+            })
+        return {
+            'regionId': region_id,
+            'sensorCount': int(len(region_rows)),
+            'summary': summary,
+            'recommendations': recommendations,
+            'issuesFound': issues_found or any(alert['level'] == 'ALERTA' for alert in alerts),
+            'alerts': alerts,
+            'evaluatedAt': firestore.SERVER_TIMESTAMP,
+        }
+
+    def _write_regions(self, region_ids):
+        """Writes the regions whose alerts changed, or that were last written over min_write_interval ago."""
+        now = time.monotonic()
+        sensor_regions = np.array(self.stats.regions, dtype=object)
+        documents = []
+        for region_id in sorted(region_ids):
+            document = self.region_document(region_id, np.flatnonzero(sensor_regions == region_id))
+            signature = tuple((alert['rule'], alert['sensors']) for alert in document['alerts'])
+            last_written = self._region_written_at.get(region_id)
+            if (signature == self._region_signatures.get(region_id) and last_written is not None
+                    and now - last_written < self.min_write_interval):
+                continue
+            documents.append((region_id, signature, document))
+        if not documents:
+            return 0
+
+        with BulkWriter(self.db) as writer:
+            for region_id, signature, document in documents:
+                future = writer.set(self.db.collection(self.collection).document(region_id), document)
+                future.add_done_callback(self._region_written(region_id, signature, now))
+        self.region_writes += writer.written
+        return writer.written
+
+    def _region_written(self, region_id, signature, now):
+        def callback(future):
+            if future.exception() is None:
+                self._region_signatures[region_id] = signature
+                self._region_written_at[region_id] = now
+        return callback
+
+
+# --- Following the flat sensorData collection ---
+def initialize_firebase():
+    """Initializes Firebase Admin SDK and returns the Firestore client."""
+    if uses_local_backend(): # STORAGE_BACKEND=sqlite|memory (see document_store.py)
+        return get_local_document_store()
+    try:
+        cred = credentials.Certificate(SERVICE_ACCOUNT_KEY_PATH)
+        if not firebase_admin._apps:
+            firebase_admin.initialize_app(cred)
+        db_client = firestore.client()
+        print("Successfully connected to Firebase Firestore.")
+        return db_client
+    except Exception as e:
+        print(f"Error initializing Firebase: {e}")
+        return None
+
+def follow_sensor_data(db_client, engine, interval, since=None, once=False):
+    """
+    Feeds the engine with the sensorData readings newer than `since` (a
+    datetime), page by page, every `interval` seconds. Returns the time of the
+    last reading processed.
+
+    The cursor is inclusive ('>=') so readings that share the timestamp of the
+    last one processed are not skipped; the ids already seen at that timestamp
+    are remembered and left out, and the page grows by that many documents so
+    it always makes progress.
+    """
+    seen_at_since = set()
+    while True:
+        while True:
+            query = db_client.collection(SENSOR_COLLECTION)
+            if since is not None:
+                query = query.where('sensor_timestamp', '>=', since)
+            limit = POLL_PAGE_SIZE + len(seen_at_since)
+            snapshots = list(query.order_by('sensor_timestamp').limit(limit).stream())
+            new_snapshots = [snapshot for snapshot in snapshots if snapshot.id not in seen_at_since]
+            for snapshot in new_snapshots:
+                engine.add(snapshot.to_dict())
+            if new_snapshots:
+                last_timestamp = new_snapshots[-1].get('sensor_timestamp')
+                if last_timestamp != since:
+                    since = last_timestamp
+                    seen_at_since = set()
+                seen_at_since.update(snapshot.id for snapshot in new_snapshots
+                                     if snapshot.get('sensor_timestamp') == since)
+            if len(snapshots) < limit:
+                break
+        engine.flush()
+        if once:
+            return since
+        time.sleep(interval)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Evaluates the soil recommendation rules for every sensor and writes them per region.")
+    parser.add_argument("--interval", type=float, default=30.0, help="Seconds between polls of sensorData.")
+    parser.add_argument("--once", action="store_true", help="Process the readings available now and exit.")
+    parser.add_argument("--since-minutes", type=float, default=60.0,
+                        help="On start, also process the readings of the last N minutes (builds the statistics).")
+    parser.add_argument("--debounce", type=int, default=DEBOUNCE_EVALUATIONS,
+                        help="Consecutive evaluations before an alert turns on or off.")
+    args = parser.parse_args()
+    telemetry.configure_from_env("recommendation_engine")
+
+    db = initialize_firebase()
+    if db is None:
+        exit()
+    engine = RecommendationEngine(db, debounce=args.debounce)
+    since = datetime.fromtimestamp(time.time() - args.since_minutes * 60, timezone.utc)
+    print(f"Following '{SENSOR_COLLECTION}' from {since.isoformat(timespec='seconds')} "
+          f"({len(engine.historical_contexts)} regions with historical context).")
+    try:
+        follow_sensor_data(db, engine, args.interval, since=since, once=args.once)
+    except KeyboardInterrupt:
+        print("\nStopping the recommendation engine.")
+    finally:
+        engine.close()
+        print(f"Processed {engine.processed} readings; {engine.region_writes} region documents written.")
@@ -0,0 +1,383 @@
+import argparse
+import contextlib
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+# --- End-to-end benchmarks ---
+# Runs the main data paths offline, against local stand-ins, and writes the
+# measurements to a JSON file that can be compared with the one of a previous
+# version (--compare):
+#
+#   upload     upload_all_aemet_data over a synthetic aemetDATA/ tree scaled to --years years  -> rows/s
+#   realtime   fetch_aemet_realtime against fake_aemet_server.py with --stations stations      -> stations/s
+#   sensors    simulateSensor.py load test                                                     -> writes/s
+#   ask        IA/api_assistant.py /ask with fake_llm_server.py as the model                  -> p50/p95/p99 ms
+#
+# Writes go to the local document store (document_store.py, --backend memory or
+# sqlite) or to the Firestore emulator (--backend emulator), never to the real project.
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+IA_DIR = os.path.join(ROOT_DIR, "IA")
+DEFAULT_DATA_ROOT = os.path.join(ROOT_DIR, "aemetDATA")
+DEFAULT_RESULTS_PATH = "benchmark_results.json"
+BENCHMARKS = ("upload", "realtime", "sensors", "ask")
+FIRST_SYNTHETIC_YEAR = 1950
+BENCHMARK_API_KEY = "benchmark"
+DEFAULT_REGRESSION_THRESHOLD = 0.10 # Relative change reported as a regression by --compare
+
+# (benchmark, metric path, True if higher is better) compared by --compare
+HEADLINE_METRICS = [
+    ("upload", "rows_per_sec", True),
+    ("upload", "documents_per_sec", True),
+    ("realtime", "per_station.stations_per_sec", True),
+    ("realtime", "bulk.stations_per_sec", True),
+    ("sensors", "writes_per_sec", True),
+    ("ask", "latency_ms.p50", False),
+    ("ask", "latency_ms.p95", False),
+    ("ask", "latency_ms.p99", False),
+    ("ask", "requests_per_sec", True),
+]
+
+ASK_QUESTIONS = [
+    "¿Cuándo debo regar el maíz?",
+    "¿Qué hago si el pH del suelo es muy ácido?",
+    "¿Cómo protejo el cultivo de una helada?",
+    "¿Qué humedad del suelo es adecuada para el trigo?",
+    "¿Cómo afecta una ola de calor a los frutales?",
+    "¿Cuándo conviene abonar la vid?",
+]
+ASK_REGIONS = ["MADRID", "VALLADOLID", "A_CORUÑA", "SEVILLA"]
+
+
+def percentile(sorted_values, p):
+    """Percentile p (0-100) by linear interpolation over an already sorted list."""
+    if not sorted_values:
+        return None
+    k = (len(sorted_values) - 1) * p / 100.0
+    low = int(k)
+    high = min(low + 1, len(sorted_values) - 1)
+    return sorted_values[low] + (sorted_values[high] - sorted_values[low]) * (k - low)
+
+def latency_summary(seconds):
+    values = sorted(seconds)
+    summary = {f"p{p}": round(percentile(values, p) * 1000, 2) if values else None for p in (50, 95, 99)}
+    summary["max"] = round(values[-1] * 1000, 2) if values else None
+    return summary
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT_DIR,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+@contextlib.contextmanager
+def quiet(enabled):
+    """Silences the progress output of the benchmarked scripts (unless --verbose)."""
+    if not enabled:
+        yield
+        return
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+def open_store(backend, workdir, emulator=None):
+    """Document store the benchmarks write to; a fresh one for every benchmark."""
+    if backend == "emulator":
+        from simulateSensor import initialize_firestore
+        return initialize_firestore(emulator or os.environ.get("FIRESTORE_EMULATOR_HOST", "localhost:8080"),
+                                    "sensorizacao-e-ambiente-51347")
+    from document_store import MemoryDocumentStore, SQLiteDocumentStore
+    if backend == "sqlite":
+        fd, path = tempfile.mkstemp(suffix=".sqlite3", dir=workdir)
+        os.close(fd)
+        return SQLiteDocumentStore(path)
+    return MemoryDocumentStore()
+
+
+# --- upload_all_aemet_data ---
+def build_scaled_data_tree(source_root, target_root, years):
+    """
+    Copies the ebh_estadistica_anual_YYYY folders of source_root into target_root
+    as `years` consecutive synthetic years (reusing the real years in turn) and
+    returns the number of CSV data rows written.
+    """
+    source_years = sorted(int(name.rsplit('_', 1)[-1]) for name in os.listdir(source_root)
+                          if name.startswith("ebh_estadistica_anual_") and name.rsplit('_', 1)[-1].isdigit())
+    if not source_years:
+        raise ValueError(f"No ebh_estadistica_anual_YYYY folders in '{source_root}'.")
+    rows = 0
+    for i in range(years):
+        source_year = source_years[i % len(source_years)]
+        target_year = FIRST_SYNTHETIC_YEAR + i
+        source_dir = os.path.join(source_root, f"ebh_estadistica_anual_{source_year}")
+        target_dir = os.path.join(target_root, f"ebh_estadistica_anual_{target_year}")
+        os.makedirs(target_dir, exist_ok=True)
+        for filename in os.listdir(source_dir):
+            if not filename.endswith(".csv"):
+                continue
+            target_name = filename.replace(f"_{source_year}_", f"_{target_year}_", 1)
+            shutil.copyfile(os.path.join(source_dir, filename), os.path.join(target_dir, target_name))
+            with open(os.path.join(source_dir, filename), 'rb') as f:
+                rows += max(0, sum(1 for line in f if line.strip()) - 1) # minus the header
+    return rows
+
+def bench_upload(args, workdir):
+    import upload_all_aemet_data
+
+    data_root = os.path.join(workdir, "aemetDATA")
+    rows = build_scaled_data_tree(args.data_root, data_root, args.years)
+    upload_all_aemet_data.ALL_ENCOUNTERED_REGIONS_INFO.clear()
+    upload_all_aemet_data.initialize_firebase(db_client=open_store(args.backend, workdir, args.emulator))
+
+    start = time.perf_counter()
+    with quiet(not args.verbose):
+        documents = upload_all_aemet_data.sync_historical_data(
+            data_root, manifest_path=os.path.join(workdir, "manifest.json"), workers=args.workers,
+            climatology=not args.no_climatology)
+    elapsed = time.perf_counter() - start
+    return {
+        'years': args.years,
+        'csv_rows': rows,
+        'documents': documents,
+        'climatology': not args.no_climatology,
+        'duration_s': round(elapsed, 3),
+        'rows_per_sec': round(rows / elapsed, 1) if elapsed > 0 else None,
+        'documents_per_sec': round(documents / elapsed, 1) if elapsed > 0 else None,
+    }
+
+
+# --- fetch_aemet_realtime ---
+def bench_realtime(args, workdir):
+    import fetch_aemet_realtime
+    from aemet_client import AemetClient, TokenBucket, create_http_session
+    from fake_aemet_server import SAMPLE_PAYLOAD_PATH, load_recorded_observations, replicate_observations, start_fake_aemet_server
+    from observation_watermarks import WatermarkStore
+
+    observations = replicate_observations(load_recorded_observations(SAMPLE_PAYLOAD_PATH), args.stations)
+    server, base_url = start_fake_aemet_server(observations)
+    station_idemas = sorted(server.observations_by_station)
+    # No rate limit and no response cache: every run really goes through both HTTP hops
+    unlimited = TokenBucket(rate=1e9, capacity=1e9)
+    results = {'stations': len(station_idemas), 'rows': len(observations)}
+    try:
+        for mode in ("per_station", "bulk"):
+            fetch_aemet_realtime.initialize_firebase(db_client=open_store(args.backend, workdir, args.emulator))
+            client = AemetClient(BENCHMARK_API_KEY, session=create_http_session(pool_size=args.realtime_workers),
+                                 base_url=base_url, rate_limiter=unlimited, use_cache=False)
+            watermarks = WatermarkStore(None)
+            passes = {}
+            try:
+                # First pass writes every station; the second one finds nothing new
+                for name in ("new", "unchanged"):
+                    start = time.perf_counter()
+                    with quiet(not args.verbose):
+                        if mode == "bulk":
+                            written = fetch_aemet_realtime.ingest_all_stations_bulk(
+                                BENCHMARK_API_KEY, station_idemas, watermarks=watermarks, client=client)
+                        else:
+                            written = fetch_aemet_realtime.ingest_all_stations(
+                                BENCHMARK_API_KEY, station_idemas, max_workers=args.realtime_workers,
+                                watermarks=watermarks, client=client)
+                    passes[name] = (written, time.perf_counter() - start)
+            finally:
+                client.close()
+            written, elapsed = passes["new"]
+            results[mode] = {
+                'written': written,
+                'duration_s': round(elapsed, 3),
+                'stations_per_sec': round(len(station_idemas) / elapsed, 1) if elapsed > 0 else None,
+                'unchanged_pass_s': round(passes["unchanged"][1], 3),
+            }
+    finally:
+        server.shutdown()
+    return results
+
+
+# --- simulateSensor ---
+def bench_sensors(args, workdir):
+    from simulateSensor import run_load_test
+
+    with quiet(not args.verbose):
+        report = run_load_test(open_store(args.backend, workdir, args.emulator), args.sensors, args.hz,
+                               args.sensor_duration, ASK_REGIONS, flush_size=500, flush_interval=0.5,
+                               commit_workers=4, layout=args.sensor_layout)
+    report['target_writes_per_sec'] = args.sensors * args.hz
+    return report
+
+
+# --- IA/api_assistant.py /ask ---
+def bench_ask(args, workdir):
+    from fake_llm_server import start_fake_llm_server
+    import requests
+    from werkzeug.serving import WSGIRequestHandler, make_server
+
+    llm_server, llm_url = start_fake_llm_server(delay=args.llm_delay)
+    if IA_DIR not in sys.path:
+        sys.path.insert(0, IA_DIR)
+    with quiet(not args.verbose):
+        import agriculture_assistant
+        import api_assistant
+    agriculture_assistant.LLAMA_API_URL = llm_url
+    if not args.ask_cache:
+        api_assistant.answer_cache.ttl_seconds = 0 # Every question reaches the model
+    api_assistant.answer_cache.clear()
+
+    class RequestHandler(WSGIRequestHandler):
+        def log_request(self, *log_args, **log_kwargs):
+            if args.verbose:
+                super().log_request(*log_args, **log_kwargs)
+
+    server = make_server("127.0.0.1", 0, api_assistant.app, threaded=True, request_handler=RequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/ask"
+    local = threading.local()
+
+    def ask(i):
+        session = getattr(local, 'session', None)
+        if session is None:
+            session = local.session = requests.Session()
+        payload = {'question': ASK_QUESTIONS[i % len(ASK_QUESTIONS)], 'region': ASK_REGIONS[i % len(ASK_REGIONS)]}
+        start = time.perf_counter()
+        try:
+            response = session.post(url, json=payload, timeout=60)
+            ok = response.ok
+        except requests.RequestException:
+            ok = False
+        return time.perf_counter() - start, ok
+
+    try:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.ask_concurrency) as executor:
+            outcomes = list(executor.map(ask, range(args.ask_requests)))
+        elapsed = time.perf_counter() - start
+    finally:
+        server.shutdown()
+        llm_server.shutdown()
+    latencies = [seconds for seconds, ok in outcomes if ok]
+    return {
+        'requests': args.ask_requests,
+        'concurrency': args.ask_concurrency,
+        'failed': sum(1 for _, ok in outcomes if not ok),
+        'llm_delay_ms': round(args.llm_delay * 1000, 2),
+        'answer_cache': args.ask_cache,
+        'model_requests': llm_server.requests_served,
+        'duration_s': round(elapsed, 3),
+        'requests_per_sec': round(len(latencies) / elapsed, 1) if elapsed > 0 else None,
+        'latency_ms': latency_summary(latencies),
+    }
+
+
+BENCHMARK_FUNCTIONS = {"upload": bench_upload, "realtime": bench_realtime, "sensors": bench_sensors, "ask": bench_ask}
+
+
+# --- Comparison between runs ---
+def metric_value(results, benchmark, metric_path):
+    value = results.get('results', {}).get(benchmark, {})
+    for part in metric_path.split('.'):
+        value = value.get(part) if isinstance(value, dict) else None
+    return value if isinstance(value, (int, float)) else None
+
+def compare_results(current, previous, threshold=DEFAULT_REGRESSION_THRESHOLD):
+    """Prints every headline metric against the previous run; returns the list of regressions."""
+    print(f"\nComparison with {previous.get('revision') or 'previous run'} ({previous.get('timestamp')}):")
+    regressions = []
+    for benchmark, metric_path, higher_is_better in HEADLINE_METRICS:
+        old, new = metric_value(previous, benchmark, metric_path), metric_value(current, benchmark, metric_path)
+        if old is None or new is None or old == 0:
+            continue
+        change = (new - old) / old
+        worse = change < -threshold if higher_is_better else change > threshold
+        label = "REGRESSION" if worse else ""
+        print(f"  {benchmark}.{metric_path}: {old} -> {new} ({change:+.1%}) {label}")
+        if worse:
+            regressions.append({'metric': f"{benchmark}.{metric_path}", 'previous': old, 'current': new,
+                                'change': round(change, 4)})
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline end-to-end benchmarks of the ingest, upload and assistant paths.")
+    parser.add_argument("--only", nargs="+", choices=BENCHMARKS, default=list(BENCHMARKS),
+                        help="Benchmarks to run (default: all).")
+    parser.add_argument("--output", default=DEFAULT_RESULTS_PATH, help=f"Results file (default: {DEFAULT_RESULTS_PATH}).")
+    parser.add_argument("--compare", metavar="PREVIOUS_JSON",
+                        help="Results of a previous run; exits with status 1 if a headline metric regressed.")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_REGRESSION_THRESHOLD,
+                        help="Relative change counted as a regression by --compare (default: 0.10).")
+    parser.add_argument("--backend", choices=["memory", "sqlite", "emulator"], default="memory",
+                        help="Where the benchmarks write (emulator: the Firestore emulator at --emulator).")
+    parser.add_argument("--emulator", metavar="HOST:PORT", default=os.environ.get("FIRESTORE_EMULATOR_HOST"))
+    parser.add_argument("--verbose", action="store_true", help="Show the output of the benchmarked scripts.")
+    # upload
+    parser.add_argument("--data-root", default=DEFAULT_DATA_ROOT, help="Real aemetDATA/ tree the synthetic years are copied from.")
+    parser.add_argument("--years", type=int, default=50, help="Synthetic years of EBH statistics to upload.")
+    parser.add_argument("--workers", type=int, default=None, help="CSV parser processes (default: one per CPU core).")
+    parser.add_argument("--no-climatology", action="store_true", help="Leave the climatology step out of the upload benchmark.")
+    # realtime
+    parser.add_argument("--stations", type=int, default=500, help="Synthetic stations served by the fake AEMET server.")
+    parser.add_argument("--realtime-workers", type=int, default=16, help="Concurrent stations in per-station mode.")
+    # sensors
+    parser.add_argument("--sensors", type=int, default=1000, help="Simulated sensors.")
+    parser.add_argument("--hz", type=float, default=5.0, help="Readings per second of each sensor.")
+    parser.add_argument("--sensor-duration", type=float, default=10.0, help="Seconds of sensor load.")
+    parser.add_argument("--sensor-layout", choices=["flat", "sharded"], default="flat")
+    # ask
+    parser.add_argument("--ask-requests", type=int, default=200, help="/ask requests to send.")
+    parser.add_argument("--ask-concurrency", type=int, default=8, help="Concurrent /ask clients.")
+    parser.add_argument("--llm-delay", type=float, default=0.05, help="Seconds the fake model takes per answer.")
+    parser.add_argument("--ask-cache", action="store_true", help="Keep the answer cache enabled (repeated questions are hits).")
+    args = parser.parse_args()
+    if ROOT_DIR not in sys.path:
+        sys.path.insert(0, ROOT_DIR)
+
+    results = {
+        'revision': git_revision(),
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'backend': args.backend,
+        'results': {},
+        'errors': {},
+    }
+    workdir = tempfile.mkdtemp(prefix="aemet_bench_")
+    try:
+        for name in BENCHMARKS:
+            if name not in args.only:
+                continue
+            print(f"Running benchmark '{name}'...")
+            try:
+                results['results'][name] = BENCHMARK_FUNCTIONS[name](args, workdir)
+                print(f"  {json.dumps(results['results'][name], ensure_ascii=False)}")
+            except Exception as e:
+                print(f"  Benchmark '{name}' failed: {e}")
+                results['errors'][name] = str(e)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    regressions = []
+    if args.compare:
+        try:
+            with open(args.compare, 'r', encoding='utf-8') as f:
+                previous = json.load(f)
+            regressions = compare_results(results, previous, args.threshold)
+            results['regressions'] = regressions
+        except (OSError, ValueError) as e:
+            print(f"Could not read previous results '{args.compare}': {e}")
+
+    tmp_path = args.output + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, args.output)
+    print(f"\nResults written to {args.output}.")
+    if regressions:
+        exit(1)
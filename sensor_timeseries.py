@@ -0,0 +1,264 @@
+from firebase_admin import firestore
+from bulk_writer import BulkWriter
+from collections import defaultdict
+from datetime import datetime, timezone
+import copy
+import threading
+import time
+import uuid
+
+# --- Region-sharded time-series layout for sensor readings ---
+#
+#   sensorRegions/{regionId}                                  latest reading of the region + latest per sensor
+#   sensorRegions/{regionId}/sensors/{sensorId}/hours/{YYYYMMDDHH}   readings of one sensor in one hour (array)
+#   sensorRegions/{regionId}/rollups_minute/{YYYYMMDDHHMM}    count/sum/min/max per metric over the region,
+#                                                             in partials (see below)
+#   sensorRegions/{regionId}/rollups_hour/{YYYYMMDDHH}
+#   sensorRegions/{regionId}/rollups_day/{YYYYMMDD}
+#
+# A dashboard reads one region document (or one rollup document) instead of
+# querying the whole sensorData collection. Hour documents hold every reading of
+# that hour, which stays well below Firestore's 1 MiB document limit up to ~1 Hz
+# per sensor.
+#
+# A rollup document holds one partial per writer: partials.{partialId} is the
+# absolute count/sum/min/max of the readings that writer has seen for the
+# bucket, so writing it again (a retry, a replayed dead letter) changes nothing.
+# A restart, a second writer process, a late reading for a bucket the writer
+# already forgot, or a dead-lettered rollup write all start a new partial id
+# instead of overwriting an old one. Readers add the partials up (rollup_totals,
+# rollup_mean).
+
+ROOT_COLLECTION = 'sensorRegions'
+METRICS = ('temperatura', 'humedad', 'ph')
+ROLLUP_KEY_FORMATS = {'minute': '%Y%m%d%H%M', 'hour': '%Y%m%d%H', 'day': '%Y%m%d'}
+# Rollup buckets whose partial is kept in memory per region and granularity; a
+# reading for an older bucket starts a new partial
+ROLLUP_BUCKETS_KEPT = {'minute': 10, 'hour': 3, 'day': 2}
+FIRESTORE_BATCH_LIMIT = 500
+
+def _reading_time(reading):
+    ts = reading.get('sensor_timestamp')
+    if isinstance(ts, datetime):
+        return ts if ts.tzinfo else ts.replace(tzinfo=timezone.utc)
+    return datetime.now(timezone.utc)
+
+def _compact(reading, ts):
+    """The part of a reading stored in the time series: its time and the metric values."""
+    compact = {'t': ts}
+    for metric in METRICS:
+        if reading.get(metric) is not None:
+            compact[metric] = reading[metric]
+    return compact
+
+def _new_aggregate():
+    return {'count': 0, **{metric: {'min': None, 'max': None, 'sum': 0.0, 'count': 0} for metric in METRICS}}
+
+def _update_aggregate(aggregate, compact):
+    aggregate['count'] += 1
+    for metric in METRICS:
+        value = compact.get(metric)
+        if value is None:
+            continue
+        stats = aggregate[metric]
+        stats['min'] = value if stats['min'] is None else min(stats['min'], value)
+        stats['max'] = value if stats['max'] is None else max(stats['max'], value)
+        stats['sum'] += value
+        stats['count'] += 1
+
+def _aggregate_document(aggregate):
+    document = {'count': aggregate['count']}
+    for metric in METRICS:
+        stats = aggregate[metric]
+        if stats['count']:
+            document[metric] = {'min': stats['min'], 'max': stats['max'], 'sum': stats['sum'], 'count': stats['count']}
+    return document
+
+def rollup_totals(rollup_document):
+    """count and per-metric count/sum/min/max of a stored rollup document, over all its partials."""
+    totals = _new_aggregate()
+    for partial in ((rollup_document or {}).get('partials') or {}).values():
+        totals['count'] += partial.get('count', 0)
+        for metric in METRICS:
+            stats, other = totals[metric], partial.get(metric)
+            if not other:
+                continue
+            stats['min'] = other['min'] if stats['min'] is None else min(stats['min'], other['min'])
+            stats['max'] = other['max'] if stats['max'] is None else max(stats['max'], other['max'])
+            stats['sum'] += other['sum']
+            stats['count'] += other['count']
+    return totals
+
+def rollup_mean(rollup_document, metric):
+    """Mean of a metric in a stored rollup document, or None without readings."""
+    stats = rollup_totals(rollup_document)[metric]
+    return round(stats['sum'] / stats['count'], 3) if stats['count'] else None
+
+
+class SensorTimeSeriesWriter:
+    """
+    Writes readings into the sharded layout above. Readings are buffered;
+    every flush writes, through the shared BulkWriter (per-write retries, then
+    the dead-letter file), one merged document per touched sensor-hour (new
+    readings appended with ArrayUnion), the region "latest" documents and this
+    writer's partial of every touched rollup bucket. Every write is idempotent.
+
+    Exposes the same add/flush/close interface and statistics (written, failed,
+    commit_latencies) as simulateSensor.BufferedSensorWriter; a commit latency
+    here is the duration of one flush.
+    """
+
+    def __init__(self, db_client, root_collection=ROOT_COLLECTION, flush_size=FIRESTORE_BATCH_LIMIT,
+                 flush_interval=1.0):
+        self.db = db_client
+        self.root_collection = root_collection
+        self.flush_size = max(1, flush_size)
+        self.flush_interval = flush_interval
+        self.writer_id = uuid.uuid4().hex[:12]
+        self._lock = threading.Lock() # Protects the buffers below
+        self._commit_lock = threading.Lock() # One flush at a time keeps every document's writes in order
+        self._hour_readings = defaultdict(list) # (region, sensor, hour key) -> [compact readings]
+        self._latest = defaultdict(dict) # region -> {sensorId: compact reading}
+        self._rollups = {} # (region, granularity, bucket key) -> {'partialId', 'aggregate' (absolute), 'sinceFlush'}
+        self._dirty_rollups = set()
+        self._partial_sequence = 0
+        self._buffered = 0
+        self.commit_latencies = [] # seconds
+        self.written = 0
+        self.failed = 0
+        self._stop = threading.Event()
+        self._timer = threading.Thread(target=self._flush_periodically, daemon=True)
+        self._timer.start()
+
+    def _new_partial(self):
+        """Rollup state under a partial id never used before (called with self._lock held)."""
+        self._partial_sequence += 1
+        return {'partialId': f"{self.writer_id}-{self._partial_sequence}", 'aggregate': _new_aggregate(),
+                'sinceFlush': _new_aggregate()}
+
+    def add(self, reading):
+        region_id = reading.get('regionId')
+        sensor_id = reading.get('sensorId')
+        if not region_id or not sensor_id:
+            print(f"Skipping reading without regionId/sensorId: {reading}")
+            return
+        ts = _reading_time(reading)
+        compact = _compact(reading, ts)
+
+        with self._lock:
+            self._hour_readings[(region_id, sensor_id, ts.strftime(ROLLUP_KEY_FORMATS['hour']))].append(compact)
+            previous = self._latest[region_id].get(sensor_id)
+            if previous is None or previous['t'] <= ts:
+                self._latest[region_id][sensor_id] = compact
+            for granularity, key_format in ROLLUP_KEY_FORMATS.items():
+                rollup_key = (region_id, granularity, ts.strftime(key_format))
+                if rollup_key not in self._rollups:
+                    self._rollups[rollup_key] = self._new_partial()
+                state = self._rollups[rollup_key]
+                _update_aggregate(state['aggregate'], compact)
+                _update_aggregate(state['sinceFlush'], compact)
+                self._dirty_rollups.add(rollup_key)
+            self._buffered += 1
+            should_flush = self._buffered >= self.flush_size
+        if should_flush:
+            self.flush()
+
+    def flush(self):
+        with self._commit_lock:
+            with self._lock:
+                if not self._buffered:
+                    return
+                hour_readings, self._hour_readings = self._hour_readings, defaultdict(list)
+                latest, self._latest = self._latest, defaultdict(dict)
+                rollups = {}
+                for key in self._dirty_rollups:
+                    state = self._rollups[key]
+                    rollups[key] = (state['partialId'], _aggregate_document(state['aggregate']))
+                    state['sinceFlush'] = _new_aggregate()
+                self._dirty_rollups = set()
+                self._buffered = 0
+                self._prune_rollups()
+
+            start = time.perf_counter()
+            # One batch in flight: a document's writes of consecutive flushes are applied in order
+            with BulkWriter(self.db, max_in_flight=1) as writer:
+                futures = self._queue_writes(writer, hour_readings, latest, rollups)
+            self.commit_latencies.append(time.perf_counter() - start)
+            self._record_results(futures)
+
+    def close(self):
+        """Flushes pending readings and stops the periodic flush."""
+        self._stop.set()
+        self._timer.join()
+        self.flush()
+
+    def _flush_periodically(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def _region_ref(self, region_id):
+        return self.db.collection(self.root_collection).document(region_id)
+
+    def _queue_writes(self, writer, hour_readings, latest, rollups):
+        """Queues the merged writes of one flush; returns [(future, readings in it or None, rollup key or None)]."""
+        futures = []
+        for (region_id, sensor_id, hour_key), readings in hour_readings.items():
+            hour_ref = self._region_ref(region_id).collection('sensors').document(sensor_id)\
+                           .collection('hours').document(hour_key)
+            futures.append((writer.set(hour_ref, {
+                'regionId': region_id,
+                'sensorId': sensor_id,
+                'hour': hour_key,
+                'readings': firestore.ArrayUnion(readings),
+            }, merge=True), len(readings), None))
+
+        for region_id, sensors in latest.items():
+            newest = max(sensors.values(), key=lambda compact: compact['t'])
+            futures.append((writer.set(self._region_ref(region_id), {
+                'regionId': region_id,
+                'latest': newest,
+                'sensors': sensors, # merged per sensor id
+                'updatedAt': firestore.SERVER_TIMESTAMP,
+            }, merge=True), None, None))
+
+        for rollup_key, (partial_id, document) in rollups.items():
+            region_id, granularity, bucket_key = rollup_key
+            rollup_ref = self._region_ref(region_id).collection(f'rollups_{granularity}').document(bucket_key)
+            futures.append((writer.set(rollup_ref, {'regionId': region_id, 'granularity': granularity,
+                                                    'bucket': bucket_key, 'partials': {partial_id: document}},
+                                       merge=True), None, rollup_key))
+        return futures
+
+    def _record_results(self, futures):
+        """
+        Counts the readings whose hour document was committed. A dead-lettered
+        rollup partial is left to the replay: the bucket continues under a new
+        partial id, so the replay cannot overwrite newer totals.
+        """
+        for future, reading_count, rollup_key in futures:
+            ok = future.exception() is None
+            if reading_count is not None:
+                if ok:
+                    self.written += reading_count
+                else:
+                    self.failed += reading_count
+            elif rollup_key is not None and not ok:
+                with self._lock:
+                    state = self._rollups.get(rollup_key)
+                    if state is None:
+                        continue
+                    # The readings added while this flush ran continue under a new partial
+                    replacement = self._new_partial()
+                    replacement['aggregate'] = copy.deepcopy(state['sinceFlush'])
+                    replacement['sinceFlush'] = state['sinceFlush']
+                    self._rollups[rollup_key] = replacement
+
+    def _prune_rollups(self):
+        """Forgets the partials of closed rollup buckets so memory stays bounded (called with self._lock held)."""
+        keys_by_series = defaultdict(list)
+        for region_id, granularity, bucket_key in self._rollups:
+            keys_by_series[(region_id, granularity)].append(bucket_key)
+        for (region_id, granularity), bucket_keys in keys_by_series.items():
+            for bucket_key in sorted(bucket_keys)[:-ROLLUP_BUCKETS_KEPT[granularity]]:
+                if (region_id, granularity, bucket_key) not in self._dirty_rollups:
+                    del self._rollups[(region_id, granularity, bucket_key)]
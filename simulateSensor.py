@@ -1,13 +1,38 @@
 import firebase_admin
 from firebase_admin import credentials, firestore
+from document_store import uses_local_backend, get_local_document_store
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+import argparse
+import os
 import random
+import threading
 import time
 
-# Inicializar la app de Firebase
-cred = credentials.Certificate("sensorizacao-e-ambiente-51347-firebase-adminsdk-fbsvc-d6499a3058.json")
-firebase_admin.initialize_app(cred)
+SERVICE_ACCOUNT_KEY_PATH = "sensorizacao-e-ambiente-51347-firebase-adminsdk-fbsvc-d6499a3058.json"
+SENSOR_COLLECTION = 'sensorData'
+FIRESTORE_BATCH_LIMIT = 500 # Maximum operations per Firestore batch
 
-db = firestore.client()
+def initialize_firestore(emulator_host=None, project_id=None):
+    """
+    Devuelve el cliente de Firestore. Con emulator_host (p. ej. 'localhost:8080')
+    se conecta al emulador de Firestore en lugar de al proyecto real.
+    """
+    if uses_local_backend(): # STORAGE_BACKEND=sqlite|memory (ver document_store.py)
+        return get_local_document_store()
+    if emulator_host:
+        os.environ["FIRESTORE_EMULATOR_HOST"] = emulator_host
+        # The emulator accepts anonymous credentials; google-cloud-firestore uses them
+        # automatically when FIRESTORE_EMULATOR_HOST is set.
+        from google.cloud import firestore as gcloud_firestore
+        print(f"Usando el emulador de Firestore en {emulator_host} (proyecto '{project_id}').")
+        return gcloud_firestore.Client(project=project_id)
+
+    # Inicializar la app de Firebase
+    cred = credentials.Certificate(SERVICE_ACCOUNT_KEY_PATH)
+    if not firebase_admin._apps:
+        firebase_admin.initialize_app(cred)
+    return firestore.client()
 
 def generate_data():
     return {
@@ -17,9 +42,218 @@ def generate_data():
         'timestamp': firestore.SERVER_TIMESTAMP           # Tiempo del servidor
     }
 
-# Subir 10 datos de ejemplo
-for i in range(10):
+def generate_sensor_reading(sensor_id, region_id):
+    """Lectura de un sensor concreto: generate_data() más sus identificadores y la hora de medida."""
     data = generate_data()
-    db.collection('sensorData').add(data)
-    print(f'Dato {i+1} subido:', data)
-    time.sleep(1)  # Espera 1 segundo entre cargas
+    data['sensorId'] = sensor_id
+    data['regionId'] = region_id
+    data['sensor_timestamp'] = datetime.now(timezone.utc) # Hora de la medida (el dashboard ordena por este campo)
+    return data
+
+def percentile(sorted_values, p):
+    """Percentil p (0-100) por interpolación lineal sobre una lista ya ordenada."""
+    if not sorted_values:
+        return None
+    k = (len(sorted_values) - 1) * p / 100.0
+    low = int(k)
+    high = min(low + 1, len(sorted_values) - 1)
+    return sorted_values[low] + (sorted_values[high] - sorted_values[low]) * (k - low)
+
+
+# --- Escritura por lotes ---
+class BufferedSensorWriter:
+    """
+    Acumula lecturas y las sube en lotes de Firestore. Un lote se envía cuando
+    llega a flush_size lecturas o cuando han pasado flush_interval segundos desde
+    el último envío. Hasta commit_workers lotes pueden estar en vuelo a la vez.
+    Guarda la latencia de cada commit para el informe final.
+    """
+
+    def __init__(self, db_client, collection=SENSOR_COLLECTION, flush_size=FIRESTORE_BATCH_LIMIT,
+                 flush_interval=1.0, commit_workers=4):
+        self.db = db_client
+        self.collection = collection
+        self.flush_size = max(1, min(flush_size, FIRESTORE_BATCH_LIMIT))
+        self.flush_interval = flush_interval
+        self._buffer = []
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=commit_workers)
+        self._futures = []
+        self._futures_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.commit_latencies = [] # seconds
+        self.written = 0
+        self.failed = 0
+        self._stop = threading.Event()
+        self._timer = threading.Thread(target=self._flush_periodically, daemon=True)
+        self._timer.start()
+
+    def add(self, reading):
+        with self._lock:
+            self._buffer.append(reading)
+            if len(self._buffer) < self.flush_size:
+                return
+            readings, self._buffer = self._buffer, []
+        self._submit(readings)
+
+    def flush(self):
+        with self._lock:
+            readings, self._buffer = self._buffer, []
+        if readings:
+            self._submit(readings)
+
+    def close(self):
+        """Envía lo pendiente y espera a que terminen todos los commits."""
+        self._stop.set()
+        self._timer.join()
+        self.flush()
+        with self._futures_lock:
+            pending = list(self._futures)
+        for future in pending:
+            future.result()
+        self._executor.shutdown()
+
+    def _flush_periodically(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def _submit(self, readings):
+        with self._futures_lock:
+            self._futures = [f for f in self._futures if not f.done()]
+            self._futures.append(self._executor.submit(self._commit, readings))
+
+    def _commit(self, readings):
+        batch = self.db.batch()
+        collection_ref = self.db.collection(self.collection)
+        for reading in readings:
+            batch.set(collection_ref.document(), reading)
+        start = time.perf_counter()
+        try:
+            batch.commit()
+        except Exception as e:
+            print(f"Error al subir un lote de {len(readings)} lecturas: {e}")
+            with self._stats_lock:
+                self.failed += len(readings)
+            return
+        latency = time.perf_counter() - start
+        with self._stats_lock:
+            self.commit_latencies.append(latency)
+            self.written += len(readings)
+
+
+def run_load_test(db_client, sensors, hz, duration, regions, flush_size, flush_interval, commit_workers,
+                  layout='flat', recommendations=False):
+    """
+    Simula `sensors` sensores que envían `hz` lecturas por segundo cada uno
+    durante `duration` segundos, repartidos entre `regions` regiones, y devuelve
+    un resumen con escrituras/s sostenidas y percentiles de latencia de commit.
+    layout='flat' escribe un documento por lectura en sensorData; layout='sharded'
+    usa la estructura por región/sensor con agregados de sensor_timeseries.py.
+    Con recommendations=True las lecturas pasan también por el motor de
+    recomendaciones (recommendation_engine.py), que escribe los consejos por región.
+    """
+    sensor_ids = [f"sensor-{i:05d}" for i in range(sensors)]
+    sensor_regions = {sensor_id: regions[i % len(regions)] for i, sensor_id in enumerate(sensor_ids)}
+    if layout == 'sharded':
+        from sensor_timeseries import SensorTimeSeriesWriter
+        writer = SensorTimeSeriesWriter(db_client, flush_size=flush_size, flush_interval=flush_interval)
+    else:
+        writer = BufferedSensorWriter(db_client, flush_size=flush_size, flush_interval=flush_interval,
+                                      commit_workers=commit_workers)
+    engine = None
+    if recommendations:
+        from recommendation_engine import RecommendationEngine
+        engine = RecommendationEngine(db_client, flush_interval=max(flush_interval, 1.0))
+
+    print(f"Prueba de carga: {sensors} sensores x {hz} Hz durante {duration} s "
+          f"({sensors * hz:.0f} lecturas/s objetivo, lotes de {writer.flush_size}, flush cada {flush_interval} s)")
+    generated = 0
+    tick = 1.0 / hz
+    start = time.perf_counter()
+    next_tick = start
+    while time.perf_counter() - start < duration:
+        for sensor_id in sensor_ids:
+            reading = generate_sensor_reading(sensor_id, sensor_regions[sensor_id])
+            writer.add(reading)
+            if engine is not None:
+                engine.add(reading)
+        generated += len(sensor_ids)
+        next_tick += tick
+        sleep_for = next_tick - time.perf_counter()
+        if sleep_for > 0:
+            time.sleep(sleep_for)
+    writer.close()
+    if engine is not None:
+        engine.close()
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(writer.commit_latencies)
+    report = {
+        'layout': layout,
+        'sensors': sensors,
+        'hz': hz,
+        'duration_s': round(elapsed, 3),
+        'generated': generated,
+        'written': writer.written,
+        'failed': writer.failed,
+        'commits': len(latencies),
+        'writes_per_sec': round(writer.written / elapsed, 1) if elapsed > 0 else 0.0,
+        'commit_latency_ms': {f"p{p}": round(percentile(latencies, p) * 1000, 2) if latencies else None
+                              for p in (50, 95, 99)},
+    }
+    if engine is not None:
+        report['recommendation_region_writes'] = engine.region_writes
+        print(f"Motor de recomendaciones: {engine.processed} lecturas evaluadas, "
+              f"{engine.region_writes} documentos de región escritos.")
+    print(f"Escritas {report['written']}/{generated} lecturas ({report['failed']} fallidas) en {report['commits']} commits.")
+    print(f"Escrituras sostenidas: {report['writes_per_sec']} /s")
+    print(f"Latencia de commit (ms): p50={report['commit_latency_ms']['p50']} "
+          f"p95={report['commit_latency_ms']['p95']} p99={report['commit_latency_ms']['p99']}")
+    return report
+
+
+def positive_float(value):
+    """Tipo de argparse para la frecuencia de lectura: número estrictamente positivo."""
+    number = float(value)
+    if number <= 0:
+        raise argparse.ArgumentTypeError(f"debe ser mayor que 0 (recibido {value})")
+    return number
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulador de sensores de suelo que sube lecturas a Firestore.")
+    parser.add_argument("--load", action="store_true", help="Modo de carga: N sensores x M Hz con escritura por lotes.")
+    parser.add_argument("--sensors", type=int, default=100, help="Número de sensores simulados (modo --load).")
+    parser.add_argument("--hz", type=positive_float, default=1.0, help="Lecturas por segundo de cada sensor (modo --load).")
+    parser.add_argument("--duration", type=float, default=30.0, help="Duración de la prueba en segundos (modo --load).")
+    parser.add_argument("--regions", default="MADRID,VALLADOLID,A CORUÑA",
+                        help="IDs de región (separados por comas, como en aemetHistoricalData) entre los que se reparten los sensores.")
+    parser.add_argument("--flush-size", type=int, default=FIRESTORE_BATCH_LIMIT, help="Lecturas por lote (máx. 500).")
+    parser.add_argument("--flush-interval", type=float, default=1.0, help="Segundos máximos entre envíos de lotes.")
+    parser.add_argument("--commit-workers", type=int, default=4, help="Lotes en vuelo simultáneamente.")
+    parser.add_argument("--layout", choices=["flat", "sharded"], default="flat",
+                        help="flat: un documento por lectura en sensorData; sharded: series por región/sensor con agregados.")
+    parser.add_argument("--recommendations", action="store_true",
+                        help="Evaluar también las reglas de recomendación y escribirlas por región (modo --load).")
+    parser.add_argument("--emulator", metavar="HOST:PORT",
+                        default=os.environ.get("FIRESTORE_EMULATOR_HOST"),
+                        help="Usar el emulador de Firestore (por defecto $FIRESTORE_EMULATOR_HOST).")
+    parser.add_argument("--project", default="sensorizacao-e-ambiente-51347", help="ID de proyecto para el emulador.")
+    args = parser.parse_args()
+    region_ids = [r.strip() for r in args.regions.split(',') if r.strip()]
+    if args.load and not region_ids:
+        parser.error("--regions necesita al menos un ID de región.")
+
+    db = initialize_firestore(args.emulator, args.project)
+
+    if args.load:
+        run_load_test(db, args.sensors, args.hz, args.duration, region_ids,
+                      args.flush_size, args.flush_interval, args.commit_workers, layout=args.layout,
+                      recommendations=args.recommendations)
+    else:
+        # Subir 10 datos de ejemplo
+        for i in range(10):
+            data = generate_data()
+            db.collection(SENSOR_COLLECTION).add(data)
+            print(f'Dato {i+1} subido:', data)
+            time.sleep(1)  # Espera 1 segundo entre cargas
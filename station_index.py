@@ -0,0 +1,214 @@
+import numpy as np
+import argparse
+import json
+import os
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError: # scipy is optional; queries fall back to a vectorized brute-force search
+    cKDTree = None
+
+# --- In-memory spatial index of the AEMET station inventory ---
+# Coordinates are kept as NumPy arrays (one entry per station) and indexed with a
+# k-d tree over 3-D unit vectors, so "nearest k stations" and inverse-distance
+# weighting for thousands of farm locations run in one vectorized call.
+#
+#   index = StationIndex.from_file(DEFAULT_INVENTORY_PATH)
+#   distances_km, idemas = index.nearest([41.65, 40.42], [-4.72, -3.70], k=3)
+#   values = index.idw([41.65], [-4.72], index.values_from_observations(observations, 'ta'))
+
+DEFAULT_INVENTORY_PATH = "aemet_station_inventory.json" # Written by import_requestsIDEMAs.py
+EARTH_RADIUS_KM = 6371.0088
+BRUTE_FORCE_CHUNK = 2048 # Query points per block in the fallback search (bounds the distance matrix size)
+
+def parse_dms(value):
+    """
+    Converts an AEMET inventory coordinate ('394924N', '031205W': degrees,
+    minutes, seconds and hemisphere) to decimal degrees. Plain numbers are
+    returned as floats; anything unparseable becomes NaN.
+    """
+    if value is None:
+        return np.nan
+    if isinstance(value, (int, float)):
+        return float(value)
+    text = str(value).strip().upper()
+    if not text:
+        return np.nan
+    hemisphere = text[-1]
+    if hemisphere not in "NSEW":
+        try:
+            return float(text.replace(',', '.'))
+        except ValueError:
+            return np.nan
+    digits = text[:-1]
+    if not digits.isdigit() or len(digits) < 6:
+        return np.nan
+    degrees = int(digits[:-4])
+    minutes = int(digits[-4:-2])
+    seconds = int(digits[-2:])
+    decimal = degrees + minutes / 60.0 + seconds / 3600.0
+    return -decimal if hemisphere in "SW" else decimal
+
+def to_float(value):
+    try:
+        return float(str(value).replace(',', '.'))
+    except (TypeError, ValueError):
+        return np.nan
+
+def _unit_vectors(lat, lon):
+    """(n, 3) unit vectors for latitude/longitude arrays in degrees."""
+    lat_rad = np.radians(np.asarray(lat, dtype=float))
+    lon_rad = np.radians(np.asarray(lon, dtype=float))
+    cos_lat = np.cos(lat_rad)
+    return np.column_stack((cos_lat * np.cos(lon_rad), cos_lat * np.sin(lon_rad), np.sin(lat_rad)))
+
+def _chord_to_km(chord):
+    """Straight-line distance between unit vectors -> great-circle distance in km."""
+    return 2.0 * EARTH_RADIUS_KM * np.arcsin(np.clip(chord / 2.0, 0.0, 1.0))
+
+
+class StationIndex:
+    """Station identifiers, names and coordinates as parallel arrays plus a spatial index."""
+
+    def __init__(self, idemas, names, provinces, lat, lon, alt):
+        lat = np.asarray(lat, dtype=float)
+        lon = np.asarray(lon, dtype=float)
+        valid = ~(np.isnan(lat) | np.isnan(lon))
+        if not valid.all():
+            print(f"Skipping {int((~valid).sum())} stations without valid coordinates.")
+        self.idemas = np.asarray(idemas, dtype=object)[valid]
+        self.names = np.asarray(names, dtype=object)[valid]
+        self.provinces = np.asarray(provinces, dtype=object)[valid]
+        self.lat = lat[valid]
+        self.lon = lon[valid]
+        self.alt = np.asarray(alt, dtype=float)[valid]
+        self.position = {idema: i for i, idema in enumerate(self.idemas)}
+        self._xyz = _unit_vectors(self.lat, self.lon)
+        self._tree = cKDTree(self._xyz) if cKDTree is not None and len(self._xyz) else None
+
+    def __len__(self):
+        return len(self.idemas)
+
+    @classmethod
+    def from_inventory(cls, stations):
+        """Builds the index from the AEMET inventory list (indicativo, nombre, provincia, latitud, longitud, altitud)."""
+        stations = [s for s in stations if s.get('indicativo')]
+        return cls(
+            idemas=[s['indicativo'] for s in stations],
+            names=[s.get('nombre', '') for s in stations],
+            provinces=[(s.get('provincia') or '').strip().upper() for s in stations],
+            lat=[parse_dms(s.get('latitud')) for s in stations],
+            lon=[parse_dms(s.get('longitud')) for s in stations],
+            alt=[to_float(s.get('altitud')) for s in stations],
+        )
+
+    @classmethod
+    def from_observations(cls, observations):
+        """Builds the index from real-time observations (idema, ubi, lat, lon, alt), one entry per station."""
+        latest = {}
+        for obs in observations:
+            if obs.get('idema'):
+                latest[obs['idema']] = obs
+        return cls(
+            idemas=list(latest),
+            names=[obs.get('ubi', '') for obs in latest.values()],
+            provinces=[''] * len(latest),
+            lat=[to_float(obs.get('lat')) for obs in latest.values()],
+            lon=[to_float(obs.get('lon')) for obs in latest.values()],
+            alt=[to_float(obs.get('alt')) for obs in latest.values()],
+        )
+
+    @classmethod
+    def from_file(cls, filepath=DEFAULT_INVENTORY_PATH):
+        with open(filepath, 'r', encoding='utf-8') as f:
+            return cls.from_inventory(json.load(f))
+
+    def _query(self, xyz, k, subset=None):
+        """Chord distances and station positions of the k nearest stations for each row of xyz."""
+        points = self._xyz if subset is None else self._xyz[subset]
+        k = min(k, len(points))
+        if self._tree is not None:
+            tree = self._tree if subset is None else cKDTree(points)
+            chord, positions = tree.query(xyz, k=k)
+            chord = chord.reshape(len(xyz), k)
+            positions = positions.reshape(len(xyz), k)
+        else:
+            chord = np.empty((len(xyz), k))
+            positions = np.empty((len(xyz), k), dtype=np.intp)
+            for start in range(0, len(xyz), BRUTE_FORCE_CHUNK):
+                block = xyz[start:start + BRUTE_FORCE_CHUNK]
+                distances = np.linalg.norm(block[:, np.newaxis, :] - points[np.newaxis, :, :], axis=2)
+                nearest = np.argpartition(distances, k - 1, axis=1)[:, :k] if k < len(points) else \
+                    np.tile(np.arange(len(points)), (len(block), 1))
+                nearest_distances = np.take_along_axis(distances, nearest, axis=1)
+                order = np.argsort(nearest_distances, axis=1)
+                positions[start:start + len(block)] = np.take_along_axis(nearest, order, axis=1)
+                chord[start:start + len(block)] = np.take_along_axis(nearest_distances, order, axis=1)
+        if subset is not None:
+            positions = np.flatnonzero(subset)[positions]
+        return chord, positions
+
+    def nearest_positions(self, lat, lon, k=1):
+        """(distances in km, station positions), both shaped (number of points, k)."""
+        if not len(self):
+            raise ValueError("The station index is empty.")
+        chord, positions = self._query(_unit_vectors(np.atleast_1d(lat), np.atleast_1d(lon)), k)
+        return _chord_to_km(chord), positions
+
+    def nearest(self, lat, lon, k=1):
+        """(distances in km, station idemas) of the k nearest stations to every (lat, lon) point."""
+        distances, positions = self.nearest_positions(lat, lon, k)
+        return distances, self.idemas[positions]
+
+    def values_from_observations(self, observations, field):
+        """Array aligned with the index holding obs[field] per station (NaN where there is no value)."""
+        values = np.full(len(self), np.nan)
+        for obs in observations:
+            position = self.position.get(obs.get('idema'))
+            if position is not None:
+                values[position] = to_float(obs.get(field))
+        return values
+
+    def idw(self, lat, lon, values, k=4, power=2.0, max_distance_km=None):
+        """
+        Inverse-distance-weighted interpolation of per-station `values` (aligned
+        with the index, NaN = no data) at every (lat, lon) point, using the k
+        nearest stations that have data. Points closer than 10 m to a station
+        take its value; points with no station within max_distance_km get NaN.
+        """
+        values = np.asarray(values, dtype=float)
+        has_value = ~np.isnan(values)
+        if not has_value.any():
+            return np.full(len(np.atleast_1d(lat)), np.nan)
+        subset = None if has_value.all() else has_value
+        chord, positions = self._query(_unit_vectors(np.atleast_1d(lat), np.atleast_1d(lon)), k, subset)
+        distances = _chord_to_km(chord)
+        neighbour_values = values[positions]
+
+        weights = 1.0 / np.maximum(distances, 1e-9) ** power
+        if max_distance_km is not None:
+            weights[distances > max_distance_km] = 0.0
+        with np.errstate(invalid='ignore', divide='ignore'):
+            result = (weights * neighbour_values).sum(axis=1) / weights.sum(axis=1)
+        exact = distances[:, 0] < 0.01
+        result[exact] = neighbour_values[exact, 0]
+        return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Nearest AEMET stations to a location.")
+    parser.add_argument("lat", type=float)
+    parser.add_argument("lon", type=float)
+    parser.add_argument("-k", type=int, default=3, help="Number of stations to list.")
+    parser.add_argument("--inventory", default=DEFAULT_INVENTORY_PATH,
+                        help="Station inventory saved by import_requestsIDEMAs.py.")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.inventory):
+        print(f"ERROR: Station inventory '{args.inventory}' not found. Run import_requestsIDEMAs.py first.")
+        exit()
+    index = StationIndex.from_file(args.inventory)
+    distances_km, positions = index.nearest_positions(args.lat, args.lon, k=args.k)
+    for distance, position in zip(distances_km[0], positions[0]):
+        print(f"{index.idemas[position]:>8}  {distance:7.1f} km  {index.names[position]} ({index.provinces[position]}), "
+              f"alt {index.alt[position]:.0f} m")
@@ -0,0 +1,333 @@
+import atexit
+import contextlib
+import json
+import os
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# --- Lightweight in-process metrics ---
+# Stage timings (histograms) and counters shared by the ingestion scripts and the
+# assistant servers, without any external dependency:
+#
+#   with telemetry.timed("aemet_metadata"): ...            stage_duration_seconds{stage="aemet_metadata"}
+#   telemetry.inc("writes_total", 490, collection="...")   writes_total{collection="..."}
+#
+# They can be read in the Prometheus text format (start_metrics_server or the
+# /metrics route of the assistant servers) or as JSON dumped periodically to a file.
+# Environment (read by configure_from_env):
+#
+#   TELEMETRY_PORT            serve /metrics and /metrics.json on this port
+#   TELEMETRY_JSON_PATH       dump the metrics as JSON to this file (every TELEMETRY_JSON_INTERVAL s and on exit)
+#   TELEMETRY_PROFILE         opt-in per-run capture: 'cpu' (cProfile), 'memory' (tracemalloc) or 'cpu,memory'
+#   TELEMETRY_PROFILE_DIR     where profile_run() writes its captures (default .profiles/)
+
+STAGE_METRIC = "stage_duration_seconds"
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+DEFAULT_JSON_INTERVAL = 60.0
+DEFAULT_PROFILE_DIR = ".profiles"
+TRACEMALLOC_TOP = 30 # Allocation sites listed in a memory capture
+
+METRIC_HELP = {
+    STAGE_METRIC: "Duration of each hot-path stage.",
+    "rows_total": "Rows read (AEMET observations, CSV documents).",
+    "writes_total": "Document writes committed.",
+    "retries_total": "Retried requests.",
+    "cache_requests_total": "Cache lookups by result.",
+    "errors_total": "Failed stages.",
+    "dead_letter_total": "Writes saved to the dead-letter file after exhausting their retries.",
+}
+
+
+class Histogram:
+    """Cumulative-bucket histogram of observed values (seconds), as in Prometheus."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def cumulative(self):
+        total, result = 0, []
+        for count in self.counts:
+            total += count
+            result.append(total)
+        return result
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding quantile q (0-1); None if nothing was observed."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        for bound, cumulative in zip(self.buckets, self.cumulative()):
+            if cumulative >= rank:
+                return bound
+        return self.max
+
+
+def _label_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(label_key, extra=()):
+    pairs = list(label_key) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+class MetricsRegistry:
+    """Counters and histograms keyed by (name, labels). Thread-safe."""
+
+    def __init__(self):
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+        self.started_at = time.time()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(value)
+
+    @contextlib.contextmanager
+    def timed(self, stage, **labels):
+        """Observes the duration of the block in stage_duration_seconds{stage=...}; counts errors_total if it raises."""
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.inc("errors_total", stage=stage, **labels)
+            raise
+        finally:
+            self.observe(STAGE_METRIC, time.perf_counter() - start, stage=stage, **labels)
+
+    def snapshot(self):
+        """Plain-dict view: counters by name and label string, histograms with count/sum/max/p50/p95/p99."""
+        with self._lock:
+            counters = {}
+            for (name, label_key), value in sorted(self._counters.items()):
+                counters.setdefault(name, {})[_format_labels(label_key) or "total"] = value
+            histograms = {}
+            for (name, label_key), histogram in sorted(self._histograms.items()):
+                histograms.setdefault(name, {})[_format_labels(label_key) or "all"] = {
+                    'count': histogram.count,
+                    'sum': round(histogram.sum, 6),
+                    'max': round(histogram.max, 6),
+                    'p50': histogram.quantile(0.5),
+                    'p95': histogram.quantile(0.95),
+                    'p99': histogram.quantile(0.99),
+                }
+        return {'startedAt': self.started_at, 'timestamp': time.time(), 'counters': counters, 'histograms': histograms}
+
+    def render_prometheus(self):
+        lines = []
+        with self._lock:
+            for name in sorted({name for name, _ in self._counters}):
+                lines.append(f"# HELP {name} {METRIC_HELP.get(name, name)}")
+                lines.append(f"# TYPE {name} counter")
+                for (metric, label_key), value in sorted(self._counters.items()):
+                    if metric == name:
+                        lines.append(f"{name}{_format_labels(label_key)} {value}")
+            for name in sorted({name for name, _ in self._histograms}):
+                lines.append(f"# HELP {name} {METRIC_HELP.get(name, name)}")
+                lines.append(f"# TYPE {name} histogram")
+                for (metric, label_key), histogram in sorted(self._histograms.items()):
+                    if metric != name:
+                        continue
+                    for bound, cumulative in zip(histogram.buckets, histogram.cumulative()):
+                        lines.append(f"{name}_bucket{_format_labels(label_key, [('le', bound)])} {cumulative}")
+                    lines.append(f"{name}_bucket{_format_labels(label_key, [('le', '+Inf')])} {histogram.count}")
+                    lines.append(f"{name}_sum{_format_labels(label_key)} {histogram.sum}")
+                    lines.append(f"{name}_count{_format_labels(label_key)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+            self.started_at = time.time()
+
+
+REGISTRY = MetricsRegistry()
+inc = REGISTRY.inc
+observe = REGISTRY.observe
+timed = REGISTRY.timed
+snapshot = REGISTRY.snapshot
+render_prometheus = REGISTRY.render_prometheus
+
+
+def write_json(path, registry=REGISTRY):
+    """Dumps the snapshot to `path` through a temporary file, so readers never see a partial dump."""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(registry.snapshot(), f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"Could not write metrics to '{path}': {e}")
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.startswith("/metrics.json"):
+            body, content_type = json.dumps(self.server.registry.snapshot()).encode('utf-8'), 'application/json'
+        elif self.path.startswith("/metrics"):
+            body, content_type = self.server.registry.render_prometheus().encode('utf-8'), 'text/plain; version=0.0.4'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_metrics_server(port, host="0.0.0.0", registry=REGISTRY):
+    """Serves /metrics (Prometheus text) and /metrics.json from a background thread; returns the server."""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    server.registry = registry
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    print(f"Metrics available at http://{host}:{server.server_address[1]}/metrics")
+    return server
+
+def start_periodic_dump(path, interval=DEFAULT_JSON_INTERVAL, registry=REGISTRY):
+    """Writes the JSON snapshot every `interval` seconds and once more at exit."""
+    stop = threading.Event()
+
+    def loop():
+        while not stop.wait(interval):
+            write_json(path, registry)
+
+    threading.Thread(target=loop, name="metrics-dump", daemon=True).start()
+    atexit.register(write_json, path, registry)
+    return stop
+
+_configured = False
+
+def configure_from_env(run_name=None):
+    """
+    Starts the exporters requested through TELEMETRY_PORT / TELEMETRY_JSON_PATH
+    (once per process). With run_name, a TELEMETRY_PROFILE capture covers the
+    rest of the process and is written at exit.
+    """
+    global _configured
+    if _configured:
+        return
+    _configured = True
+    if run_name:
+        profile_until_exit(run_name)
+    port = os.environ.get("TELEMETRY_PORT")
+    if port:
+        try:
+            start_metrics_server(int(port))
+        except (OSError, ValueError) as e:
+            print(f"Could not start the metrics server on port {port}: {e}")
+    json_path = os.environ.get("TELEMETRY_JSON_PATH")
+    if json_path:
+        start_periodic_dump(json_path, float(os.environ.get("TELEMETRY_JSON_INTERVAL", DEFAULT_JSON_INTERVAL)))
+
+
+# --- Opt-in profiling of a whole run ---
+# tracemalloc is process-global: overlapping captures (concurrent daemon jobs)
+# share it, and it is stopped when the last one finishes.
+_tracemalloc_lock = threading.Lock()
+_tracemalloc_users = 0
+
+def _start_tracemalloc():
+    global _tracemalloc_users
+    import tracemalloc
+    with _tracemalloc_lock:
+        if _tracemalloc_users == 0:
+            tracemalloc.start()
+        _tracemalloc_users += 1
+
+def _stop_tracemalloc():
+    """Snapshot and (current, peak) memory of the capture; stops tracing if no other capture uses it."""
+    global _tracemalloc_users
+    import tracemalloc
+    with _tracemalloc_lock:
+        snapshot = tracemalloc.take_snapshot()
+        traced = tracemalloc.get_traced_memory()
+        _tracemalloc_users -= 1
+        if _tracemalloc_users == 0:
+            tracemalloc.stop()
+    return snapshot, traced
+
+@contextlib.contextmanager
+def profile_run(name, modes=None, output_dir=None):
+    """
+    Captures a cProfile ('cpu') and/or tracemalloc ('memory') profile of the
+    block when requested through TELEMETRY_PROFILE (or `modes`). Writes
+    {name}-{timestamp}.prof (open with pstats or snakeviz) and/or
+    {name}-{timestamp}-memory.txt to TELEMETRY_PROFILE_DIR.
+
+    The CPU capture only covers the calling thread, not the worker threads it
+    starts (fetch pools, bulk writer). The memory capture covers the whole
+    process, including any capture running at the same time.
+    """
+    requested = modes if modes is not None else os.environ.get("TELEMETRY_PROFILE", "")
+    requested = {mode.strip().lower() for mode in requested.split(',') if mode.strip()}
+    if not requested:
+        yield
+        return
+
+    output_dir = output_dir or os.environ.get("TELEMETRY_PROFILE_DIR", DEFAULT_PROFILE_DIR)
+    os.makedirs(output_dir, exist_ok=True)
+    prefix = os.path.join(output_dir, f"{name}-{time.strftime('%Y%m%d-%H%M%S')}")
+    profiler = None
+    if "cpu" in requested:
+        import cProfile
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError as e: # Python 3.12+: another profiler is already active
+            print(f"CPU profile of '{name}' skipped: {e}")
+            profiler = None
+    if "memory" in requested:
+        _start_tracemalloc()
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(f"{prefix}.prof")
+            print(f"CPU profile written to {prefix}.prof")
+        if "memory" in requested:
+            memory_snapshot, (current, peak) = _stop_tracemalloc()
+            with open(f"{prefix}-memory.txt", 'w', encoding='utf-8') as f:
+                f.write(f"current={current / 1e6:.1f} MB peak={peak / 1e6:.1f} MB\n\n")
+                for stat in memory_snapshot.statistics('lineno')[:TRACEMALLOC_TOP]:
+                    f.write(f"{stat}\n")
+            print(f"Memory profile written to {prefix}-memory.txt")
+
+def profile_until_exit(name):
+    """profile_run() from now until the interpreter exits (scripts that call exit() on errors included)."""
+    capture = profile_run(name)
+    capture.__enter__()
+    atexit.register(capture.__exit__, None, None, None)
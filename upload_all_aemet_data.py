@@ -1,165 +1,269 @@
-import pandas as pd
 import firebase_admin
 from firebase_admin import credentials, firestore
+from document_store import uses_local_backend, get_local_document_store
+from bulk_writer import BulkWriter, on_all_written
+from materialize_region_bundle import materialize_region_bundles
+import telemetry
+from aemet_csv_parser import parse_aemet_csv, describe_aemet_csv
+from aemet_climatology import compute_climatologies
+from water_balance import compute_water_balance_documents
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import os
 import glob
 import json # For potential pretty printing if needed
+import hashlib
+import argparse
+import queue
+import threading
+import time
 
 # --- Firebase Setup ---
 SERVICE_ACCOUNT_KEY_PATH = "sensorizacao-e-ambiente-51347-firebase-adminsdk-fbsvc-d6499a3058.json" 
+db = None
 
-try:
-    cred = credentials.Certificate(SERVICE_ACCOUNT_KEY_PATH)
-    if not firebase_admin._apps:
-        firebase_admin.initialize_app(cred)
-    db = firestore.client()
-    print("Successfully connected to Firebase Firestore.")
-except Exception as e:
-    print(f"Error initializing Firebase: {e}")
-    exit()
+def initialize_firebase(db_client=None):
+    """
+    Initializes Firebase Admin SDK and the global Firestore client (or adopts
+    db_client, e.g. the one shared by ingestion_daemon.py).
+    Called from the main process only, so parser worker processes never connect.
+    """
+    global db
+    if db_client is not None:
+        db = db_client
+        return db
+    if uses_local_backend(): # STORAGE_BACKEND=sqlite|memory (see document_store.py)
+        db = get_local_document_store()
+        return db
+    try:
+        cred = credentials.Certificate(SERVICE_ACCOUNT_KEY_PATH)
+        if not firebase_admin._apps:
+            firebase_admin.initialize_app(cred)
+        db = firestore.client()
+        print("Successfully connected to Firebase Firestore.")
+        return db
+    except Exception as e:
+        print(f"Error initializing Firebase: {e}")
+        exit()
 
 # --- Global dictionary to store region info: {sanitized_name: type} ---
 ALL_ENCOUNTERED_REGIONS_INFO = {}
 
-def get_region_type_from_suffix(filename_suffix):
-    """Determines the region type from the filename suffix."""
-    if "_Provincias" in filename_suffix: return "Provincia"
-    elif "_GrandesCuencas" in filename_suffix: return "GrandesCuencas"
-    elif "_ComunidadesAutonomas" in filename_suffix: return "ComunidadesAutonomas"
-    elif "_Nacional" in filename_suffix: return "Nacional"
-    else: return "Unknown" # Default if suffix doesn't match
-
-def get_parameter_code_from_prefix(prefix):
-    """Maps file prefix to a standardized parameter code (without suffix)."""
-    prefix_upper = prefix.upper()
-    if prefix_upper == "AD25": return "AD25mm"
-    elif prefix_upper == "AD75": return "AD75mm"
-    elif prefix_upper == "PADMAX": return "ADRmax"
-    elif prefix_upper == "ETO": return "ETo"
-    elif prefix_upper == "PREC": return "Precipitacion"
-    else:
-        print(f"Warning: Unrecognized parameter prefix '{prefix}'. Using as is.")
-        return prefix
-        
-def process_aemet_csv(csv_filepath, year):
+# --- Incremental upload manifest ---
+# Local record of what is already in Firestore: content hash of every CSV file
+# (plus the regions it contains) and hash of every uploaded document payload.
+DEFAULT_MANIFEST_PATH = ".aemet_upload_manifest.json"
+_manifest_lock = threading.Lock() # The bulk writer threads record committed writes while the manifest is saved
+
+def load_manifest(manifest_path):
+    """Loads the incremental upload manifest, or returns an empty one."""
+    empty_manifest = {"files": {}, "documents": {}, "regionsMetadataHash": None, "summariesSourceHash": None}
+    if not os.path.exists(manifest_path):
+        return empty_manifest
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        for key, default in empty_manifest.items():
+            manifest.setdefault(key, {} if isinstance(default, dict) else default)
+        return manifest
+    except (OSError, ValueError) as e:
+        print(f"Warning: Could not read manifest '{manifest_path}' ({e}). Starting from an empty manifest.")
+        return empty_manifest
+
+def save_manifest(manifest, manifest_path):
+    """Writes the manifest atomically (temporary file + replace) so a crash never leaves it half-written."""
+    tmp_path = manifest_path + ".tmp"
+    with _manifest_lock:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=1, sort_keys=True)
+        os.replace(tmp_path, manifest_path)
+
+def hash_file(filepath):
+    """SHA-256 of the raw file content."""
+    sha = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def hash_payload(payload):
+    """Stable hash of a document payload (keys sorted, so dict order does not matter)."""
+    encoded = json.dumps(payload, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+def manifest_file_key(csv_filepath, data_root_directory):
+    """Manifest key of a CSV: its path relative to the data root, with '/' separators."""
+    return os.path.relpath(csv_filepath, data_root_directory).replace(os.sep, '/')
+
+def record_regions(regions):
+    """Merges {sanitized region name: type} into ALL_ENCOUNTERED_REGIONS_INFO."""
     global ALL_ENCOUNTERED_REGIONS_INFO # Use the global dictionary
-    basename = os.path.basename(csv_filepath)
-    parts = basename.split('_')
-    
-    if len(parts) < 3 or not parts[1] == str(year):
-        # print(f"Skipping file {basename}: does not match expected format or year.")
-        return
+    for region_name_sanitized, region_type in regions.items():
+        # Store the type found in this file. If seen before, it should be the same.
+        if region_name_sanitized not in ALL_ENCOUNTERED_REGIONS_INFO:
+             ALL_ENCOUNTERED_REGIONS_INFO[region_name_sanitized] = region_type
+        elif ALL_ENCOUNTERED_REGIONS_INFO[region_name_sanitized] != region_type:
+             # This case should ideally not happen if a region name is unique to its type
+             print(f"Warning: Region '{region_name_sanitized}' found with multiple types: "
+                   f"'{ALL_ENCOUNTERED_REGIONS_INFO[region_name_sanitized]}' and '{region_type}'. Check data consistency.")
 
-    parameter_prefix = parts[0]
-    filename_suffix = "_" + "_".join(parts[2:])
-    
-    region_type = get_region_type_from_suffix(filename_suffix)
-    base_parameter_code = get_parameter_code_from_prefix(parameter_prefix)
-    
-    if region_type == "Unknown" or not base_parameter_code:
-        print(f"Skipping file {basename} due to unrecognized suffix or prefix.")
-        return
+def is_unchanged_file(manifest, file_key, file_hash):
+    """True if the manifest says this exact file content was already uploaded."""
+    file_entry = manifest["files"].get(file_key)
+    return bool(file_entry) and file_entry.get("sha256") == file_hash
+
+def update_manifest(manifest, section, key, value):
+    # Called from the bulk writer threads as writes commit
+    with _manifest_lock:
+        manifest[section][key] = value
+
+def record_document_when_written(manifest, document_path, payload_hash):
+    """Done-callback for a write future: stores the payload hash once the write has committed."""
+    def callback(future):
+        if future.exception() is None:
+            update_manifest(manifest, "documents", document_path, payload_hash)
+    return callback
+
+def timed_parse_aemet_csv(csv_filepath, year):
+    """parse_aemet_csv plus its duration, measured in the worker process and reported by the parent."""
+    start = time.perf_counter()
+    parsed = parse_aemet_csv(csv_filepath, year)
+    return parsed, time.perf_counter() - start
+
+def record_parse_metrics(parsed, seconds):
+    telemetry.observe(telemetry.STAGE_METRIC, seconds, stage="csv_parse")
+    if parsed is not None:
+        telemetry.inc("rows_total", len(parsed["documents"]), source="csv")
+
+def upload_parsed_csv(parsed, writer, manifest=None, file_key=None, file_hash=None):
+    """
+    Write stage: queues the documents produced by parse_aemet_csv on the bulk
+    writer. With a manifest, unchanged documents are not rewritten, each
+    document hash is recorded once its write has committed, and the file is
+    recorded once all its documents are in Firestore (a dead-lettered document
+    keeps the file pending for the next incremental run). Returns the number of
+    writes queued; the writer counts what was actually written.
+    """
+    basename = parsed["basename"]
+    futures = []
+    skipped_unchanged = 0
+
+    if parsed["documents"]:
+        print(f"\nUploading {len(parsed['documents'])} documents from {basename} (Param: {parsed['parameterCode']})")
+
+    for document in parsed["documents"]:
+        # Path uses the combined parameter code + type for the subcollection name
+        doc_ref = db.collection('aemetHistoricalData').document(document["region"])\
+                    .collection(parsed["parameterCode"]).document(str(document["year"]))
+        data_to_upload = document["payload"]
 
-    # Construct the parameter code to use for subcollection names (e.g., AD25mm_Provincias)
-    parameter_code_with_type = f"{base_parameter_code}_{region_type}"
+        if manifest is not None:
+            payload_hash = hash_payload(data_to_upload)
+            if manifest["documents"].get(doc_ref.path) == payload_hash:
+                skipped_unchanged += 1
+                continue
+            future = writer.set(doc_ref, data_to_upload)
+            future.add_done_callback(record_document_when_written(manifest, doc_ref.path, payload_hash))
+        else:
+            future = writer.set(doc_ref, data_to_upload)
+        futures.append(future)
 
-    # We only process regional files for the main data structure
-    is_regional_file = region_type in ["Provincia", "GrandesCuencas", "ComunidadesAutonomas"]
-    if not is_regional_file:
-         print(f"Skipping file {basename} data upload (type: {region_type}), but will record region name if applicable.")
-        # We might still want to record 'Nacional' as a region type if it appears in a file
-        # But Nacional files likely don't have a 'región' column to iterate over
-        # Let's handle Nacional type specifically if needed later or in metadata update
+    if manifest is not None:
+        if file_hash is not None:
+            file_entry = {"sha256": file_hash, "regions": parsed["regions"]}
+            on_all_written(futures, lambda: update_manifest(manifest, "files", file_key or basename, file_entry))
+        if skipped_unchanged:
+            print(f"Skipped {skipped_unchanged} unchanged documents in {basename}.")
+    return len(futures)
 
-    print(f"\nProcessing file: {basename} for Param: {base_parameter_code}, Type: {region_type}, Year: {year}")
+def collect_csv_files(data_root_directory):
+    """Lists (csv path, year) for every CSV inside the ebh_estadistica_anual_YYYY folders."""
+    csv_files = []
+    for year_folder_name in sorted(os.listdir(data_root_directory)):
+        year_folder_path = os.path.join(data_root_directory, year_folder_name)
+        if os.path.isdir(year_folder_path) and year_folder_name.startswith("ebh_estadistica_anual_"):
+            try:
+                year = int(year_folder_name.split('_')[-1])
+            except ValueError as e:
+                print(f"Error processing folder {year_folder_name}: {e}")
+                continue
+            for csv_file in sorted(glob.glob(os.path.join(year_folder_path, "*.csv"))):
+                csv_files.append((csv_file, year))
+    return csv_files
 
+def upload_all_csvs(data_root_directory, manifest=None, manifest_path=None, workers=None, parsed_documents=None):
+    """
+    Parallel pipeline: CSV files are parsed in a process pool (one file per
+    task) while a single thread queues the parsed documents on the bulk
+    writer, which commits several batches concurrently, so parsing never waits
+    on network round-trips. With parsed_documents, the documents of every
+    parsed file are kept there by manifest file key (for the summaries).
+    Returns the number of documents written.
+    """
+    jobs = []
+    for csv_file, year in collect_csv_files(data_root_directory):
+        if describe_aemet_csv(csv_file, year) is None:
+            continue
+        file_key = manifest_file_key(csv_file, data_root_directory)
+        file_hash = None
+        if manifest is not None:
+            file_hash = hash_file(csv_file)
+            if is_unchanged_file(manifest, file_key, file_hash):
+                record_regions(manifest["files"][file_key].get("regions", {}))
+                continue
+        jobs.append((csv_file, year, file_key, file_hash))
+
+    if not jobs:
+        print("No CSV files to process.")
+        return 0
+    print(f"Parsing {len(jobs)} CSV files with {workers or os.cpu_count()} worker processes...")
+
+    write_queue = queue.Queue(maxsize=64) # Bounded, so parsing cannot run far ahead of the writer
+    bulk_writer = BulkWriter(db)
+
+    def queue_writes():
+        while True:
+            item = write_queue.get()
+            if item is None:
+                return
+            parsed, file_key, file_hash = item
+            try:
+                upload_parsed_csv(parsed, bulk_writer, manifest=manifest, file_key=file_key, file_hash=file_hash)
+                if manifest is not None and manifest_path:
+                    save_manifest(manifest, manifest_path) # Progress so far; saved again once everything committed
+            except Exception as e:
+                print(f"An error occurred while uploading {parsed['basename']}: {e}")
+
+    writer_thread = threading.Thread(target=queue_writes, name="firestore-writer")
+    writer_thread.start()
     try:
-        try: df = pd.read_csv(csv_filepath, sep=';', encoding='utf-8', dtype=str)
-        except UnicodeDecodeError: df = pd.read_csv(csv_filepath, sep=';', encoding='latin-1', dtype=str)
-        
-        if df.empty or len(df.columns) < 2: # Need at least param desc and region
-            print(f"Warning: File {basename} is empty or has too few columns. Skipping.")
-            return
-            
-        parameter_desc_col = df.columns[0]
-        region_col = df.columns[1] # 'región' - Check if Nacional files have this!
-
-        if region_col.strip().lower() != 'región':
-             print(f"Warning: Second column in {basename} is not named 'región'. Assuming it's the region column: '{region_col}'.")
-             # If Nacional files have a different structure, add specific handling here.
-
-
-        month_names_standard = ["enero", "febrero", "marzo", "abril", "mayo", "junio", "julio", "agosto", "septiembre", "octubre", "noviembre", "diciembre"]
-        month_cols = [m for m in df.columns[2:] if m.strip().lower() in month_names_standard]
-
-        batch = db.batch()
-        write_count = 0
-
-        for index, row in df.iterrows():
-            region_name_original = row[region_col]
-            if pd.isna(region_name_original) or not region_name_original.strip(): continue
-            
-            region_name_sanitized = region_name_original.strip().replace('/', '_').replace('.', '')
-            if not region_name_sanitized: continue
-
-            # --- Store region name and type in the global dictionary ---
-            # Store the type found in this file. If seen before, it should be the same.
-            if region_name_sanitized not in ALL_ENCOUNTERED_REGIONS_INFO:
-                 ALL_ENCOUNTERED_REGIONS_INFO[region_name_sanitized] = region_type
-            elif ALL_ENCOUNTERED_REGIONS_INFO[region_name_sanitized] != region_type:
-                 # This case should ideally not happen if a region name is unique to its type
-                 print(f"Warning: Region '{region_name_sanitized}' found with multiple types: "
-                       f"'{ALL_ENCOUNTERED_REGIONS_INFO[region_name_sanitized]}' and '{region_type}'. Check data consistency.")
-                 # Decide on precedence or store multiple types if needed (more complex)
-            # --- ---
-            
-            # Only upload data for regional files that have month columns
-            if not is_regional_file or not month_cols: continue 
-
-            parameter_description_from_csv = row[parameter_desc_col].strip()
-            monthly_values_data = {}
-            has_valid_month_data = False
-            for month_name_csv in month_cols:
-                month_name_clean = month_name_csv.strip().lower()
-                value_str = row[month_name_csv]
-                if pd.notna(value_str) and value_str.strip():
-                    try: monthly_values_data[month_name_clean] = float(value_str.replace(',', '.')) ; has_valid_month_data = True
-                    except ValueError: monthly_values_data[month_name_clean] = None
-                else: monthly_values_data[month_name_clean] = None
-            
-            if not has_valid_month_data: continue
-            
-            # Path uses the combined parameter code + type for the subcollection name
-            doc_ref = db.collection('aemetHistoricalData').document(region_name_sanitized)\
-                        .collection(parameter_code_with_type).document(str(year))
-            
-            data_to_upload = {
-                "parameterDescriptionCSV": parameter_description_from_csv,
-                "monthlyValues": monthly_values_data,
-                "regionOriginal": region_name_original.strip(),
-                "year": int(year),
-                "parameterCodeUsed": parameter_code_with_type, 
-                "baseParameter": base_parameter_code, # Store base param
-                "regionType": region_type, # Store type
-                "sourceFile": basename
-            }
-            batch.set(doc_ref, data_to_upload)
-            write_count += 1
-            
-            if write_count >= 490:
-                print(f"Committing intermediate batch of {write_count} operations for {basename}...")
-                batch.commit(); batch = db.batch(); write_count = 0
-        
-        if write_count > 0:
-            print(f"Committing final batch of {write_count} operations for {basename}...")
-            batch.commit()
-        # print(f"Finished processing data upload for {basename}.") # Less verbose
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(timed_parse_aemet_csv, csv_file, year): (csv_file, file_key, file_hash)
+                       for csv_file, year, file_key, file_hash in jobs}
+            for future in as_completed(futures):
+                csv_file, file_key, file_hash = futures[future]
+                try:
+                    parsed, seconds = future.result()
+                except Exception as e:
+                    telemetry.inc("errors_total", stage="csv_parse")
+                    print(f"An error occurred while processing {csv_file}: {e}")
+                    continue
+                record_parse_metrics(parsed, seconds)
+                if parsed is None:
+                    continue
+                record_regions(parsed["regions"])
+                if parsed_documents is not None:
+                    parsed_documents[file_key] = parsed["documents"]
+                write_queue.put((parsed, file_key, file_hash))
+    finally:
+        write_queue.put(None)
+        writer_thread.join()
+        stats = bulk_writer.close()
 
-    except Exception as e:
-        print(f"An error occurred while processing {csv_filepath}: {e}")
-        import traceback; traceback.print_exc()
+    print(f"Wrote {stats['written']}/{stats['queued']} documents to aemetHistoricalData "
+          f"({stats['deadLettered']} failed).")
+    return stats['written']
 
-def update_regions_metadata():
+def update_regions_metadata(manifest=None):
     global ALL_ENCOUNTERED_REGIONS_INFO
     if not ALL_ENCOUNTERED_REGIONS_INFO:
         print("No regions were encountered during processing. Metadata not updated.")
@@ -182,6 +286,11 @@ def update_regions_metadata():
     # Sort the list of objects, e.g., by type then by id
     regions_list_for_metadata.sort(key=lambda x: (x['type'], x['id']))
 
+    regions_hash = hash_payload(regions_list_for_metadata)
+    if manifest is not None and manifest.get("regionsMetadataHash") == regions_hash:
+        print("Regions metadata unchanged since the last upload. Skipping.")
+        return
+
     metadata_doc_ref = db.collection('metadata').document('regionsWithType') # Use a new document name
     try:
         metadata_doc_ref.set({
@@ -189,28 +298,193 @@ def update_regions_metadata():
             'lastUpdated': firestore.SERVER_TIMESTAMP
         })
         print(f"Successfully updated {metadata_doc_ref.path} document.")
+        if manifest is not None:
+            manifest["regionsMetadataHash"] = regions_hash
         # Optional: Print the JSON representation for verification
         # print(json.dumps(regions_list_for_metadata, indent=2, ensure_ascii=False)) 
     except Exception as e:
         print(f"Error updating {metadata_doc_ref.path} document: {e}")
 
+def upload_from_store(store_path, manifest=None, manifest_path=None, parsed_documents=None):
+    """
+    Uploads aemetHistoricalData as a projection of the columnar store compiled
+    by aemet_store.py, instead of re-parsing the CSVs. Document hashes in the
+    manifest still apply, so unchanged documents are not rewritten. With
+    parsed_documents, the documents of every file are kept there by basename.
+    Returns the number of documents written.
+    """
+    from aemet_store import load_store, iter_parsed_files # pyarrow is only needed for this mode
+
+    if not os.path.exists(store_path):
+        print(f"ERROR: Store '{store_path}' not found. Run 'python aemet_store.py compile' first.")
+        return 0
+    table = load_store(store_path)
+    print(f"Uploading from store '{store_path}' ({table.num_rows} rows)...")
+
+    with BulkWriter(db) as writer:
+        for parsed in iter_parsed_files(table):
+            record_regions(parsed["regions"])
+            if parsed_documents is not None:
+                parsed_documents[parsed["basename"]] = parsed["documents"]
+            try:
+                upload_parsed_csv(parsed, writer, manifest=manifest)
+                if manifest is not None and manifest_path:
+                    save_manifest(manifest, manifest_path)
+            except Exception as e:
+                print(f"An error occurred while uploading {parsed['basename']}: {e}")
+    stats = writer.stats()
+    print(f"Wrote {stats['written']}/{stats['queued']} documents to aemetHistoricalData "
+          f"({stats['deadLettered']} failed).")
+    return stats['written']
+
+def collect_all_documents(data_root_directory=None, store_path=None, workers=None, parsed_documents=None):
+    """
+    Returns every aemetHistoricalData document of the dataset (all years), from
+    the columnar store if given, otherwise by parsing the CSVs in a process pool.
+    parsed_documents holds the documents already parsed by this run's upload
+    (filled by upload_all_csvs / upload_from_store); only the other files are parsed.
+    """
+    parsed_documents = parsed_documents or {}
+    documents = [document for file_documents in parsed_documents.values() for document in file_documents]
+    if store_path:
+        if parsed_documents: # upload_from_store has gone through every file of the store
+            return documents
+        from aemet_store import load_store, iter_parsed_files
+        for parsed in iter_parsed_files(load_store(store_path)):
+            documents.extend(parsed["documents"])
+        return documents
+
+    csv_files = [(csv_file, year) for csv_file, year in collect_csv_files(data_root_directory)
+                 if manifest_file_key(csv_file, data_root_directory) not in parsed_documents]
+    if not csv_files:
+        return documents
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for parsed in pool.map(parse_aemet_csv, *zip(*csv_files)):
+            if parsed is not None:
+                documents.extend(parsed["documents"])
+    return documents
+
+def summaries_source_hash(manifest, store_path=None):
+    """
+    Identifies the data the summary documents are computed from: the store
+    file, or the hashes of the CSVs the manifest records as uploaded.
+    """
+    if store_path:
+        return hash_file(store_path)
+    return hash_payload({file_key: entry.get("sha256") for file_key, entry in manifest["files"].items()})
+
+def upload_summary_documents(summaries, subcollection, label, manifest=None):
+    """
+    Writes {(region, document id): payload} to
+    aemetHistoricalData/{region}/{subcollection}/{document id}, skipping the
+    documents whose payload is unchanged in the manifest. Returns the number
+    documents written and the number that could not be written.
+    """
+    print(f"\nUploading {len(summaries)} {label} documents...")
+    unchanged = 0
+    with BulkWriter(db) as writer:
+        for (region_name, document_id), summary in summaries.items():
+            doc_ref = db.collection('aemetHistoricalData').document(region_name)\
+                        .collection(subcollection).document(document_id)
+            payload_hash = hash_payload(summary) # Hashed before the server timestamp is added
+            if manifest is not None and manifest["documents"].get(doc_ref.path) == payload_hash:
+                unchanged += 1
+                continue
+            future = writer.set(doc_ref, {**summary, "lastUpdated": firestore.SERVER_TIMESTAMP})
+            if manifest is not None:
+                future.add_done_callback(record_document_when_written(manifest, doc_ref.path, payload_hash))
+    print(f"Wrote {writer.written} {label} documents ({unchanged} unchanged, {writer.dead_lettered} failed).")
+    return writer.written, writer.dead_lettered
+
+def upload_climatologies(documents, manifest=None):
+    """
+    Writes one summary document per (region, parameter) to
+    aemetHistoricalData/{region}/climatology/{parameterCode}: multi-year monthly
+    mean, min, max and percentiles, plus each year's anomaly against the mean.
+    Returns (documents written, documents that failed).
+    """
+    climatologies = compute_climatologies(documents)
+    if not climatologies:
+        print("No historical documents available. Climatology not updated.")
+        return 0, 0
+    return upload_summary_documents(climatologies, 'climatology', 'climatology', manifest)
+
+def upload_water_balance(documents, manifest=None):
+    """
+    Writes the historical irrigation need of every region and crop (bucket
+    water balance, see water_balance.py) to
+    aemetHistoricalData/{region}/waterBalance/{crop}_{regionType}.
+    Returns (documents written, documents that failed).
+    """
+    water_balance = compute_water_balance_documents(documents)
+    if not water_balance:
+        print("No precipitation/ETo documents available. Water balance not updated.")
+        return 0, 0
+    return upload_summary_documents(water_balance, 'waterBalance', 'water balance', manifest)
+
+
+def sync_historical_data(data_root_directory, incremental=False, manifest_path=DEFAULT_MANIFEST_PATH, workers=None,
+                         store_path=None, climatology=True):
+    """
+    Full upload run: the CSVs (or the compiled store), the regions metadata and
+    the climatology and water balance summary documents. With incremental=True only what changed since
+    the manifest was last saved is written, and the summaries are not recomputed
+    when no file changed. Requires initialize_firebase().
+    Returns the number of aemetHistoricalData documents written.
+    """
+    manifest = load_manifest(manifest_path) if incremental else None
+    if manifest is not None:
+        print(f"Incremental mode: {len(manifest['files'])} files and {len(manifest['documents'])} documents in manifest '{manifest_path}'.")
+
+    parsed_documents = {} if climatology else None # Reused by the summaries instead of parsing the files again
+    if store_path:
+        written = upload_from_store(store_path, manifest=manifest, manifest_path=manifest_path,
+                                    parsed_documents=parsed_documents)
+    else:
+        written = upload_all_csvs(data_root_directory, manifest=manifest, manifest_path=manifest_path, workers=workers,
+                                  parsed_documents=parsed_documents)
+
+    update_regions_metadata(manifest) # Update metadata after processing all files
+    if climatology:
+        try:
+            source_hash = summaries_source_hash(manifest, store_path) if manifest is not None else None
+            if source_hash is not None and manifest.get("summariesSourceHash") == source_hash:
+                print("\nNo data file changed since the summaries were computed. Climatology and water balance skipped.")
+            else:
+                all_documents = collect_all_documents(data_root_directory, store_path=store_path, workers=workers,
+                                                      parsed_documents=parsed_documents)
+                failed = upload_climatologies(all_documents, manifest)[1] + upload_water_balance(all_documents, manifest)[1]
+                if manifest is not None and not failed: # Failed documents are retried on the next run
+                    manifest["summariesSourceHash"] = source_hash
+        except Exception as e:
+            print(f"Error updating climatology and water balance documents: {e}")
+    if manifest is not None: save_manifest(manifest, manifest_path)
+    print("\nAll AEMET data processing finished.")
+    return written
+
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Uploads the AEMET EBH annual statistics under aemetDATA/ to Firestore.")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Skip files and documents that have not changed since the last incremental upload.")
+    parser.add_argument("--manifest", default=DEFAULT_MANIFEST_PATH,
+                        help=f"Manifest file used by --incremental (default: {DEFAULT_MANIFEST_PATH}).")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Parser processes (default: one per CPU core).")
+    parser.add_argument("--no-climatology", action="store_true",
+                        help="Do not recompute the per-region climatology and water balance summary documents.")
+    parser.add_argument("--from-store", metavar="STORE_PATH",
+                        help="Upload from a columnar store compiled with 'python aemet_store.py compile' instead of the CSVs.")
+    args = parser.parse_args()
+    telemetry.configure_from_env("upload_all_aemet_data")
+
     data_root_directory = "./aemetDATA/" 
-    # ... (directory check) ...
+    if not args.from_store and not os.path.isdir(data_root_directory):
+        print(f"ERROR: Data directory '{data_root_directory}' not found.")
+        exit()
     print(f"Starting AEMET data upload from: {os.path.abspath(data_root_directory)}")
 
-    for year_folder_name in os.listdir(data_root_directory):
-        # ... (process each year folder and CSV file within) ...
-         year_folder_path = os.path.join(data_root_directory, year_folder_name)
-         if os.path.isdir(year_folder_path) and year_folder_name.startswith("ebh_estadistica_anual_"):
-             try:
-                 year = int(year_folder_name.split('_')[-1])
-                 # print(f"\nProcessing year folder: {year_folder_name} for year {year}")
-                 all_csvs = glob.glob(os.path.join(year_folder_path, "*.csv"))
-                 if not all_csvs: continue
-                 for csv_file in all_csvs: process_aemet_csv(csv_file, year)
-             except Exception as e: print(f"Error processing folder {year_folder_name}: {e}")
-
-    update_regions_metadata() # Update metadata after processing all files
-    print("\nAll AEMET data processing finished.")
\ No newline at end of file
+    initialize_firebase()
+    sync_historical_data(data_root_directory, incremental=args.incremental, manifest_path=args.manifest,
+                         workers=args.workers, store_path=args.from_store, climatology=not args.no_climatology)
+    materialize_region_bundles(db)
@@ -0,0 +1,323 @@
+import numpy as np
+import warnings
+from aemet_csv_parser import MONTH_NAMES_STANDARD, parse_aemet_csv
+import argparse
+import glob
+import os
+
+# --- Soil water balance / irrigation need from the EBH statistics ---
+# Monthly bucket model of the root zone, run for every region x year x crop
+# coefficient x soil capacity at once. Only the 12 (or 365) time steps are a
+# Python loop; every step is one set of NumPy operations over all the scenarios:
+#
+#   water      = soil water + effective rain - Kc * ETo
+#   irrigation = what brings water back up to (1 - p) * capacity (FAO-56 readily available water)
+#   drainage   = water above the capacity
+#
+# Forcing comes from the aemetHistoricalData documents (PREC -> Precipitacion,
+# ETO -> ETo) and the initial soil water from the observed ADRmax (PADMAX, % of
+# the maximum capacity) of the month before the start, or from a sensor's
+# 'humedad' (taken as % of the capacity) for projections from today.
+#
+#   model = WaterBalanceModel.from_documents(documents)
+#   model.historical(CROP_COEFFICIENTS)                          all regions x years x crops x capacities
+#   model.project("MADRID", start_month=6, initial_humidity=35)  rest of the year, one run per historical year
+
+CAPACITIES_MM = (25.0, 75.0, 150.0) # Root-zone capacities (AD25 and AD75 of the EBH, plus a deep soil)
+DEPLETION_FRACTION = 0.5 # FAO-56 p: irrigate before the crop uses more than half the available water
+EFFECTIVE_RAIN_FRACTION = 0.8 # Share of the rain that enters the root zone
+RAIN_DAYS_PER_MONTH = 6 # Daily mode: the monthly rain falls on this many evenly spaced days
+DAYS_IN_MONTH = (31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)
+PROJECTION_PERCENTILES = (50, 90) # p90: a dry year
+
+PRECIPITATION_PARAMETER = "Precipitacion"
+ETO_PARAMETER = "ETo"
+SOIL_MOISTURE_PARAMETER = "ADRmax"
+MODEL_FILE_PREFIXES = ("PREC", "ETO", "PADMAX")
+
+# Orientative monthly crop coefficients (FAO-56 stages mapped onto a typical Spanish calendar;
+# the low winter/summer values are the bare or dormant soil)
+CROP_COEFFICIENTS = {
+    "cereal_invierno": (0.70, 0.80, 1.00, 1.15, 1.15, 0.60, 0.30, 0.30, 0.30, 0.40, 0.50, 0.60),
+    "maiz": (0.30, 0.30, 0.30, 0.40, 0.60, 1.00, 1.20, 1.20, 0.90, 0.50, 0.30, 0.30),
+    "vid": (0.30, 0.30, 0.30, 0.40, 0.55, 0.70, 0.70, 0.70, 0.60, 0.45, 0.30, 0.30),
+    "olivo": (0.50, 0.50, 0.65, 0.65, 0.60, 0.55, 0.55, 0.55, 0.60, 0.65, 0.65, 0.50),
+    "hortalizas": (0.50, 0.50, 0.60, 0.80, 1.00, 1.05, 1.05, 1.00, 0.80, 0.60, 0.50, 0.50),
+    "pradera": (0.85, 0.85, 0.90, 0.95, 1.00, 1.00, 1.00, 1.00, 0.95, 0.90, 0.85, 0.85),
+}
+
+
+def simulate_bucket(precipitation, eto, kc, capacity, initial_fraction, start_month=0, daily=False,
+                    depletion=DEPLETION_FRACTION, effective_rain=EFFECTIVE_RAIN_FRACTION):
+    """
+    Runs the bucket model from start_month (0 = enero) to December.
+
+    precipitation, eto and kc are (..., 12) arrays in mm (kc dimensionless);
+    capacity (mm) and initial_fraction (0-1 of the capacity) are (...) arrays.
+    All of them are broadcast together, so each axis can be regions, years,
+    crops or capacities. Returns {'irrigation', 'drainage', 'soilWater'}:
+    monthly irrigation need and drainage (mm) and the soil water at the end of
+    each month, as (..., 12) arrays with NaN before start_month. Missing
+    forcing (NaN) propagates to the months that depend on it.
+    """
+    precipitation, eto, kc = (np.asarray(a, dtype=float) for a in (precipitation, eto, kc))
+    capacity, initial_fraction = np.asarray(capacity, dtype=float), np.asarray(initial_fraction, dtype=float)
+    shape = np.broadcast_shapes(precipitation.shape[:-1], eto.shape[:-1], kc.shape[:-1],
+                                capacity.shape, initial_fraction.shape)
+    capacity = np.broadcast_to(capacity, shape)
+    floor = (1.0 - depletion) * capacity
+    water = np.clip(initial_fraction, 0.0, 1.0) * capacity
+    rain = effective_rain * precipitation
+    demand = kc * eto
+
+    results = {name: np.full(shape + (12,), np.nan) for name in ('irrigation', 'drainage', 'soilWater')}
+    for month in range(start_month, 12):
+        if daily:
+            days = DAYS_IN_MONTH[month]
+            rain_every = max(1, days // RAIN_DAYS_PER_MONTH)
+            rain_days = len(range(0, days, rain_every))
+            irrigation = np.zeros(shape)
+            drainage = np.zeros(shape)
+            for day in range(days):
+                day_rain = rain[..., month] / rain_days if day % rain_every == 0 else 0.0
+                water, day_irrigation, day_drainage = _step(water, day_rain, demand[..., month] / days, floor, capacity)
+                irrigation += day_irrigation
+                drainage += day_drainage
+        else:
+            water, irrigation, drainage = _step(water, rain[..., month], demand[..., month], floor, capacity)
+        results['irrigation'][..., month] = irrigation
+        results['drainage'][..., month] = drainage
+        results['soilWater'][..., month] = water
+    return results
+
+def _step(water, rain, demand, floor, capacity):
+    water = water + rain - demand
+    irrigation = np.maximum(floor - water, 0.0)
+    water = water + irrigation
+    drainage = np.maximum(water - capacity, 0.0)
+    return np.minimum(water, capacity), irrigation, drainage
+
+
+def _crop_array(crops):
+    """(names, (crops, 12) Kc array) from {name: Kc or 12 monthly Kc}."""
+    names = list(crops)
+    return names, np.array([np.broadcast_to(np.asarray(crops[name], dtype=float), (12,)) for name in names])
+
+
+class WaterBalanceModel:
+    """
+    Forcing of every (region, region type) laid out as (regions, years, 12)
+    arrays: precipitation and ETo in mm, soil moisture in % of the maximum
+    capacity. Built once; each run is a single vectorized pass.
+    """
+
+    def __init__(self, keys, region_names, years, precipitation, eto, soil_moisture):
+        self.keys = keys # [(region, region type)]
+        self.region_names = region_names # Original (display) name of each key
+        self.years = years
+        self.precipitation = precipitation
+        self.eto = eto
+        self.soil_moisture = soil_moisture
+        self._index = {(_region_lookup_key(region), region_type): i for i, (region, region_type) in enumerate(keys)}
+
+    @classmethod
+    def from_documents(cls, documents):
+        """From the {"region", "year", "payload"} entries of aemet_csv_parser (regions with PREC and ETO only)."""
+        parameters = (PRECIPITATION_PARAMETER, ETO_PARAMETER, SOIL_MOISTURE_PARAMETER)
+        relevant = [d for d in documents if d["payload"]["baseParameter"] in parameters]
+        available = {}
+        for d in relevant:
+            available.setdefault((d["region"], d["payload"]["regionType"]), set()).add(d["payload"]["baseParameter"])
+        keys = sorted(key for key, found in available.items() if {PRECIPITATION_PARAMETER, ETO_PARAMETER} <= found)
+        years = sorted({int(d["year"]) for d in relevant})
+        key_index = {key: i for i, key in enumerate(keys)}
+        year_index = {year: i for i, year in enumerate(years)}
+
+        arrays = {parameter: np.full((len(keys), len(years), 12), np.nan) for parameter in parameters}
+        region_names = [None] * len(keys)
+        for d in relevant:
+            k = key_index.get((d["region"], d["payload"]["regionType"]))
+            if k is None:
+                continue
+            monthly = d["payload"]["monthlyValues"]
+            arrays[d["payload"]["baseParameter"]][k, year_index[int(d["year"])]] = [
+                np.nan if monthly.get(month) is None else monthly[month] for month in MONTH_NAMES_STANDARD
+            ]
+            region_names[k] = region_names[k] or d["payload"]["regionOriginal"]
+        return cls(keys, region_names, years, arrays[PRECIPITATION_PARAMETER], arrays[ETO_PARAMETER],
+                   arrays[SOIL_MOISTURE_PARAMETER])
+
+    @classmethod
+    def load(cls, data_root="./aemetDATA/", store_path=None):
+        """From the compiled columnar store if it exists, otherwise from the CSVs under data_root."""
+        documents = []
+        if store_path and os.path.exists(store_path):
+            from aemet_store import load_store, iter_parsed_files
+            for parsed in iter_parsed_files(load_store(store_path)):
+                documents.extend(parsed["documents"])
+        else:
+            # Only the three files per year and region type the model uses
+            for csv_file in sorted(glob.glob(os.path.join(data_root, "ebh_estadistica_anual_*", "*.csv"))):
+                prefix, _, rest = os.path.basename(csv_file).partition('_')
+                year = rest.split('_')[0]
+                if prefix.upper() in MODEL_FILE_PREFIXES and year.isdigit():
+                    parsed = parse_aemet_csv(csv_file, int(year))
+                    if parsed is not None:
+                        documents.extend(parsed["documents"])
+        return cls.from_documents(documents)
+
+    def find(self, region, region_type=None):
+        """
+        Index of a region (by sanitized id, preferring Provincia when the type is
+        not given); None if unknown. Case, spaces and underscores are not
+        significant: 'A_CORUÑA' finds 'A CORUÑA'.
+        """
+        region = _region_lookup_key(region)
+        if region_type is not None:
+            return self._index.get((region, region_type))
+        matches = [i for (name, kind), i in self._index.items() if name == region]
+        matches.sort(key=lambda i: self.keys[i][1] != "Provincia")
+        return matches[0] if matches else None
+
+    def initial_fractions(self, start_month=0):
+        """Observed soil moisture at the start of start_month as a 0-1 fraction, (regions, years); full soil when unknown."""
+        if start_month > 0:
+            observed = self.soil_moisture[:, :, start_month - 1]
+        else:
+            # December of the year before (January of the same year for the first one)
+            observed = np.concatenate([self.soil_moisture[:, :1, 0], self.soil_moisture[:, :-1, 11]], axis=1)
+        return np.nan_to_num(observed / 100.0, nan=1.0)
+
+    def historical(self, crops=CROP_COEFFICIENTS, capacities=CAPACITIES_MM, daily=False):
+        """
+        Every region x year x crop x capacity from January, starting from the
+        observed soil moisture. Returns (crop names, results) with
+        (regions, years, crops, capacities, 12) arrays.
+        """
+        names, kc = _crop_array(crops)
+        capacities = np.asarray(capacities, dtype=float)
+        results = simulate_bucket(
+            self.precipitation[:, :, None, None, :], self.eto[:, :, None, None, :], kc[None, None, :, None, :],
+            capacities[None, None, None, :], self.initial_fractions(0)[:, :, None, None], daily=daily)
+        return names, results
+
+    def project(self, region, start_month, initial_humidity=None, crops=CROP_COEFFICIENTS, capacities=CAPACITIES_MM,
+                region_type=None, daily=False):
+        """
+        Irrigation need from start_month to December, starting from
+        initial_humidity (% of the capacity, e.g. a sensor's 'humedad'; the
+        observed soil moisture of each year when None), with the weather of
+        every historical year. Returns None for unknown regions, otherwise
+        {crop: {capacity: {'p50': mm, 'p90': mm, 'perYear': {year: mm}}}}.
+        """
+        r = self.find(region, region_type)
+        if r is None:
+            return None
+        names, kc = _crop_array(crops)
+        capacities = np.asarray(capacities, dtype=float)
+        if initial_humidity is None:
+            initial = self.initial_fractions(start_month)[r][:, None, None]
+        else:
+            initial = np.float64(initial_humidity) / 100.0
+        results = simulate_bucket(self.precipitation[r][:, None, None, :], self.eto[r][:, None, None, :],
+                                  kc[None, :, None, :], capacities[None, None, :], initial,
+                                  start_month=start_month, daily=daily)
+        totals = results['irrigation'][..., start_month:].sum(axis=-1) # (years, crops, capacities); NaN if a month is missing
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", category=RuntimeWarning) # All-NaN when no year has complete data
+            percentiles = np.nanpercentile(totals, PROJECTION_PERCENTILES, axis=0)
+        projection = {}
+        for c, name in enumerate(names):
+            projection[name] = {}
+            for j, capacity in enumerate(capacities):
+                entry = {f"p{p}": _round(percentiles[i, c, j]) for i, p in enumerate(PROJECTION_PERCENTILES)}
+                entry['perYear'] = {str(year): _round(totals[y, c, j]) for y, year in enumerate(self.years)}
+                projection[name][_capacity_key(capacity)] = entry
+        return projection
+
+
+def _region_lookup_key(region):
+    return ' '.join(str(region).replace('_', ' ').split()).upper()
+
+def _round(value):
+    return None if np.isnan(value) else round(float(value), 1)
+
+def _capacity_key(capacity):
+    return f"{capacity:g}mm"
+
+def _to_firestore_values(array_1d):
+    """Maps a 12-month array to {month name: float or None}."""
+    return {month: _round(value) for month, value in zip(MONTH_NAMES_STANDARD, array_1d)}
+
+def compute_water_balance_documents(documents, crops=CROP_COEFFICIENTS, capacities=CAPACITIES_MM):
+    """
+    Historical irrigation need of every region and crop, from the
+    aemetHistoricalData documents. Returns {(region, document id): payload},
+    with document ids like maiz_Provincia (the region type, as in the
+    climatology parameter codes).
+    """
+    model = WaterBalanceModel.from_documents(documents)
+    if not model.keys:
+        return {}
+    names, results = model.historical(crops, capacities)
+    irrigation, drainage = results['irrigation'], results['drainage']
+    annual_irrigation = irrigation.sum(axis=-1) # (regions, years, crops, capacities)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        monthly_mean = np.nanmean(irrigation, axis=1) # (regions, crops, capacities, 12)
+        annual_mean = np.nanmean(annual_irrigation, axis=1)
+        annual_p90 = np.nanpercentile(annual_irrigation, 90, axis=1)
+        drainage_mean = np.nanmean(drainage.sum(axis=-1), axis=1)
+
+    water_balance = {}
+    for r, (region, region_type) in enumerate(model.keys):
+        for c, crop in enumerate(names):
+            water_balance[(region, f"{crop}_{region_type}")] = {
+                "region": region,
+                "regionOriginal": model.region_names[r],
+                "regionType": region_type,
+                "crop": crop,
+                "kcMonthly": _to_firestore_values(np.broadcast_to(np.asarray(crops[crop], dtype=float), (12,))),
+                "depletionFraction": DEPLETION_FRACTION,
+                "effectiveRainFraction": EFFECTIVE_RAIN_FRACTION,
+                "years": model.years,
+                "capacities": {
+                    _capacity_key(capacity): {
+                        "irrigationMonthlyMean": _to_firestore_values(monthly_mean[r, c, j]),
+                        "irrigationAnnualMean": _round(annual_mean[r, c, j]),
+                        "irrigationAnnualP90": _round(annual_p90[r, c, j]),
+                        "irrigationAnnual": {str(year): _round(annual_irrigation[r, y, c, j])
+                                             for y, year in enumerate(model.years)},
+                        "drainageAnnualMean": _round(drainage_mean[r, c, j]),
+                    }
+                    for j, capacity in enumerate(capacities)
+                },
+            }
+    return water_balance
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Irrigation need of a region from the AEMET water balance statistics.")
+    parser.add_argument("region", help="Sanitized region id, e.g. MADRID or \"A CORUÑA\" (A_CORUÑA also works).")
+    parser.add_argument("--crop", choices=sorted(CROP_COEFFICIENTS), default=None, help="One crop (default: all).")
+    parser.add_argument("--month", type=int, choices=range(1, 13), default=None, metavar="1-12", help="Start month 1-12 (default: the current one).")
+    parser.add_argument("--humidity", type=float, default=None,
+                        help="Current soil humidity in %% of the capacity, e.g. a sensor's 'humedad' (default: observed).")
+    parser.add_argument("--daily", action="store_true", help="Disaggregate the months into daily steps.")
+    parser.add_argument("--data-root", default="./aemetDATA/")
+    parser.add_argument("--store", default=None, help="Read the compiled columnar store instead of the CSVs.")
+    args = parser.parse_args()
+
+    from datetime import datetime
+    model = WaterBalanceModel.load(args.data_root, args.store)
+    start_month = (args.month if args.month is not None else datetime.now().month) - 1
+    crops = {args.crop: CROP_COEFFICIENTS[args.crop]} if args.crop else CROP_COEFFICIENTS
+    projection = model.project(args.region, start_month, args.humidity, crops=crops, daily=args.daily)
+    if projection is None:
+        print(f"Region '{args.region}' has no precipitation/ETo data.")
+        exit()
+    print(f"Irrigation need from {MONTH_NAMES_STANDARD[start_month]} to diciembre in {args.region} "
+          f"(years {model.years[0]}-{model.years[-1]}, mm):")
+    for crop, by_capacity in projection.items():
+        cells = ", ".join(f"{capacity}: p50={entry['p50']} p90={entry['p90']}" for capacity, entry in by_capacity.items())
+        print(f"  {crop:16s} {cells}")